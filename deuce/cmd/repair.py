@@ -0,0 +1,20 @@
+from deuce.common import cli
+from deuce import conf
+from deuce.drivers.sqlite import SqliteStorageDriver
+import deuce.util.log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+@cli.runnable
+def run():
+    """Recomputes the block reference counts kept by the
+    sqlite metadata driver"""
+    if conf.metadata_driver.driver != 'sqlite':
+        LOG.error(u'Block reference counts are only kept by the '
+                  u'sqlite metadata driver')
+        return
+
+    repaired = SqliteStorageDriver().repair_block_ref_counts()
+    LOG.info(u'Repaired the reference counts of {0} blocks'.format(repaired))
@@ -1,3 +1,7 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import threading
 import time
 import uuid
 import socket
@@ -5,8 +9,25 @@ import socket
 import six
 from abc import ABCMeta, abstractmethod, abstractproperty
 
+import deuce
 from deuce import conf
 
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Returns the thread pool shared by every download's
+    prefetching, so that the number of blocks being fetched at
+    once stays bounded however many downloads are running"""
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=conf.api_configuration.block_prefetch_workers)
+        return _executor
+
 
 @six.add_metaclass(ABCMeta)
 class BlockStorageDriver(object):
@@ -51,10 +72,12 @@ class BlockStorageDriver(object):
         raise NotImplementedError
 
     @abstractmethod
-    def get_vault_statistics(self, vault_id):
+    def get_vault_statistics(self, vault_id, recompute=False):
         """Return the statistics on the vault.
 
-        "param vault_id: The ID of the vault to gather statistics for"""
+        :param vault_id: The ID of the vault to gather statistics for
+        :param recompute: Whether to count the statistics afresh
+            instead of using any running totals the driver keeps"""
         raise NotImplementedError
 
     @abstractmethod
@@ -74,21 +97,31 @@ class BlockStorageDriver(object):
         raise NotImplementedError
 
     @abstractmethod
-    def store_block(self, vault_id, metadata_block_id, block_data):
+    def store_block(self, vault_id, metadata_block_id, block_data,
+                    md5=None):
         """Stores the block into the specified vault
 
         :param metadata_block_id: The Metadata ID of the block
+        :param md5: The MD5 hexdigest of the block data, if the
+            caller has already computed it
         :returns: A tuple containing the status of saving the block to storage
                     (True/False), and the storage id of the block"""
         raise NotImplementedError
 
     @abstractmethod
-    def store_async_block(self, vault_id, metadata_block_ids, block_datas):
+    def store_async_block(self, vault_id, metadata_block_ids, block_datas,
+                          md5s=None):
         """Stores blocks asynchronously into the specified vault
 
         :param vault_id: The IDs of the vault
         :param metadata_block_ids: The Metadata IDs of the blocks
         :param block_datas: The content of the blocks
+        :param md5s: The MD5 hexdigests of the blocks, if the
+            caller has already computed them
+        :returns: A tuple of whether every block was stored and
+            the storage id of each block, or None for a block
+            that was not stored. The list is empty if none of
+            the blocks are known to have been stored
         """
         raise NotImplementedError
 
@@ -106,10 +139,69 @@ class BlockStorageDriver(object):
     def create_blocks_generator(self, vault_id, storage_block_gen):
         """Returns a generator of file-like objects that are
         ready to read. These objects will get closed
-        individually."""
-        return ((storage_block_id,
-                 self.get_block_obj(vault_id, storage_block_id))
-            for storage_block_id in storage_block_gen)
+        individually.
+
+        While the caller reads one block, up to
+        api_configuration.block_prefetch_window of the blocks
+        following it are fetched in the background, on at most
+        api_configuration.block_prefetch_workers threads shared
+        by all downloads. Prefetched blocks are read into memory
+        so that they do not hold a storage connection while they
+        wait, which costs up to window + 1 whole blocks of memory
+        per download. The default window of zero fetches each
+        block only when it is asked for, and streams it."""
+        window = conf.api_configuration.block_prefetch_window
+
+        if window < 1:
+            return ((storage_block_id,
+                     self.get_block_obj(vault_id, storage_block_id))
+                for storage_block_id in storage_block_gen)
+
+        return self._prefetch_blocks_generator(vault_id, storage_block_gen,
+                                               window)
+
+    def _prefetch_blocks_generator(self, vault_id, storage_block_gen,
+                                   window):
+        # The request context is thread local, so hand a copy of
+        # it to the worker threads doing the fetching
+        context_vars = dict(vars(deuce.context))
+
+        def fetch(storage_block_id):
+            for name, value in context_vars.items():
+                setattr(deuce.context, name, value)
+
+            obj = self.get_block_obj(vault_id, storage_block_id)
+            if obj is None:
+                return None
+
+            try:
+                return BytesIO(obj.read())
+            finally:
+                obj.close()
+
+        executor = _get_executor()
+        pending = collections.deque()
+
+        try:
+            for storage_block_id in storage_block_gen:
+                pending.append((storage_block_id,
+                                executor.submit(fetch, storage_block_id)))
+
+                # Keep the current block plus a full window
+                # of upcoming blocks in flight
+                if len(pending) > window:
+                    storage_block_id, future = pending.popleft()
+                    yield (storage_block_id, future.result())
+
+            while pending:
+                storage_block_id, future = pending.popleft()
+                yield (storage_block_id, future.result())
+
+        finally:
+            # The consumer stopped early; drop anything we
+            # have not started fetching on its behalf
+            for storage_block_id, future in pending:
+                future.cancel()
 
     @staticmethod
     def storage_id(metadata_block_id):
@@ -1,5 +1,6 @@
 
 import importlib
+import itertools
 import datetime
 import six
 import ssl
@@ -7,7 +8,8 @@ import uuid
 
 from deuce.drivers.metadatadriver import MetadataStorageDriver
 from deuce.drivers.metadatadriver import GapError, OverlapError
-from deuce.drivers.metadatadriver import ConstraintError
+from deuce.drivers.metadatadriver import ConstraintError, BlockRecord
+from deuce.drivers.metadatadriver import VaultCounters
 from deuce import conf
 
 import deuce
@@ -15,260 +17,337 @@ import deuce
 
 CQL_CREATE_VAULT = '''
     INSERT INTO vaults (projectid, vaultid)
-    VALUES (%(projectid)s, %(vaultid)s)
+    VALUES (:projectid, :vaultid)
+    IF NOT EXISTS
 '''
 
 CQL_DELETE_VAULT = '''
     DELETE FROM vaults
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
 '''
 
 CQL_GET_ALL_VAULTS = '''
     SELECT vaultid
     FROM vaults
-    WHERE projectid = %(projectid)s
-    AND vaultid >= %(vaultid)s
+    WHERE projectid = :projectid
+    AND vaultid >= :vaultid
     ORDER BY vaultid
-    LIMIT %(limit)s
+    LIMIT :limit
 '''
 
 CQL_CREATE_FILE = '''
     INSERT INTO files (projectid, vaultid, fileid, finalized, size)
-    VALUES (%(projectid)s, %(vaultid)s, %(fileid)s, false, %(size)s)
+    VALUES (:projectid, :vaultid, :fileid, false, :size)
 '''
 
 CQL_MARK_BLOCK_AS_BAD = '''
     UPDATE blocks SET
     isinvalid = true
     WHERE
-    projectid = %(projectid)s AND
-    vaultid = %(vaultid)s AND
-    blockid = %(blockid)s
+    projectid = :projectid AND
+    vaultid = :vaultid AND
+    blockid = :blockid
 '''
 
 CQL_GET_FILE = '''
     SELECT finalized
     FROM files
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND fileid = %(fileid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
+'''
+
+CQL_GET_FILE_STATE = '''
+    SELECT finalized, size
+    FROM files
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
 '''
 
 CQL_GET_FILE_SIZE = '''
     SELECT size
     FROM files
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND fileid = %(fileid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
 '''
 
 CQL_DELETE_FILE = '''
     DELETE FROM files
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND fileid = %(fileid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
 '''
 
 CQL_GET_BAD_BLOCKS = '''
     SELECT blockid
     FROM blocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
     AND isinvalid = true
 '''
 
-CQL_GET_FILE_PER_BLOCK = '''
+CQL_GET_FILES_PER_BLOCK = '''
     SELECT fileid
     FROM blockfiles
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid = %(blockid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
+'''
+
+# The files that reference a bad block, kept up to date as blocks
+# are marked bad, replaced, and assigned to or removed from files
+CQL_GET_BAD_FILES = '''
+    SELECT fileid
+    FROM badfiles
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+'''
+
+CQL_ADD_BAD_FILE = '''
+    INSERT INTO badfiles (projectid, vaultid, fileid, blockid)
+    VALUES (:projectid, :vaultid, :fileid, :blockid)
+'''
+
+CQL_DEL_BAD_FILE_BLOCK = '''
+    DELETE FROM badfiles
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
+    AND blockid = :blockid
+'''
+
+CQL_DEL_BAD_FILE = '''
+    DELETE FROM badfiles
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
 '''
 
 CQL_GET_ALL_FILE_BLOCKS = '''
     SELECT blockid, offset
     FROM fileblocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND fileid = %(fileid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
     ORDER BY offset
 '''
 
 CQL_GET_FILE_BLOCKS = '''
     SELECT blockid, offset
     FROM fileblocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND fileid = %(fileid)s
-    AND offset >= %(marker)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
+    AND offset >= :marker
     ORDER BY offset
-    LIMIT %(limit)s
+    LIMIT :limit
+'''
+
+CQL_GET_FILE_BLOCK_OFFSET = '''
+    SELECT offset
+    FROM fileblocks
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
+    AND offset <= :position
+    ORDER BY offset DESC
+    LIMIT 1
 '''
 
 CQL_GET_ALL_FILE_BLOCKS_W_SIZE = '''
     SELECT blockid, offset, blocksize
     FROM fileblocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND fileid = %(fileid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
     ORDER by offset
 '''
 
 CQL_GET_ALL_BLOCKS = '''
     SELECT blockid
     FROM blocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid >= %(marker)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid >= :marker
     ORDER BY blockid
-    LIMIT %(limit)s
+    LIMIT :limit
 '''
 
 CQL_GET_STORAGE_ID = '''
     SELECT storageid
     FROM blocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid =%(blockid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid =:blockid
+'''
+
+CQL_GET_BLOCK_RECORD = '''
+    SELECT storageid, blocksize, isinvalid
+    FROM blocks
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
 '''
 
 CQL_GET_BLOCK_ID = '''
     SELECT blockid
     FROM blocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND storageid =%(storageid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND storageid =:storageid
 '''
 
-CQL_GET_COUNT_ALL_BLOCKS = '''
-    SELECT COUNT(*)
+CQL_GET_ALL_BLOCK_SIZES = '''
+    SELECT blocksize
     FROM blocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
 '''
 
 CQL_GET_ALL_FILES_MARKER = '''
     SELECT fileid
     FROM files
-    WHERE projectid=%(projectid)s
-    AND vaultid = %(vaultid)s
-    AND fileid >= %(marker)s
-    AND finalized = %(finalized)s
-    LIMIT %(limit)s
+    WHERE projectid=:projectid
+    AND vaultid = :vaultid
+    AND fileid >= :marker
+    AND finalized = :finalized
+    LIMIT :limit
 '''
 
 CQL_GET_ALL_FILES = '''
     SELECT fileid
     FROM files
-    WHERE projectid=%(projectid)s
-    AND vaultid = %(vaultid)s
-    AND finalized = %(finalized)s
-    LIMIT %(limit)s
+    WHERE projectid=:projectid
+    AND vaultid = :vaultid
+    AND finalized = :finalized
+    LIMIT :limit
 '''
 
 CQL_GET_COUNT_ALL_FILES = '''
     SELECT COUNT(*)
     FROM files
-    WHERE projectid=%(projectid)s
-    AND vaultid = %(vaultid)s
+    WHERE projectid=:projectid
+    AND vaultid = :vaultid
 '''
 
 CQL_FINALIZE_FILE = '''
     UPDATE files
     SET finalized=true,
-    size=%(size)s
-    WHERE projectid=%(projectid)s
-    AND vaultid=%(vaultid)s
-    AND fileid=%(fileid)s
+    size=:size
+    WHERE projectid=:projectid
+    AND vaultid=:vaultid
+    AND fileid=:fileid
 '''
 
 CQL_ASSIGN_BLOCK_TO_FILE = '''
     INSERT INTO fileblocks
     (projectid, vaultid, fileid, blockid, blocksize, offset)
-    VALUES (%(projectid)s, %(vaultid)s, %(fileid)s, %(blockid)s,
-    %(blocksize)s, %(offset)s)
+    VALUES (:projectid, :vaultid, :fileid, :blockid,
+    :blocksize, :offset)
 '''
 CQL_REGISTER_FILE_TO_BLOCK = '''
     INSERT INTO blockfiles
     (projectid, vaultid, fileid, blockid)
-    VALUES (%(projectid)s, %(vaultid)s, %(fileid)s, %(blockid)s)
+    VALUES (:projectid, :vaultid, :fileid, :blockid)
 '''
 CQL_UNREGISTER_FILE_TO_BLOCK = '''
     DELETE FROM blockfiles
-    WHERE projectid=%(projectid)s
-    AND vaultid=%(vaultid)s
-    AND blockid=%(blockid)s
+    WHERE projectid=:projectid
+    AND vaultid=:vaultid
+    AND blockid=:blockid
+    AND fileid=:fileid
 '''
 CQL_REGISTER_BLOCK = '''
     INSERT INTO blocks
     (projectid, vaultid, blockid, storageid, blocksize, isinvalid, reftime)
-    VALUES (%(projectid)s, %(vaultid)s, %(blockid)s, %(storageid)s,
-    %(blocksize)s, %(isinvalid)s, %(reftime)s)
+    VALUES (:projectid, :vaultid, :blockid, :storageid,
+    :blocksize, :isinvalid, :reftime)
 '''
 
 CQL_UNREGISTER_BLOCK = '''
     DELETE FROM blocks
-    WHERE projectid=%(projectid)s
-    AND vaultid=%(vaultid)s
-    AND blockid=%(blockid)s
+    WHERE projectid=:projectid
+    AND vaultid=:vaultid
+    AND blockid=:blockid
 '''
 
 CQL_GET_BLOCK_SIZE = '''
     SELECT blocksize FROM blocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid = %(blockid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
     AND isinvalid = false
 '''
 
 CQL_GET_BLOCK_REF_COUNT = '''
     SELECT refcount
     FROM blockreferences
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid = %(blockid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
 '''
 
 CQL_UPDATE_REF_TIME = '''
     UPDATE blocks
-    SET reftime = %(reftime)s
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid = %(blockid)s
+    SET reftime = :reftime
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
 '''
 
 CQL_GET_BLOCK_REF_TIME = '''
     SELECT reftime
     FROM blocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid = %(blockid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
 '''
 
 # Note: negative numbers for decrementing works
 # fine here.
 CQL_INC_BLOCK_REF_COUNT = '''
     UPDATE blockreferences
-    SET refcount = refcount + %(delta)s
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid = %(blockid)s
+    SET refcount = refcount + :delta
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
 '''
 
 CQL_DEL_BLOCK_REF_COUNT = '''
     DELETE FROM blockreferences
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid = %(blockid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
+'''
+
+CQL_GET_VAULT_STATS = '''
+    SELECT files, blocks, bytes, badblocks
+    FROM vaultstats
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+'''
+
+# Note: counter columns can only be incremented, so the
+# counters are set by applying the difference.
+CQL_INC_VAULT_STATS = '''
+    UPDATE vaultstats
+    SET files = files + :files,
+    blocks = blocks + :blocks,
+    bytes = bytes + :bytes,
+    badblocks = badblocks + :badblocks
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
 '''
 
 CQL_GET_BLOCK_STATUS = '''
     SELECT isinvalid
     FROM blocks
-    WHERE projectid = %(projectid)s
-    AND vaultid = %(vaultid)s
-    AND blockid = %(blockid)s
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid = :blockid
 '''
 
 CQL_HEALTH_CHECK = '''
@@ -280,6 +359,7 @@ CQL_HEALTH_CHECK = '''
 class CassandraStorageDriver(MetadataStorageDriver):
 
     def __init__(self):
+        super(CassandraStorageDriver, self).__init__()
 
         ssl_options = None
         auth_provider = None
@@ -296,14 +376,16 @@ class CassandraStorageDriver(MetadataStorageDriver):
         auth_module = importlib.import_module(
             '{0}.auth'.format(conf.metadata_driver.cassandra.db_module))
 
-        # Import the query submodule
-        query_module = importlib.import_module(
-            '{0}.query'.format(conf.metadata_driver.cassandra.db_module))
+        # Import the policies submodule
+        policies_module = importlib.import_module(
+            '{0}.policies'.format(conf.metadata_driver.cassandra.db_module))
+
+        # Import the concurrent submodule
+        self._concurrent = importlib.import_module(
+            '{0}.concurrent'.format(conf.metadata_driver.cassandra.db_module))
 
         self.consistency = getattr(self.cassandra,
                                    'ConsistencyLevel')
-        self.simplestatement = getattr(query_module,
-                                       'SimpleStatement')
 
         if conf.metadata_driver.cassandra.ssl_enabled:
             ssl_version = getattr(ssl,
@@ -319,10 +401,16 @@ class CassandraStorageDriver(MetadataStorageDriver):
                 password=conf.metadata_driver.cassandra.password
             )
 
+        # Requests go straight to a replica of the partition they
+        # touch, in the local datacenter
+        load_balancing_policy = policies_module.TokenAwarePolicy(
+            policies_module.DCAwareRoundRobinPolicy())
+
         self._cluster = cluster_module.Cluster(
             contact_points=conf.metadata_driver.cassandra.cluster,
             auth_provider=auth_provider,
-            ssl_options=ssl_options)
+            ssl_options=ssl_options,
+            load_balancing_policy=load_balancing_policy)
 
         # NOTE(TheSriram): We need the total number of nodes in the
         # cluster to be greater than two, if we are going to apply
@@ -337,6 +425,50 @@ class CassandraStorageDriver(MetadataStorageDriver):
         deuce_keyspace = conf.metadata_driver.cassandra.keyspace
         self._session = self._cluster.connect(deuce_keyspace)
 
+        # Every statement is prepared once, up front, so that calls
+        # only send the bound values. Bound statements also carry the
+        # routing key the token aware policy needs. Results are read
+        # in pages of fetch_size rows as they are iterated.
+        self._statements = {}
+
+        for name, cql in globals().items():
+            if name.startswith('CQL_'):
+                statement = self._session.prepare(cql)
+                statement.consistency_level = self.consistency_level
+                statement.fetch_size = conf.metadata_driver.cassandra.\
+                    fetch_size
+                self._statements[cql] = statement
+
+    def _execute_concurrent(self, statements_and_args):
+        """Executes each (statement, args) pair, keeping at most
+        cassandra.concurrency requests in flight. The pairs may be
+        a generator, in which case they are consumed as requests
+        complete.
+
+        :returns: The rows of each statement, in order
+        :raises: The first error any of the statements raised"""
+        results = self._concurrent.execute_concurrent(
+            self._session, statements_and_args,
+            concurrency=conf.metadata_driver.cassandra.concurrency,
+            raise_on_first_error=True)
+
+        return [rows for success, rows in results]
+
+    @staticmethod
+    def _pages(rows):
+        """Splits the rows into lists of at most fetch_size rows,
+        so that a large result is never held in memory as a whole"""
+        rows = iter(rows)
+        size = conf.metadata_driver.cassandra.fetch_size
+
+        while True:
+            page = list(itertools.islice(rows, size))
+
+            if not page:
+                return
+
+            yield page
+
     def create_vault(self, vault_id):
         """Creates a vault"""
         args = dict(
@@ -344,9 +476,14 @@ class CassandraStorageDriver(MetadataStorageDriver):
             vaultid=vault_id
         )
 
-        query = self.simplestatement(CQL_CREATE_VAULT,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_CREATE_VAULT]
         res = self._session.execute(query, args)
+
+        # Only a new vault starts its counters at zero; one that
+        # already exists keeps its own, or has them counted when
+        # they are first asked for
+        if res[0][0]:
+            self._inc_vault_counters(vault_id)
         return
 
     def delete_vault(self, vault_id):
@@ -354,9 +491,12 @@ class CassandraStorageDriver(MetadataStorageDriver):
             projectid=deuce.context.project_id,
             vaultid=vault_id
         )
-        query = self.simplestatement(CQL_DELETE_VAULT,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_DELETE_VAULT]
         res = self._session.execute(query, args)
+
+        # A counter row cannot be reliably deleted and then counted
+        # up again, so the counters are zeroed instead
+        self._set_vault_counters(vault_id, VaultCounters())
         return
 
     def create_vaults_generator(self, marker=None, limit=None):
@@ -365,55 +505,67 @@ class CassandraStorageDriver(MetadataStorageDriver):
             vaultid=marker or '',
             limit=self._determine_limit(limit)
         )
-        query = self.simplestatement(CQL_GET_ALL_VAULTS,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_ALL_VAULTS]
         res = self._session.execute(query, args)
         return [row[0] for row in res]
 
-    def get_vault_statistics(self, vault_id):
-        """Return the statistics on the vault.
+    def _inc_vault_counters(self, vault_id, files=0, blocks=0, bytes=0,
+                            badblocks=0):
+        """Adds the deltas to the counters of the vault"""
+        args = dict(
+            projectid=deuce.context.project_id,
+            vaultid=vault_id,
+            files=files,
+            blocks=blocks,
+            bytes=bytes,
+            badblocks=badblocks
+        )
 
-        "param vault_id: The ID of the vault to gather statistics for"""
-        res = {}
+        query = self._statements[CQL_INC_VAULT_STATS]
+        self._session.execute(query, args)
 
+    def _get_vault_counters(self, vault_id):
         args = dict(
             projectid=deuce.context.project_id,
             vaultid=vault_id
         )
 
-        def __stats_query(cql_statement, default_value):
-            query = self.simplestatement(cql_statement,
-                consistency_level=self.consistency_level)
-            result = self._session.execute(query, args)
+        query = self._statements[CQL_GET_VAULT_STATS]
+        res = self._session.execute(query, args)
 
-            try:
-                return result[0][0]
+        try:
+            return VaultCounters(*[value or 0 for value in res[0]])
+        except IndexError:
+            return None
 
-            except IndexError:  # pragma: no cover
-                return default_value
+    def _set_vault_counters(self, vault_id, counters):
+        current = self._get_vault_counters(vault_id) or VaultCounters()
 
-        def __stats_get_vault_file_count():
-            return __stats_query(CQL_GET_COUNT_ALL_FILES, 0)
+        self._inc_vault_counters(
+            vault_id,
+            files=counters.files - current.files,
+            blocks=counters.blocks - current.blocks,
+            bytes=counters.bytes - current.bytes,
+            badblocks=counters.badblocks - current.badblocks)
 
-        def __stats_get_vault_block_count():
-            return __stats_query(CQL_GET_COUNT_ALL_BLOCKS, 0)
+    def _count_vault_statistics(self, vault_id):
+        args = dict(
+            projectid=deuce.context.project_id,
+            vaultid=vault_id
+        )
 
-        # Add any statistics regarding files
-        res['files'] = {}
-        res['files']['count'] = __stats_get_vault_file_count()
+        query = self._statements[CQL_GET_COUNT_ALL_FILES]
+        res = self._session.execute(query, args)
 
-        # Add any statistics regarding blocks
-        res['blocks'] = {}
-        res['blocks']['count'] = __stats_get_vault_block_count()
+        counters = VaultCounters(files=res[0][0])
 
-        # Add information about bad blocks and bad files
+        query = self._statements[CQL_GET_ALL_BLOCK_SIZES]
 
-        res['blocks']['bad'], res['files']['bad'] = \
-            self.vault_health(vault_id)
-        # Add any statistics specific to the Cassandra backend
-        res['internal'] = {}
+        for row in self._session.execute(query, args):
+            counters.blocks += 1
+            counters.bytes += row[0] or 0
 
-        return res
+        return counters
 
     def vault_health(self, vault_id):
         '''Returns the number of bad blocks and bad files associated
@@ -424,31 +576,71 @@ class CassandraStorageDriver(MetadataStorageDriver):
             vaultid=vault_id,
         )
 
-        bad_blocks = self._session.execute(CQL_GET_BAD_BLOCKS, args)
+        bad_blocks = self._session.execute(
+            self._statements[CQL_GET_BAD_BLOCKS], args)
 
         no_of_bad_blocks = len(bad_blocks)
 
-        bad_files = set()
-        results = []
+        if no_of_bad_blocks == 0:
+            return (0, 0)
+
+        query = self._statements[CQL_GET_BAD_FILES]
+        bad_files = set(row[0] for row in self._session.execute(query, args))
 
-        for block_id in bad_blocks:
+        no_of_bad_files = len(bad_files)
+
+        return (no_of_bad_blocks, no_of_bad_files)
+
+    def _bad_file_statements(self, vault_id, file_ids, block_ids):
+        """Yields the statements recording that each file
+        references the bad block alongside it"""
+        query = self._statements[CQL_ADD_BAD_FILE]
+
+        for file_id, block_id in zip(file_ids, block_ids):
             args = dict(
                 projectid=deuce.context.project_id,
                 vaultid=vault_id,
-                blockid=block_id[0],
+                fileid=uuid.UUID(str(file_id)),
+                blockid=block_id
             )
-            future = self._session.execute_async(CQL_GET_FILE_PER_BLOCK, args)
-            results.append(future)
 
-        for future in results:
-            try:
-                bad_files.add(future.result()[0][0])
-            except IndexError:
-                pass
+            yield (query, args)
 
-        no_of_bad_files = len(bad_files)
+    def _add_bad_files(self, vault_id, file_ids, block_ids):
+        """Records that each file references the bad block
+        alongside it"""
+        self._execute_concurrent(
+            self._bad_file_statements(vault_id, file_ids, block_ids))
 
-        return (no_of_bad_blocks, no_of_bad_files)
+    def _update_bad_files(self, vault_id, block_ids, isinvalid):
+        """Adds (or, for blocks that are valid again, removes) the
+        files referencing each of the blocks to the bad files"""
+        query = self._statements[CQL_GET_FILES_PER_BLOCK]
+
+        results = self._execute_concurrent(
+            (query, dict(projectid=deuce.context.project_id,
+                         vaultid=vault_id,
+                         blockid=block_id))
+            for block_id in block_ids)
+
+        file_block_ids = [(row[0], block_id)
+                          for block_id, rows in zip(block_ids, results)
+                          for row in rows]
+
+        if isinvalid:
+            self._add_bad_files(vault_id,
+                                [file_id for file_id, _ in file_block_ids],
+                                [block_id for _, block_id in file_block_ids])
+            return
+
+        query = self._statements[CQL_DEL_BAD_FILE_BLOCK]
+
+        self._execute_concurrent(
+            (query, dict(projectid=deuce.context.project_id,
+                         vaultid=vault_id,
+                         fileid=uuid.UUID(str(file_id)),
+                         blockid=block_id))
+            for file_id, block_id in file_block_ids)
 
     def create_file(self, vault_id, file_id):
         """Creates a new file with no blocks and no files"""
@@ -460,10 +652,11 @@ class CassandraStorageDriver(MetadataStorageDriver):
             size=0
         )
 
-        query = self.simplestatement(CQL_CREATE_FILE,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_CREATE_FILE]
         res = self._session.execute(query, args)
 
+        self._inc_vault_counters(vault_id, files=1)
+
         return file_id
 
     def file_length(self, vault_id, file_id):
@@ -474,8 +667,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             fileid=uuid.UUID(file_id)
         )
 
-        query = self.simplestatement(CQL_GET_FILE_SIZE,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_FILE_SIZE]
         res = self._session.execute(query, args)
 
         try:
@@ -485,19 +677,27 @@ class CassandraStorageDriver(MetadataStorageDriver):
 
     def get_block_storage_id(self, vault_id, block_id):
         """Retrieve storage id for a given block id"""
-        args = dict(
-            projectid=deuce.context.project_id,
-            vaultid=vault_id,
-            blockid=block_id
-        )
+        record = self._get_block_record(vault_id, block_id)
+        return record.storage_id if record else None
 
-        query = self.simplestatement(CQL_GET_STORAGE_ID,
-            consistency_level=self.consistency_level)
-        res = self._session.execute(query, args)
-        try:
-            return str(res[0][0])
-        except IndexError:
-            return None
+    def get_block_storage_ids(self, vault_id, block_ids):
+        """Retrieve storage ids for the given block ids"""
+
+        def get_result(res):
+            try:
+                return str(res[0][0])
+            except IndexError:
+                return None
+
+        query = self._statements[CQL_GET_STORAGE_ID]
+
+        results = self._execute_concurrent(
+            (query, dict(projectid=deuce.context.project_id,
+                         vaultid=vault_id,
+                         blockid=block_id))
+            for block_id in block_ids)
+
+        return [get_result(res) for res in results]
 
     def get_block_metadata_id(self, vault_id, storage_id):
         """Retrieve block id for a given storage id"""
@@ -507,8 +707,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             storageid=storage_id
         )
 
-        query = self.simplestatement(CQL_GET_BLOCK_ID,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_BLOCK_ID]
         res = self._session.execute(query, args)
         try:
             return str(res[0][0])
@@ -522,8 +721,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             fileid=uuid.UUID(file_id)
         )
 
-        query = self.simplestatement(CQL_GET_FILE,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_FILE]
         res = self._session.execute(query, args)
 
         return len(res) > 0
@@ -536,8 +734,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             fileid=uuid.UUID(file_id)
         )
 
-        query = self.simplestatement(CQL_GET_FILE,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_FILE]
         res = self._session.execute(query, args)
 
         try:
@@ -546,25 +743,16 @@ class CassandraStorageDriver(MetadataStorageDriver):
         except IndexError:
             return False
 
-    def _delete_files_from_blockfiles(self, vault_id, blockids):
-        futures = []
+    def _delete_files_from_blockfiles(self, vault_id, file_id, blockids):
 
-        query = self.simplestatement(CQL_UNREGISTER_FILE_TO_BLOCK,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_UNREGISTER_FILE_TO_BLOCK]
 
-        for blockid in blockids:
-            args = dict(
-                projectid=deuce.context.project_id,
-                vaultid=vault_id,
-                blockid=blockid
-            )
-
-            future = self._session.execute_async(query,
-                                                 args)
-            futures.append(future)
-
-        for future in futures:
-            future.result()
+        self._execute_concurrent(
+            (query, dict(projectid=deuce.context.project_id,
+                         vaultid=vault_id,
+                         fileid=uuid.UUID(file_id),
+                         blockid=blockid))
+            for blockid in set(blockids))
 
     def delete_file(self, vault_id, file_id):
 
@@ -574,22 +762,32 @@ class CassandraStorageDriver(MetadataStorageDriver):
             fileid=uuid.UUID(file_id)
         )
 
-        query = self.simplestatement(CQL_DELETE_FILE,
-            consistency_level=self.consistency_level)
+        # Deletes do not report whether there was anything to
+        # delete, so look first to keep the file count right
+        query = self._statements[CQL_GET_FILE]
+        existed = len(self._session.execute(query, args)) > 0
+
+        query = self._statements[CQL_DELETE_FILE]
         self._session.execute(query, args)
 
+        if existed:
+            self._inc_vault_counters(vault_id, files=-1)
+
         # now list the file blocks, delete the mapping from blocks to
         # files and decrement the block reference count
 
-        query = self.simplestatement(CQL_GET_ALL_FILE_BLOCKS_W_SIZE,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_ALL_FILE_BLOCKS_W_SIZE]
         res = self._session.execute(query, args)
 
-        block_ids = [data[0] for data in res]
-        self._delete_files_from_blockfiles(vault_id,
-                                           block_ids)
+        for page in self._pages(res):
+            block_ids = [data[0] for data in page]
+            self._delete_files_from_blockfiles(vault_id, file_id,
+                                               block_ids)
+
+            self._inc_block_ref_counts(vault_id, block_ids, -1)
 
-        self._inc_block_ref_counts(vault_id, block_ids, -1)
+        query = self._statements[CQL_DEL_BAD_FILE]
+        self._session.execute(query, args)
 
     def finalize_file(self, vault_id, file_id, file_size=None):
         """Updates the files table to set a file to finalized. This function
@@ -605,32 +803,39 @@ class CassandraStorageDriver(MetadataStorageDriver):
             fileid=uuid.UUID(file_id)
         )
 
-        query = self.simplestatement(CQL_GET_ALL_FILE_BLOCKS_W_SIZE,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_ALL_FILE_BLOCKS_W_SIZE]
         res = self._session.execute(query, args)
 
-        for blockid, offset, size in res:
+        for page in self._pages(res):
 
-            # Use one last chance to check for the block size
-            # if it is not in the fileblocks row.
-            if size is None:
-                size = self._get_block_size(vault_id, blockid)
+            # Use one last chance to check for the sizes of the blocks
+            # that are not in their fileblocks rows, a page at a time
+            unsized = list(set(blockid for blockid, offset, size in page
+                               if size is None))
+            sizes = dict(zip(unsized,
+                             self._get_block_sizes(vault_id, unsized)))
 
-                # If size is None, the block was never registered so we
-                # skip this record. This will likely result in a GapError
-                # being thrown on the next pass
-                if size is None:
-                    continue
+            for blockid, offset, size in page:
 
-            if offset == expected_offset:
-                expected_offset += size
-            elif offset < expected_offset:  # Block overlaps previous block
-                raise OverlapError(deuce.context.project_id, vault_id,
-                                   file_id, blockid, startpos=offset,
-                                   endpos=expected_offset)
-            else:  # There is a gap between this block and the previous one
-                raise GapError(deuce.context.project_id, vault_id, file_id,
-                               startpos=expected_offset, endpos=offset)
+                if size is None:
+                    size = sizes[blockid]
+
+                    # If size is None, the block was never registered so
+                    # we skip this record. This will likely result in a
+                    # GapError being thrown on the next pass
+                    if size is None:
+                        continue
+
+                if offset == expected_offset:
+                    expected_offset += size
+                elif offset < expected_offset:  # Overlaps previous block
+                    raise OverlapError(deuce.context.project_id, vault_id,
+                                       file_id, blockid, startpos=offset,
+                                       endpos=expected_offset)
+                else:  # There is a gap between this block and the last one
+                    raise GapError(deuce.context.project_id, vault_id,
+                                   file_id, startpos=expected_offset,
+                                   endpos=offset)
 
         # Now we must check the very last block and ensure
         # that is completes the file. This is only doable if
@@ -661,27 +866,17 @@ class CassandraStorageDriver(MetadataStorageDriver):
                 fileid=uuid.UUID(file_id)
             )
 
-            query = self.simplestatement(CQL_FINALIZE_FILE,
-                consistency_level=self.consistency_level)
+            query = self._statements[CQL_FINALIZE_FILE]
             res = self._session.execute(query, args)
 
     def get_block_data(self, vault_id, block_id):
+        record = self._get_block_record(vault_id, block_id)
 
-        args = dict(
-            projectid=deuce.context.project_id,
-            vaultid=vault_id,
-            blockid=block_id
-        )
-
-        query = self.simplestatement(CQL_GET_BLOCK_SIZE,
-            consistency_level=self.consistency_level)
-        res = self._session.execute(query, args)
-
-        try:
-            return dict(blocksize=res[0][0])
-        except IndexError:
+        if record is None or record.isinvalid:
             raise Exception("No such block: {0}".format(block_id))
 
+        return dict(blocksize=record.size)
+
     def _get_block_size(self, vault_id, block_id):
         """Returns the size of the specified block. If the block
         is not found, None is returned"""
@@ -692,8 +887,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             blockid=block_id
         )
 
-        query = self.simplestatement(CQL_GET_BLOCK_SIZE,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_BLOCK_SIZE]
         res = self._session.execute(query, args)
 
         try:
@@ -705,27 +899,21 @@ class CassandraStorageDriver(MetadataStorageDriver):
         """Returns the size of the specified block. If the block
         is not found, None is returned"""
 
-        def get_result(future):
+        def get_result(res):
             try:
-                return future[0][0]
+                return res[0][0]
             except IndexError:
                 return None
 
-        futures = []
-
-        query = self.simplestatement(CQL_GET_BLOCK_SIZE,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_BLOCK_SIZE]
 
-        for block_id in block_ids:
-            args = dict(
-                projectid=deuce.context.project_id,
-                vaultid=vault_id,
-                blockid=block_id
-            )
+        results = self._execute_concurrent(
+            (query, dict(projectid=deuce.context.project_id,
+                         vaultid=vault_id,
+                         blockid=block_id))
+            for block_id in block_ids)
 
-            future = self._session.execute_async(query, args)
-            futures.append(future)
-        return [get_result(future.result()) for future in futures]
+        return [get_result(res) for res in results]
 
     def get_file_data(self, vault_id, file_id):
         """Returns a tuple representing data for this file"""
@@ -735,8 +923,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             fileid=uuid.UUID(file_id)
         )
 
-        query = self.simplestatement(CQL_GET_FILE,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_FILE]
         res = self._session.execute(query, args)
 
         try:
@@ -754,10 +941,17 @@ class CassandraStorageDriver(MetadataStorageDriver):
             blockid=block_id
         )
 
-        query = self.simplestatement(CQL_MARK_BLOCK_AS_BAD,
-            consistency_level=self.consistency_level)
+        record = self._load_block_record(vault_id, block_id)
+
+        query = self._statements[CQL_MARK_BLOCK_AS_BAD]
         res = self._session.execute(query, args)
 
+        self._invalidate_block(vault_id, block_id)
+
+        if record is not None and not record.isinvalid:
+            self._inc_vault_counters(vault_id, badblocks=1)
+            self._update_bad_files(vault_id, [block_id], True)
+
     @staticmethod
     def _block_exists(result, check_status):
         """Helper function to check the result of a cassandra
@@ -775,8 +969,16 @@ class CassandraStorageDriver(MetadataStorageDriver):
 
         return True
 
-    def has_block(self, vault_id, block_id, check_status=False):
-        retval = False
+    @staticmethod
+    def _block_record(result):
+        try:
+            storage_id, size, isinvalid = result[0]
+        except IndexError:
+            return None
+
+        return BlockRecord(str(storage_id), size, bool(isinvalid))
+
+    def _load_block_record(self, vault_id, block_id):
 
         args = dict(
             projectid=deuce.context.project_id,
@@ -784,33 +986,51 @@ class CassandraStorageDriver(MetadataStorageDriver):
             blockid=block_id
         )
 
-        query = self.simplestatement(CQL_GET_BLOCK_STATUS,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_BLOCK_RECORD]
         res = self._session.execute(query, args)
 
-        return CassandraStorageDriver._block_exists(res, check_status)
+        return CassandraStorageDriver._block_record(res)
 
-    def has_blocks(self, vault_id, block_ids, check_status=False):
+    def _load_block_records(self, vault_id, block_ids):
+        """Reads the BlockRecords of the specified blocks
+        concurrently. Returns a dictionary of block id to
+        BlockRecord, or None for blocks that do not exist"""
+        block_ids = list(block_ids)
+        query = self._statements[CQL_GET_BLOCK_RECORD]
 
-        futures = []
-        query = self.simplestatement(CQL_GET_BLOCK_STATUS,
-            consistency_level=self.consistency_level)
+        results = self._execute_concurrent(
+            (query, dict(projectid=deuce.context.project_id,
+                         vaultid=vault_id,
+                         blockid=block_id))
+            for block_id in block_ids)
 
-        for block_id in block_ids:
-            args = dict(
-                projectid=deuce.context.project_id,
-                vaultid=vault_id,
-                blockid=block_id
-            )
+        return dict((block_id, CassandraStorageDriver._block_record(res))
+                    for block_id, res in zip(block_ids, results))
+
+    def has_block(self, vault_id, block_id, check_status=False):
+        record = self._get_block_record(vault_id, block_id)
 
-            future = self._session.execute_async(query, args)
-            futures.append((future, block_id))
+        if record is None:
+            return False
+
+        return not (check_status and record.isinvalid)
+
+    def has_blocks(self, vault_id, block_ids, check_status=False):
+
+        block_ids = list(block_ids)
+        query = self._statements[CQL_GET_BLOCK_STATUS]
+
+        results = self._execute_concurrent(
+            (query, dict(projectid=deuce.context.project_id,
+                         vaultid=vault_id,
+                         blockid=block_id))
+            for block_id in block_ids)
 
         exists = lambda res: CassandraStorageDriver._block_exists(
             res, check_status)
 
-        return [block_id for future, block_id in futures
-                if not exists(future.result())]
+        return [block_id for block_id, res in zip(block_ids, results)
+                if not exists(res)]
 
     def create_block_generator(self, vault_id, marker=None,
                                limit=None):
@@ -822,11 +1042,12 @@ class CassandraStorageDriver(MetadataStorageDriver):
             limit=self._determine_limit(limit)
         )
 
-        query = self.simplestatement(CQL_GET_ALL_BLOCKS,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_ALL_BLOCKS]
         res = self._session.execute(query, args)
 
-        return [row[0] for row in res]
+        # Rows are yielded as the driver pages them in
+        for row in res:
+            yield row[0]
 
     def create_file_generator(self, vault_id, marker=None, limit=None,
                               finalized=True):
@@ -840,19 +1061,18 @@ class CassandraStorageDriver(MetadataStorageDriver):
 
         if marker is None:
             # query = CQL_GET_ALL_FILES
-            query = self.simplestatement(CQL_GET_ALL_FILES,
-                consistency_level=self.consistency_level)
+            query = self._statements[CQL_GET_ALL_FILES]
         else:
             args.update(dict(
                 marker=uuid.UUID(marker)
             ))
-            query = self.simplestatement(CQL_GET_ALL_FILES_MARKER,
-                consistency_level=self.consistency_level)
+            query = self._statements[CQL_GET_ALL_FILES_MARKER]
             # query = CQL_GET_ALL_FILES_MARKER
 
         res = self._session.execute(query, args)
 
-        return [str(row[0]) for row in res]
+        for row in res:
+            yield str(row[0])
 
     def create_file_block_generator(self, vault_id, file_id,
                                     offset=None, limit=None):
@@ -865,8 +1085,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
 
         if limit is None:
             # query = CQL_GET_ALL_FILE_BLOCKS
-            query = self.simplestatement(CQL_GET_ALL_FILE_BLOCKS,
-                consistency_level=self.consistency_level)
+            query = self._statements[CQL_GET_ALL_FILE_BLOCKS]
         else:
 
             args.update(dict(
@@ -875,59 +1094,116 @@ class CassandraStorageDriver(MetadataStorageDriver):
             ))
 
             # query = CQL_GET_FILE_BLOCKS
-            query = self.simplestatement(CQL_GET_FILE_BLOCKS,
-                consistency_level=self.consistency_level)
+            query = self._statements[CQL_GET_FILE_BLOCKS]
 
         query_res = self._session.execute(query, args)
 
-        return [(row[0], row[1]) for row in query_res]
+        for row in query_res:
+            yield (row[0], row[1])
+
+    def get_file_manifest(self, vault_id, file_id):
+
+        args = dict(
+            projectid=deuce.context.project_id,
+            vaultid=vault_id,
+            fileid=uuid.UUID(file_id)
+        )
+
+        file_query = self._statements[CQL_GET_FILE_STATE]
+
+        blocks_query = self._statements[CQL_GET_ALL_FILE_BLOCKS_W_SIZE]
+
+        # Block sizes are denormalized into fileblocks, so the file's
+        # partition holds everything but the storage ids
+        file_future = self._session.execute_async(file_query, args)
+        blocks_future = self._session.execute_async(blocks_query, args)
+
+        try:
+            finalized, length = file_future.result()[0]
+        except IndexError:
+            return None
+
+        rows = list(blocks_future.result())
+
+        storage_ids = self.get_block_storage_ids(
+            vault_id, [row[0] for row in rows])
+
+        blocks = [(row[0], row[1], row[2], storage_id)
+                  for row, storage_id in zip(rows, storage_ids)]
+
+        return (bool(finalized), int(length or 0), blocks)
+
+    def get_file_block_offset(self, vault_id, file_id, position):
+
+        args = dict(
+            projectid=deuce.context.project_id,
+            vaultid=vault_id,
+            fileid=uuid.UUID(file_id),
+            position=position
+        )
+
+        # offset is the clustering column of fileblocks, so this
+        # is a seek within the file's partition
+        query = self._statements[CQL_GET_FILE_BLOCK_OFFSET]
+
+        res = self._session.execute(query, args)
+
+        try:
+            return res[0][0]
+        except IndexError:
+            return None
 
     def assign_blocks(self, vault_id, file_id, block_ids, offsets):
 
-        blocksizes = self._get_block_sizes(vault_id, block_ids)
+        # The blocks are read once, up front. Everything after that
+        # is independent, so the fileblocks and blockfiles rows, the
+        # bad files, the reference counts and the ref-times are all
+        # written in a single pipeline.
+        records = self._load_block_records(vault_id, set(block_ids))
 
-        # Note: blocksize can be None if the block does not yet exist. This
-        # will probably not be allowed in the future, but for now we allow
-        # this to be compatible with the other drivers.
-        futures = []
+        file_to_block_query = self._statements[CQL_REGISTER_FILE_TO_BLOCK]
 
-        file_to_block_query = self.simplestatement(CQL_REGISTER_FILE_TO_BLOCK,
-            consistency_level=self.consistency_level)
+        block_to_file_query = self._statements[CQL_ASSIGN_BLOCK_TO_FILE]
 
-        block_to_file_query = self.simplestatement(CQL_ASSIGN_BLOCK_TO_FILE,
-            consistency_level=self.consistency_level)
+        def statements():
+            for block_id, offset in zip(block_ids, offsets):
+                record = records[block_id]
 
-        for block_id, blocksize, offset in zip(block_ids, blocksizes,
-                                               offsets):
-            args = dict(
-                projectid=deuce.context.project_id,
-                vaultid=vault_id,
-                fileid=uuid.UUID(file_id),
-                blockid=block_id,
-                blocksize=blocksize,
-                offset=offset
-            )
+                # Note: blocksize can be None if the block does not yet
+                # exist. This will probably not be allowed in the future,
+                # but for now we allow this to be compatible with the
+                # other drivers.
+                args = dict(
+                    projectid=deuce.context.project_id,
+                    vaultid=vault_id,
+                    fileid=uuid.UUID(file_id),
+                    blockid=block_id,
+                    blocksize=record.size if record is not None
+                    and not record.isinvalid else None,
+                    offset=offset
+                )
+
+                yield (block_to_file_query, args)
 
-            fileblocks_future = self._session.execute_async(
-                block_to_file_query,
-                args)
-            futures.append(fileblocks_future)
+                blockfile_args = args.copy()
 
-            blockfile_args = args.copy()
+                del blockfile_args['offset']
+                del blockfile_args['blocksize']
 
-            del blockfile_args['offset']
-            del blockfile_args['blocksize']
+                yield (file_to_block_query, blockfile_args)
 
-            blockfiles_future = self._session.execute_async(
-                file_to_block_query,
-                blockfile_args)
+            bad_block_ids = [block_id for block_id, record in records.items()
+                             if record is not None and record.isinvalid]
 
-            futures.append(blockfiles_future)
+            for statement in self._bad_file_statements(
+                    vault_id, [file_id] * len(bad_block_ids), bad_block_ids):
+                yield statement
 
-        for future in futures:
-            future.result()
+            for statement in self._block_ref_statements(vault_id, block_ids,
+                                                        1, records):
+                yield statement
 
-        self._inc_block_ref_counts(vault_id, block_ids)
+        self._execute_concurrent(statements())
 
     def assign_block(self, vault_id, file_id, block_id, offset):
 
@@ -945,10 +1221,8 @@ class CassandraStorageDriver(MetadataStorageDriver):
             offset=offset
         )
 
-        block_to_file_query = self.simplestatement(CQL_ASSIGN_BLOCK_TO_FILE,
-            consistency_level=self.consistency_level)
-        file_to_block_query = self.simplestatement(CQL_REGISTER_FILE_TO_BLOCK,
-            consistency_level=self.consistency_level)
+        block_to_file_query = self._statements[CQL_ASSIGN_BLOCK_TO_FILE]
+        file_to_block_query = self._statements[CQL_REGISTER_FILE_TO_BLOCK]
 
         blockfile_args = args.copy()
 
@@ -958,10 +1232,23 @@ class CassandraStorageDriver(MetadataStorageDriver):
         self._session.execute(block_to_file_query, args)
         self._session.execute(file_to_block_query, blockfile_args)
 
+        if blocksize is None:
+            # The file references a bad block, if it is one
+            record = self._load_block_record(vault_id, block_id)
+
+            if record is not None and record.isinvalid:
+                self._add_bad_files(vault_id, [file_id], [block_id])
+
         self._inc_block_ref_count(vault_id, block_id)
 
     def register_block(self, vault_id, block_id, storage_id, blocksize):
-        if not self.has_block(vault_id, block_id, check_status=True):
+        # Read the block afresh rather than from the block cache; a
+        # cached record may be stale if another worker unregistered
+        # the block or marked it as bad
+        record = self._load_block_record(vault_id, block_id)
+
+        if record is None or record.isinvalid:
+            # A block previously marked as bad is replaced in place
             args = dict(
                 projectid=deuce.context.project_id,
                 vaultid=vault_id,
@@ -972,10 +1259,78 @@ class CassandraStorageDriver(MetadataStorageDriver):
                 blocksize=int(blocksize)
             )
 
-            query = self.simplestatement(CQL_REGISTER_BLOCK,
-                consistency_level=self.consistency_level)
+            query = self._statements[CQL_REGISTER_BLOCK]
             res = self._session.execute(query, args)
 
+            self._invalidate_block(vault_id, block_id)
+
+            if record is None:
+                self._inc_vault_counters(vault_id, blocks=1,
+                                         bytes=int(blocksize))
+            else:
+                self._inc_vault_counters(
+                    vault_id, badblocks=-int(record.isinvalid),
+                    bytes=int(blocksize) - (record.size or 0))
+                self._update_bad_files(vault_id, [block_id], False)
+
+    def register_blocks(self, vault_id, blocks):
+        records = self._load_block_records(vault_id,
+                                           [block[0] for block in blocks])
+
+        # Blocks previously marked as bad are replaced in place
+        missing = set(block_id for block_id, record in records.items()
+                      if record is None or record.isinvalid)
+
+        query = self._statements[CQL_REGISTER_BLOCK]
+        reftime = int(datetime.datetime.utcnow().timestamp())
+        statements = []
+        registered = []
+        deltas = dict(blocks=0, bytes=0, badblocks=0)
+
+        # The blocks are spread across partitions, so they are
+        # written concurrently rather than in a single batch
+        for block_id, storage_id, blocksize in blocks:
+            if block_id not in missing:
+                continue
+
+            args = dict(
+                projectid=deuce.context.project_id,
+                vaultid=vault_id,
+                blockid=block_id,
+                storageid=storage_id,
+                reftime=reftime,
+                isinvalid=False,
+                blocksize=int(blocksize)
+            )
+
+            statements.append((query, args))
+
+            record = records[block_id]
+
+            if record is None:
+                deltas['blocks'] += 1
+                deltas['bytes'] += int(blocksize)
+            else:
+                deltas['badblocks'] -= 1
+                deltas['bytes'] += int(blocksize) - (record.size or 0)
+
+            # A block listed twice is only registered, and counted, once
+            missing.discard(block_id)
+            registered.append(block_id)
+
+        self._execute_concurrent(statements)
+
+        for block_id in registered:
+            self._invalidate_block(vault_id, block_id)
+
+        if any(deltas.values()):
+            self._inc_vault_counters(vault_id, **deltas)
+
+        self._update_bad_files(vault_id,
+                               [block_id for block_id in registered
+                                if records[block_id] is not None],
+                               False)
+
     def unregister_block(self, vault_id, block_id):
 
         self._require_no_block_refs(vault_id, block_id)
@@ -986,10 +1341,18 @@ class CassandraStorageDriver(MetadataStorageDriver):
             blockid=block_id
         )
 
-        query = self.simplestatement(CQL_UNREGISTER_BLOCK,
-            consistency_level=self.consistency_level)
+        record = self._load_block_record(vault_id, block_id)
+
+        query = self._statements[CQL_UNREGISTER_BLOCK]
         res = self._session.execute(query, args)
 
+        self._invalidate_block(vault_id, block_id)
+
+        if record is not None:
+            self._inc_vault_counters(vault_id, blocks=-1,
+                                     bytes=-(record.size or 0),
+                                     badblocks=-int(record.isinvalid))
+
         self._del_block_ref_count(vault_id, block_id)
 
     def get_block_ref_count(self, vault_id, block_id):
@@ -1000,8 +1363,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             blockid=block_id
         )
 
-        query = self.simplestatement(CQL_GET_BLOCK_REF_COUNT,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_BLOCK_REF_COUNT]
         res = self._session.execute(query, args)
 
         try:
@@ -1009,11 +1371,11 @@ class CassandraStorageDriver(MetadataStorageDriver):
         except IndexError:
             return 0
 
-    def _inc_block_ref_counts(self, vault_id, block_ids, cnt=1):
-
-        futures = []
-        inc_ref_count_query = self.simplestatement(CQL_INC_BLOCK_REF_COUNT,
-            consistency_level=self.consistency_level)
+    def _block_ref_statements(self, vault_id, block_ids, cnt, records):
+        """Yields the statements adding cnt to the reference count
+        of each block, and refreshing the ref-time of the blocks that
+        are registered and valid according to records"""
+        inc_ref_count_query = self._statements[CQL_INC_BLOCK_REF_COUNT]
 
         for block_id in block_ids:
             args = dict(
@@ -1023,11 +1385,8 @@ class CassandraStorageDriver(MetadataStorageDriver):
                 delta=cnt
             )
 
-            future = self._session.execute_async(inc_ref_count_query, args)
-            futures.append(future)
+            yield (inc_ref_count_query, args)
 
-        for future in futures:
-            future.result()
         # The Ref-time value is stored in the blocks table
         # if the block doesn't exist then the ref-time insertion
         # will cause it to exist and then the register_block() will
@@ -1036,27 +1395,30 @@ class CassandraStorageDriver(MetadataStorageDriver):
         #
         # Note: the block registration will automatically insert the
         # ref-time as well.
+        update_reftime_query = self._statements[CQL_UPDATE_REF_TIME]
+        reftime = int(datetime.datetime.utcnow().timestamp())
+
+        for block_id in set(block_ids):
+            record = records.get(block_id)
 
-        missing_block_ids = self.has_blocks(vault_id, block_ids,
-                                            check_status=True)
-        update_block_ids = set(block_ids) - set(missing_block_ids)
-        futures = []
-        update_reftime_query = self.simplestatement(CQL_UPDATE_REF_TIME,
-            consistency_level=self.consistency_level)
-        for block_id in update_block_ids:
+            if record is None or record.isinvalid:
+                continue
 
             reftime_args = dict(
                 projectid=deuce.context.project_id,
                 vaultid=vault_id,
                 blockid=block_id,
-                reftime=int(datetime.datetime.utcnow().timestamp())
+                reftime=reftime
             )
-            future = self._session.execute_async(update_reftime_query,
-                                                 reftime_args)
-            futures.append(future)
 
-        for future in futures:
-            future.result()
+            yield (update_reftime_query, reftime_args)
+
+    def _inc_block_ref_counts(self, vault_id, block_ids, cnt=1):
+
+        records = self._load_block_records(vault_id, set(block_ids))
+
+        self._execute_concurrent(
+            self._block_ref_statements(vault_id, block_ids, cnt, records))
 
     def _inc_block_ref_count(self, vault_id, block_id, cnt=1):
 
@@ -1067,8 +1429,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             delta=cnt
         )
 
-        query = self.simplestatement(CQL_INC_BLOCK_REF_COUNT,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_INC_BLOCK_REF_COUNT]
         res = self._session.execute(query, args)
 
         # The Ref-time value is stored in the blocks table
@@ -1079,15 +1440,16 @@ class CassandraStorageDriver(MetadataStorageDriver):
         #
         # Note: the block registration will automatically insert the
         # ref-time as well.
-        if self.has_block(vault_id, block_id, check_status=True):
+        record = self._load_block_record(vault_id, block_id)
+
+        if record is not None and not record.isinvalid:
             reftime_args = dict(
                 projectid=deuce.context.project_id,
                 vaultid=vault_id,
                 blockid=block_id,
                 reftime=int(datetime.datetime.utcnow().timestamp())
             )
-            query = self.simplestatement(CQL_UPDATE_REF_TIME,
-                consistency_level=self.consistency_level)
+            query = self._statements[CQL_UPDATE_REF_TIME]
             res = self._session.execute(query, reftime_args)
 
     def _del_block_ref_count(self, vault_id, block_id):
@@ -1098,8 +1460,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             blockid=block_id
         )
 
-        query = self.simplestatement(CQL_DEL_BLOCK_REF_COUNT,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_DEL_BLOCK_REF_COUNT]
         res = self._session.execute(query, args)
 
     def get_block_ref_modified(self, vault_id, block_id):
@@ -1110,8 +1471,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
             blockid=block_id
         )
 
-        query = self.simplestatement(CQL_GET_BLOCK_REF_TIME,
-            consistency_level=self.consistency_level)
+        query = self._statements[CQL_GET_BLOCK_REF_TIME]
         res = self._session.execute(query, args)
 
         try:
@@ -1122,8 +1482,7 @@ class CassandraStorageDriver(MetadataStorageDriver):
     def get_health(self):
         try:
             args = ()
-            query = self.simplestatement(CQL_HEALTH_CHECK,
-                consistency_level=self.consistency_level)
+            query = self._statements[CQL_HEALTH_CHECK]
             res = self._session.execute(query, args)
             return ["cassandra cluster: [{0}] is active".format(res[0][0])]
         except:  # pragma: no cover
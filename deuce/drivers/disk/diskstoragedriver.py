@@ -3,6 +3,7 @@ import io
 import os
 import os.path
 import shutil
+import threading
 
 import deuce
 from deuce import conf
@@ -28,6 +29,13 @@ class DiskStorageDriver(BlockStorageDriver):
     def __init__(self):
         self._path = conf.block_storage_driver.disk.path
 
+        # Running [block count, total size] of each vault path,
+        # walked on first use and adjusted as blocks are written
+        # and deleted. Other processes sharing the path are not
+        # seen, so the totals are approximate until recomputed.
+        self._vault_totals = {}
+        self._vault_totals_lock = threading.Lock()
+
     def _get_project_path(self):
         return os.path.join(self._path, str(deuce.context.project_id))
 
@@ -69,10 +77,42 @@ class DiskStorageDriver(BlockStorageDriver):
         else:
             return None
 
-    def get_vault_statistics(self, vault_id):
+    def _adjust_vault_totals(self, vault_id, blocks, size):
+        path = self._get_vault_path(vault_id)
+
+        with self._vault_totals_lock:
+            totals = self._vault_totals.get(path)
+
+            if totals is not None:
+                totals[0] += blocks
+                totals[1] += size
+
+    def _store_block_data(self, vault_id, path, blockdata):
+        """Writes the block to path and adjusts the vault totals.
+        Returns the still open file"""
+        previous = os.path.getsize(path) if os.path.exists(path) else None
+
+        outfile = open(path, 'wb')
+        try:
+            outfile.write(blockdata)
+            outfile.flush()
+        except:
+            outfile.close()
+            raise
+
+        if previous is None:
+            self._adjust_vault_totals(vault_id, 1, len(blockdata))
+        else:
+            self._adjust_vault_totals(vault_id, 0, len(blockdata) - previous)
+
+        return outfile
+
+    def get_vault_statistics(self, vault_id, recompute=False):
         """Return the statistics on the vault.
 
-        "param vault_id: The ID of the vault to gather statistics for"""
+        :param vault_id: The ID of the vault to gather statistics for
+        :param recompute: Whether to walk the vault instead of using
+            the running totals"""
 
         statistics = dict()
         statistics['internal'] = {}
@@ -81,16 +121,22 @@ class DiskStorageDriver(BlockStorageDriver):
 
         path = self._get_vault_path(vault_id)
 
-        total_size = 0
-        object_count = 0
-        for root, dirs, files in os.walk(path):
-            total_size = total_size + sum(
-                os.path.getsize(
-                    os.path.join(root, name)) for name in files)
-            object_count = object_count + len(files)
+        with self._vault_totals_lock:
+            totals = self._vault_totals.get(path)
+
+            if totals is None or recompute:
+                total_size = 0
+                object_count = 0
+                for root, dirs, files in os.walk(path):
+                    total_size = total_size + sum(
+                        os.path.getsize(
+                            os.path.join(root, name)) for name in files)
+                    object_count = object_count + len(files)
 
-        statistics['total-size'] = total_size
-        statistics['block-count'] = object_count
+                totals = [object_count, total_size]
+                self._vault_totals[path] = totals
+
+            statistics['block-count'], statistics['total-size'] = totals
 
         return statistics
 
@@ -103,6 +149,9 @@ class DiskStorageDriver(BlockStorageDriver):
                     # There's nothing in the vault.
                     # It's safe to delete
                     shutil.rmtree(path)
+
+                    with self._vault_totals_lock:
+                        self._vault_totals.pop(path, None)
                     return True
 
                 else:
@@ -117,7 +166,8 @@ class DiskStorageDriver(BlockStorageDriver):
             # An error occurred
             return False
 
-    def store_block(self, vault_id, metadata_block_id, blockdata):
+    def store_block(self, vault_id, metadata_block_id, blockdata,
+                    md5=None):
         storage_id = self.storage_id(metadata_block_id)
         path = self._get_block_path(vault_id, storage_id)
 
@@ -130,9 +180,7 @@ class DiskStorageDriver(BlockStorageDriver):
             # oddly result in the exiting of the context being
             # not covered even though the success and failure
             # paths can be proven to be covered.
-            outfile = open(path, 'wb')
-            outfile.write(blockdata)
-            outfile.flush()
+            outfile = self._store_block_data(vault_id, path, blockdata)
 
             returnValue = True
             returnStorageId = storage_id
@@ -149,7 +197,8 @@ class DiskStorageDriver(BlockStorageDriver):
 
         return (returnValue, returnStorageId)
 
-    def store_async_block(self, vault_id, metadata_block_ids, blockdatas):
+    def store_async_block(self, vault_id, metadata_block_ids, blockdatas,
+                          md5s=None):
         storage_ids = [self.storage_id(metadata_block_id)
                        for metadata_block_id in metadata_block_ids]
         try:
@@ -161,9 +210,8 @@ class DiskStorageDriver(BlockStorageDriver):
                 # not covered even though the success and failure
                 # paths can be proven to be covered.
                 try:
-                    outfile = open(path, 'wb')
-                    outfile.write(blockdata)
-                    outfile.flush()
+                    outfile = self._store_block_data(vault_id, path,
+                                                     blockdata)
 
                 except:
                     pass
@@ -187,7 +235,9 @@ class DiskStorageDriver(BlockStorageDriver):
         path = self._get_block_path(vault_id, storage_block_id)
 
         if os.path.exists(path):
+            size = os.path.getsize(path)
             os.remove(path)
+            self._adjust_vault_totals(vault_id, -1, -size)
             return True
         else:
             return False
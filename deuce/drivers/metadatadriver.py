@@ -1,4 +1,6 @@
 
+import collections
+
 import six
 from abc import ABCMeta, abstractmethod, abstractproperty
 
@@ -7,6 +9,24 @@ from abc import ABCMeta, abstractmethod, abstractproperty
 
 import deuce
 from deuce import conf
+from deuce.util import LRUCache
+
+
+# The block metadata that is cached by the drivers
+BlockRecord = collections.namedtuple('BlockRecord',
+                                     ['storage_id', 'size', 'isinvalid'])
+
+
+class VaultCounters(object):
+    """The running totals kept for each vault"""
+
+    __slots__ = ('files', 'blocks', 'bytes', 'badblocks')
+
+    def __init__(self, files=0, blocks=0, bytes=0, badblocks=0):
+        self.files = files
+        self.blocks = blocks
+        self.bytes = bytes
+        self.badblocks = badblocks
 
 
 class OverlapError(Exception):
@@ -93,6 +113,13 @@ class MetadataStorageDriver(object):
     driver.
     """
 
+    def __init__(self):
+        # Per-process cache of the BlockRecord of each block, keyed
+        # by (project_id, vault_id, block_id)
+        self.block_cache = LRUCache(
+            conf.metadata_driver.block_cache.maxsize,
+            conf.metadata_driver.block_cache.ttl)
+
     @abstractmethod
     def create_vaults_generator(self, marker=None, limit=None):
         """Creates and returns a generator that will return
@@ -119,12 +146,62 @@ class MetadataStorageDriver(object):
         """
         raise NotImplementedError
 
-    @abstractmethod
-    def get_vault_statistics(self, vault_id):
+    def get_vault_statistics(self, vault_id, recompute=False):
         """Return the statistics on the vault.
 
+        The statistics come from per-vault counters that are kept
+        up to date as files and blocks come and go. Counting them
+        from the files and blocks themselves is only done the first
+        time a vault is looked at, or when asked to with recompute;
+        the counters are then reset to the counted values.
+
         :param vault_id: The ID of the vault to gather statistics for
+        :param recompute: Whether to count the statistics instead of
+            trusting the counters
         """
+        counters = None if recompute else self._get_vault_counters(vault_id)
+
+        if counters is None:
+            counters = self._count_vault_statistics(vault_id)
+            counters.badblocks, bad_files = self.vault_health(vault_id)
+            self._set_vault_counters(vault_id, counters)
+
+        elif counters.badblocks:
+            bad_files = self.vault_health(vault_id)[1]
+
+        else:
+            bad_files = 0
+
+        return {
+            'files': {
+                'count': counters.files,
+                'bad': bad_files
+            },
+            'blocks': {
+                'count': counters.blocks,
+                'bad': counters.badblocks,
+                'bytes': counters.bytes
+            },
+            'internal': {}
+        }
+
+    @abstractmethod
+    def _get_vault_counters(self, vault_id):
+        """Returns the VaultCounters of the vault, or None if
+        they have not been recorded yet"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _set_vault_counters(self, vault_id, counters):
+        """Records the VaultCounters of the vault, replacing any
+        previous values"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _count_vault_statistics(self, vault_id):
+        """Counts the files, blocks and bytes of the vault by
+        scanning its metadata. Returns a VaultCounters; the bad
+        block count is filled in by the caller"""
         raise NotImplementedError
 
     @abstractmethod
@@ -197,6 +274,29 @@ class MetadataStorageDriver(object):
         file. The file must previously have been finalized."""
         raise NotImplementedError
 
+    @abstractmethod
+    def get_file_manifest(self, vault_id, file_id):
+        """Returns everything needed to read a file back in one
+        call, as a tuple of (finalized, length, blocks) where blocks
+        is a list of (block_id, offset, size, storage_id) tuples
+        ordered by offset. Returns None if the file does not exist.
+
+        :param vault_id: The ID of the vault
+        :param file_id: The ID of the file"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_file_block_offset(self, vault_id, file_id, position):
+        """Returns the offset of the block of the file that holds
+        the byte at the specified position, i.e. the largest block
+        offset that is not past position. Returns None if there is
+        no such block.
+
+        :param vault_id: The ID of the vault
+        :param file_id: The ID of the file
+        :param position: The byte position within the file"""
+        raise NotImplementedError
+
     @abstractmethod
     def mark_block_as_bad(self, vault_id, block_id):
         """Marks the block in the metadata driver as being a bad
@@ -260,11 +360,30 @@ class MetadataStorageDriver(object):
         """Registers a block in the metadata driver."""
         raise NotImplementedError
 
+    @abstractmethod
+    def register_blocks(self, vault_id, blocks):
+        """Registers several blocks in the metadata driver in as
+        few round trips as the driver allows.
+
+        :param vault_id: The ID of the vault containing the blocks
+        :param blocks: list of (block_id, storage_id, size) tuples"""
+        raise NotImplementedError
+
     @abstractmethod
     def get_block_storage_id(self, vault_id, block_id):
         """Retrieve storage id for a given block id"""
         raise NotImplementedError
 
+    @abstractmethod
+    def get_block_storage_ids(self, vault_id, block_ids):
+        """Retrieve the storage ids for a list of block ids
+
+        :param vault_id: The ID of the vault containing the blocks
+        :param block_ids: list of block_id
+        :returns: list of storage ids in the same order as block_ids,
+            with None for any block that is not registered"""
+        raise NotImplementedError
+
     @abstractmethod
     def get_block_metadata_id(self, vault_id, storage_id):
         """Retrieve block id for a given storage id"""
@@ -308,6 +427,35 @@ class MetadataStorageDriver(object):
         """Check the meta driver health status"""
         raise NotImplementedError
 
+    @abstractmethod
+    def _load_block_record(self, vault_id, block_id):
+        """Reads the BlockRecord of the specified block from the
+        metadata store. Returns None if the block does not exist"""
+        raise NotImplementedError
+
+    def _get_block_record(self, vault_id, block_id):
+        """Returns the BlockRecord of the specified block, or None
+        if the block does not exist. Records are served from the
+        block cache where possible; missing blocks are not cached"""
+        key = (deuce.context.project_id, vault_id, block_id)
+
+        record = self.block_cache.get(key)
+
+        if record is None:
+            record = self._load_block_record(vault_id, block_id)
+
+            if record is not None:
+                self.block_cache.put(key, record)
+
+        return record
+
+    def _invalidate_block(self, vault_id, block_id):
+        """Drops the cached BlockRecord of the specified block. Must
+        be called whenever the block is registered, unregistered
+        or has its status changed"""
+        self.block_cache.invalidate(
+            (deuce.context.project_id, vault_id, block_id))
+
     def _require_no_block_refs(self, vault_id, block_id):
         """This function checks the number of block references and
         requires that there be none. If there are block references,
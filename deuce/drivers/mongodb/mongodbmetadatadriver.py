@@ -1,5 +1,4 @@
 import uuid
-from functools import lru_cache
 from deuce import conf
 
 import deuce
@@ -8,16 +7,69 @@ import sys
 import importlib
 import atexit
 import datetime
+import threading
 
 
 import itertools
 from deuce.drivers.metadatadriver import MetadataStorageDriver, \
-    GapError, OverlapError, ConstraintError
+    GapError, OverlapError, ConstraintError, BlockRecord, VaultCounters
+from deuce.util import log
+
+logger = log.getLogger(__name__)
+
+# The indexes behind every query the driver issues, by collection.
+# They are created once, when the driver first starts against a
+# database whose recorded INDEX_VERSION is older; bump INDEX_VERSION
+# whenever INDEXES changes.
+INDEX_VERSION = 2
+
+INDEXES = {
+    'vaults': [
+        [('projectid', 1), ('vaultid', 1)]
+    ],
+    'files': [
+        [('projectid', 1), ('vaultid', 1), ('fileid', 1)],
+        # File listings
+        [('projectid', 1), ('vaultid', 1), ('finalized', 1), ('fileid', 1)]
+    ],
+    'blocks': [
+        [('projectid', 1), ('vaultid', 1), ('blockid', 1)],
+        # Storage block HEAD/GET: storage id -> block id
+        [('projectid', 1), ('vaultid', 1), ('storageid', 1)],
+        # Bad block scans
+        [('projectid', 1), ('vaultid', 1), ('isinvalid', 1)]
+    ],
+    'fileblocks': [
+        [('projectid', 1), ('vaultid', 1), ('fileid', 1), ('offset', 1)],
+        [('projectid', 1), ('vaultid', 1), ('fileid', 1), ('blockid', 1)],
+        # Files referencing a block, and block reference counts
+        [('projectid', 1), ('vaultid', 1), ('blockid', 1)]
+    ],
+    'vaultstats': [
+        [('projectid', 1), ('vaultid', 1)]
+    ]
+}
+
+# The error code of a write rejected by a unique index
+DUPLICATE_KEY_ERROR = 11000
+
+# The indexes in INDEXES that are also unique. A block is only
+# registered once per vault, however many uploads race to do it
+UNIQUE_INDEXES = {
+    'blocks': [
+        [('projectid', 1), ('vaultid', 1), ('blockid', 1)]
+    ]
+}
+
+# The indexes are only checked by the first driver in the process
+_indexes_checked = False
+_indexes_checked_lock = threading.Lock()
 
 
 class MongoDbStorageDriver(MetadataStorageDriver):
 
     def __init__(self):
+        super(MongoDbStorageDriver, self).__init__()
 
         self._dbfile = conf.metadata_driver.mongodb.path
 
@@ -26,15 +78,75 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
         self.client = getattr(self.mongo_pack, 'MongoClient')(
             conf.metadata_driver.mongodb.url)
+        self._errors = getattr(self.mongo_pack, 'errors')
 
         self._db = self.client[self._dbfile]
         self._vaults = self._db.vaults
         self._blocks = self._db.blocks
         self._files = self._db.files
         self._fileblocks = self._db.fileblocks
+        self._vaultstats = self._db.vaultstats
         # Maintain the document size less than the system maximun.
         self._docnum = int(conf.metadata_driver.mongodb.maxFileBlockSegNum)
 
+        self._create_indexes()
+        self._check_indexes()
+
+    def _check_indexes(self):
+        """Warns about each index the database is missing, once per
+        process rather than for every driver created"""
+        global _indexes_checked
+
+        with _indexes_checked_lock:
+            if _indexes_checked:
+                return
+            _indexes_checked = True
+
+        for collection, keys in self.missing_indexes():
+            logger.warning('MongoDB collection {0} is missing the index '
+                           '{1}'.format(collection, keys))
+
+    def _create_indexes(self):
+        """Creates the indexes in INDEXES, unless the database
+        already has this INDEX_VERSION of them"""
+        version = self._db.schema.find_one({'_id': 'indexes'})
+
+        if version is not None and version['version'] >= INDEX_VERSION:
+            return
+
+        for collection, indexes in INDEXES.items():
+            for keys in indexes:
+                unique = keys in UNIQUE_INDEXES.get(collection, [])
+
+                # An index made unique by a newer manifest replaces
+                # the plain one an older manifest created on its keys
+                if unique:
+                    for name, index in \
+                            self._db[collection].index_information().items():
+                        if list(index['key']) == keys and \
+                                not index.get('unique'):
+                            self._db[collection].drop_index(name)
+
+                self._db[collection].ensure_index(keys, unique=unique)
+
+        self._db.schema.update({'_id': 'indexes'},
+                               {'$set': {'version': INDEX_VERSION}},
+                               upsert=True)
+
+    def missing_indexes(self):
+        """Returns a list of (collection, keys) for each index in
+        INDEXES that the database does not have"""
+        missing = []
+
+        for collection, indexes in INDEXES.items():
+            existing = [list(index['key']) for index in
+                        self._db[collection].index_information().values()]
+
+            missing.extend((collection, keys) for keys in indexes
+                           if keys not in existing)
+
+        return missing
+
     def create_vaults_generator(self, marker=None, limit=None):
         """Creates and returns a generator that will return
         the vault IDs.
@@ -42,8 +154,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         :param marker: The vault_id to start of the list
         :param limit: Number of returned items
         """
-        self._vaults.ensure_index([('projectid', 1),
-            ('vaultid', 1)])
         args = {'projectid': deuce.context.project_id}
         if marker is not None:
             args["vaultid"] = {"$gte": str(marker)}
@@ -59,64 +169,79 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
         }
-        self._vaults.insert(args)
+        res = self._vaults.update(args, {'$set': args}, upsert=True)
+
+        # Only a new vault starts its counters at zero; one that
+        # already exists keeps its own, or has them counted when
+        # they are first asked for
+        if not res.get('updatedExisting') and \
+                self._vaultstats.find_one(args) is None:
+            self._vaultstats.insert(dict(args, files=0, blocks=0,
+                                         bytes=0, badblocks=0))
 
     def delete_vault(self, vault_id):
         """Deletes the vault from metadata."""
-        self._vaults.ensure_index([('projectid', 1),
-            ('vaultid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
         }
         self._vaults.remove(args)
+        self._vaultstats.remove(args)
 
-    def get_vault_statistics(self, vault_id):
-        """Return the statistics on the vault.
+    def _inc_vault_counters(self, vault_id, **deltas):
+        """Adds the deltas to the counters of the vault. Vaults
+        whose counters have not been recorded yet are left alone"""
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+        }
 
-        "param vault_id: The ID of the vault to gather statistics for"""
-        res = {}
+        self._vaultstats.update(args, {'$inc': deltas}, upsert=False)
 
+    def _get_vault_counters(self, vault_id):
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
         }
 
-        def __stats_get_vault_file_count():
-            self._files.ensure_index([('projectid', 1),
-                ('vaultid', 1), ('fileid', 1)])
-            result = self._files.find(args)
-            if result is None:
-                return 0  # pragma: no cover
-            else:
-                return result.count()
-
-        def __stats_get_vault_block_count():
-            self._blocks.ensure_index([('projectid', 1),
-                ('vaultid', 1), ('blockid', 1)])
-            result = self._blocks.find(args)
-            if result is None:
-                return 0  # pragma: no cover
-            else:
-                return result.count()
+        res = self._vaultstats.find_one(args)
 
-        # Add any statistics regarding files
-        res['files'] = {}
-        res['files']['count'] = __stats_get_vault_file_count()
+        if res is None:
+            return None
 
-        # Add any statistics regarding blocks
-        res['blocks'] = {}
-        res['blocks']['count'] = __stats_get_vault_block_count()
+        return VaultCounters(res['files'], res['blocks'], res['bytes'],
+                             res['badblocks'])
 
-        # Add information about bad blocks and bad files
+    def _set_vault_counters(self, vault_id, counters):
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+        }
 
-        res['blocks']['bad'], res['files']['bad'] = \
-            self.vault_health(vault_id)
+        update_args = {
+            '$set': {
+                'files': counters.files,
+                'blocks': counters.blocks,
+                'bytes': counters.bytes,
+                'badblocks': counters.badblocks
+            }
+        }
 
-        # Add any statistics specific to the Mongo backend
-        res['internal'] = {}
+        self._vaultstats.update(args, update_args, upsert=True)
 
-        return res
+    def _count_vault_statistics(self, vault_id):
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+        }
+
+        counters = VaultCounters(files=self._files.find(args).count())
+
+        for res in self._blocks.find(args, {'_id': 0, 'blocksize': 1}):
+            counters.blocks += 1
+            counters.bytes += int(res.get('blocksize') or 0)
+
+        return counters
 
     def vault_health(self, vault_id):
         '''Returns the number of bad blocks and bad files associated
@@ -127,26 +252,21 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             vaultid=vault_id,
             isinvalid=True
         )
-        self._blocks.ensure_index([('projectid', 1),
-                ('vaultid', 1)])
-
-        results = self._blocks.find(args)
 
-        bad_blocks = ([res['blockid'] for res in results])
+        bad_blocks = [res['blockid'] for res in
+                      self._blocks.find(args, {'_id': 0, 'blockid': 1})]
         no_of_bad_blocks = len(bad_blocks)
         bad_files = set()
 
-        self._fileblocks.ensure_index([('projectid', 1),
-                ('vaultid', 1), ('blockid', 1)])
-
-        for block_id in bad_blocks:
+        # One query per chunk of bad blocks, keeping the query
+        # document size below the system maximum
+        for start in range(0, no_of_bad_blocks, self._docnum):
             args = dict(
                 projectid=deuce.context.project_id,
                 vaultid=vault_id,
-                blockid=block_id,
+                blockid={'$in': bad_blocks[start:start + self._docnum]}
             )
-            results = self._fileblocks.find(args)
-            bad_files.update([res['fileid'] for res in results])
+            bad_files.update(self._fileblocks.find(args).distinct('fileid'))
 
         no_of_bad_files = len(bad_files)
 
@@ -165,13 +285,12 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         }
 
         self._files.insert(args)
+        self._inc_vault_counters(vault_id, files=1)
 
         return file_id
 
     def file_length(self, vault_id, file_id):
         """Retrieve length the of the file."""
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -187,25 +306,42 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
     def get_block_storage_id(self, vault_id, block_id):
         """Retrieve storage id for a given block id"""
-        self._blocks.ensure_index([('projectid', 1),
-                                  ('vaultid', 1), ('blockid', 1)])
-        args = {
-            'projectid': deuce.context.project_id,
-            'vaultid': vault_id,
-            'blockid': block_id
+        record = self._get_block_record(vault_id, block_id)
+        return record.storage_id if record else None
+
+    def _find_blocks(self, vault_id, block_ids, project_args):
+        """Returns a generator of the blocks documents for the
+        given block ids, with the fields in project_args"""
+
+        # Keep the query document size below the system maximum
+        for start in range(0, len(block_ids), self._docnum):
+            args = {
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id,
+                'blockid': {
+                    '$in': block_ids[start:start + self._docnum]
+                }
+            }
+
+            for res in self._blocks.find(args, project_args):
+                yield res
+
+    def get_block_storage_ids(self, vault_id, block_ids):
+        """Retrieve storage ids for the given block ids"""
+        project_args = {
+            '_id': 0,
+            'blockid': 1,
+            'storageid': 1
         }
 
-        res = self._blocks.find_one(args)
-        if res:
-            return str(res.get('storageid'))
-        else:
-            return None
+        storage_ids = dict((res['blockid'], str(res['storageid']))
+                           for res in self._find_blocks(vault_id, block_ids,
+                                                        project_args))
+
+        return [storage_ids.get(block_id) for block_id in block_ids]
 
     def get_block_metadata_id(self, vault_id, storage_id):
         """Retrieve block id for a given storage id"""
-        self._blocks.ensure_index([('projectid', 1),
-                                  ('vaultid', 1),
-                                  ('storageid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -219,8 +355,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             return None
 
     def has_file(self, vault_id, file_id):
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -234,8 +368,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         return True
 
     def is_finalized(self, vault_id, file_id):
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -248,8 +380,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         return False
 
     def delete_file(self, vault_id, file_id):
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -260,9 +390,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         block_args = args.copy()
         del block_args['fileid']
 
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
-
         for result in results:
             block_args['blockid'] = result['blockid']
             update_args = {
@@ -272,15 +399,16 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             }
             self._blocks.update(block_args, update_args, upsert=False)
 
-        self._files.remove(args)
+        removed = self._files.remove(args)
         self._fileblocks.remove(args)
 
+        if removed['n']:
+            self._inc_vault_counters(vault_id, files=-removed['n'])
+
     def finalize_file(self, vault_id, file_id, file_size=None):
         """Updates FILES to set a file to finalized. This function
         makes no assumptions about whether or not the file record actually
         exists"""
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
 
         find_args = {
             'projectid': deuce.context.project_id,
@@ -299,17 +427,34 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             find(find_args).sort('offset', 1))
         expected_offset = 0
 
+        # The sizes of all of the blocks are fetched up front; bad
+        # blocks are skipped like missing ones
+        project_args = {
+            '_id': 0,
+            'blockid': 1,
+            'blocksize': 1,
+            'isinvalid': 1
+        }
+
+        blocksizes = dict(
+            (res['blockid'], res['blocksize']) for res in
+            self._find_blocks(vault_id,
+                              list(set(item['blockid']
+                                       for item in fileblocks_list)),
+                              project_args)
+            if not res.get('isinvalid'))
+
         for item in fileblocks_list:
             offset = item['offset']
             blockid = item['blockid']
 
-            blockdata = self.get_block_data(vault_id, blockid)
+            blocksize = blocksizes.get(blockid)
 
-            if blockdata is None:
+            if blocksize is None:
                 continue
 
             if offset == expected_offset:
-                expected_offset += int(blockdata['blocksize'])
+                expected_offset += int(blocksize)
             elif offset < expected_offset:  # Overlap scenario
                 raise OverlapError(deuce.context.project_id, vault_id,
                     file_id, blockid, startpos=offset, endpos=expected_offset)
@@ -344,8 +489,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
     def get_file_data(self, vault_id, file_id):
         """Returns a tuple representing data for this file"""
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -371,7 +514,13 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             }
         }
 
+        record = self._load_block_record(vault_id, block_id)
+
         self._blocks.update(args, update_args, upsert=False)
+        self._invalidate_block(vault_id, block_id)
+
+        if record is not None and not record.isinvalid:
+            self._inc_vault_counters(vault_id, badblocks=1)
 
     @staticmethod
     def _block_exists(result, check_status):
@@ -381,10 +530,7 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         else:
             return result is not None
 
-    def has_block(self, vault_id, block_id, check_status=False):
-        # Query BLOCKS for the block
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
+    def _load_block_record(self, vault_id, block_id):
 
         args = {
             'projectid': deuce.context.project_id,
@@ -392,37 +538,48 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             'blockid': str(block_id)
         }
 
-        res = self._blocks.find_one(args)
+        project_args = {
+            '_id': 0,
+            'storageid': 1,
+            'blocksize': 1,
+            'isinvalid': 1
+        }
 
-        return MongoDbStorageDriver._block_exists(res, check_status)
+        res = self._blocks.find_one(args, project_args)
 
-    # @lru_cache(maxsize=1024)
-    def has_blocks(self, vault_id, block_ids, check_status=False):
-        # Query BLOCKS for the block
-        results = []
+        if res is None:
+            return None
 
-        for block_id in block_ids:
-            self._blocks.ensure_index([('projectid', 1),
-                ('vaultid', 1), ('blockid', 1)])
+        return BlockRecord(str(res.get('storageid')), res.get('blocksize'),
+                           res.get('isinvalid') or False)
 
-            args = {
-                'projectid': deuce.context.project_id,
-                'vaultid': vault_id,
-                'blockid': str(block_id)
-            }
+    def has_block(self, vault_id, block_id, check_status=False):
+        record = self._get_block_record(vault_id, block_id)
 
-            result = self._blocks.find_one(args)
+        if record is None:
+            return False
 
-            if MongoDbStorageDriver._block_exists(result,
-                                                  check_status) is False:
-                results.append(block_id)
+        return not (check_status and record.isinvalid)
 
-        return results
+    def has_blocks(self, vault_id, block_ids, check_status=False):
+        block_ids = [str(block_id) for block_id in block_ids]
+
+        project_args = {
+            '_id': 0,
+            'blockid': 1,
+            'isinvalid': 1
+        }
+
+        found = dict((res['blockid'], res) for res in
+                     self._find_blocks(vault_id, list(set(block_ids)),
+                                       project_args))
+
+        return [block_id for block_id in block_ids
+                if not MongoDbStorageDriver._block_exists(
+                    found.get(block_id), check_status)]
 
     def get_block_data(self, vault_id, block_id):
         """Returns the blocksize for this block"""
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
 
         args = {
             'projectid': deuce.context.project_id,
@@ -434,8 +591,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         return self._blocks.find_one(args)
 
     def create_block_generator(self, vault_id, marker=None, limit=None):
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id
@@ -450,8 +605,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
     def create_file_generator(self, vault_id,
             marker=None, limit=None, finalized=True):
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         limit = self._determine_limit(limit)
 
         args = dict()
@@ -468,9 +621,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
     def create_file_block_generator(self, vault_id, file_id,
             offset=None, limit=None):
 
-        self._fileblocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1), ('offset', 1)])
-
         if limit is None:
             limit = 0
         else:
@@ -507,11 +657,74 @@ class MongoDbStorageDriver(MetadataStorageDriver):
 
         return ((res['blockid'], res['offset']) for res in resblocks)
 
+    def get_file_manifest(self, vault_id, file_id):
+
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'fileid': file_id
+        }
+
+        res = self._files.find_one(args)
+
+        if res is None:
+            return None
+
+        pipeline = [
+            {'$match': args},
+            {'$sort': {'offset': 1}}
+        ]
+
+        fileblocks = self._fileblocks.aggregate(pipeline)
+
+        # NOTE: Older pymongo returns the command response rather
+        # than a cursor
+        if isinstance(fileblocks, dict):
+            fileblocks = fileblocks['result']
+
+        fileblocks = [(doc['blockid'], doc['offset']) for doc in fileblocks]
+
+        project_args = {
+            '_id': 0,
+            'blockid': 1,
+            'blocksize': 1,
+            'storageid': 1
+        }
+
+        blocks = dict((doc['blockid'], doc) for doc in self._find_blocks(
+            vault_id, list(set(block[0] for block in fileblocks)),
+            project_args))
+
+        def block_info(block_id, offset):
+            doc = blocks.get(block_id, {})
+            storage_id = doc.get('storageid')
+            return (block_id, offset, doc.get('blocksize'),
+                    str(storage_id) if storage_id is not None else None)
+
+        return (bool(res.get('finalized')), res.get('size') or 0,
+                [block_info(block_id, offset)
+                 for block_id, offset in fileblocks])
+
+    def get_file_block_offset(self, vault_id, file_id, position):
+
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'fileid': file_id,
+            'offset':
+                {
+                    '$lte': position
+                }
+        }
+
+        res = self._fileblocks.find_one(args, {'_id': 0, 'offset': 1},
+            sort=[('offset', -1)])
+
+        return res['offset'] if res else None
+
     def assign_block(self, vault_id, file_id, block_id, offset):
         # TODO(jdp): tweak this to support multiple assignments
         # TODO(jdp): check for overlaps in metadata
-        self._files.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('fileid', 1)])
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
@@ -521,11 +734,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         }
 
         self._fileblocks.update(args, args, upsert=True)
-        # Ordered in pymongo.ASCENDING.
-        self._fileblocks.ensure_index([('projectid', 1),
-            ('vaultid', 1),
-            ('fileid', 1),
-            ('blockid', 1)])
 
         # Update the reftime
         block_args = args.copy()
@@ -543,8 +751,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
         # TODO(jdp): tweak this to support multiple assignments
         # TODO(jdp): check for overlaps in metadata
         for block_id, offset in zip(block_ids, offsets):
-            self._files.ensure_index([('projectid', 1),
-                ('vaultid', 1), ('fileid', 1)])
             args = {
                 'projectid': deuce.context.project_id,
                 'vaultid': vault_id,
@@ -554,11 +760,6 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             }
 
             self._fileblocks.update(args, args, upsert=True)
-            # Ordered in pymongo.ASCENDING.
-            self._fileblocks.ensure_index([('projectid', 1),
-                ('vaultid', 1),
-                ('fileid', 1),
-                ('blockid', 1)])
 
             # Update the reftime
             block_args = args.copy()
@@ -573,12 +774,17 @@ class MongoDbStorageDriver(MetadataStorageDriver):
             self._blocks.update(block_args, update_args, upsert=False)
 
     def register_block(self, vault_id, block_id, storage_id, blocksize):
-        if not self.has_block(vault_id, block_id, check_status=True):
+        # Read the block afresh rather than from the block cache; a
+        # cached record may be stale if another worker unregistered
+        # the block or marked it as bad
+        record = self._load_block_record(vault_id, block_id)
+
+        if record is None or record.isinvalid:
+            # A block previously marked as bad is replaced in place
             args = {
                 'projectid': deuce.context.project_id,
                 'vaultid': vault_id,
                 'blockid': str(block_id),
-                'blocksize': blocksize,
             }
             update_args = {
                 '$set': {
@@ -591,21 +797,125 @@ class MongoDbStorageDriver(MetadataStorageDriver):
                     'isinvalid': False
                 }
             }
-            self._blocks.update(args, update_args, upsert=True)
+            try:
+                res = self._blocks.update(args, update_args, upsert=True)
+            except self._errors.DuplicateKeyError:
+                res = {'updatedExisting': True}
+
+            self._invalidate_block(vault_id, block_id)
+
+            if record is None:
+                # Unless an upload racing this one counted it first
+                if not res.get('updatedExisting'):
+                    self._inc_vault_counters(vault_id, blocks=1,
+                                             bytes=int(blocksize))
+            else:
+                self._inc_vault_counters(
+                    vault_id, badblocks=-int(record.isinvalid),
+                    bytes=int(blocksize) - int(record.size or 0))
+
+    def register_blocks(self, vault_id, blocks):
+        blocks = dict((str(block_id), (storage_id, blocksize))
+                      for block_id, storage_id, blocksize in blocks)
+
+        project_args = {
+            '_id': 0,
+            'blockid': 1,
+            'blocksize': 1,
+            'isinvalid': 1
+        }
+
+        found = dict((res['blockid'], res) for res in
+                     self._find_blocks(vault_id, list(blocks),
+                                       project_args))
+
+        reftime = int(datetime.datetime.utcnow().timestamp())
+
+        # New blocks and bad blocks being replaced are all upserted
+        # against the unique block index in one unordered batch, so
+        # that an upload racing this one to register the same block
+        # does not leave two documents for it
+        bulk = self._blocks.initialize_unordered_bulk_op()
+        ops = []
+
+        for block_id, (storage_id, blocksize) in blocks.items():
+            if MongoDbStorageDriver._block_exists(found.get(block_id),
+                                                  check_status=True):
+                continue
+
+            block = {
+                'reftime': reftime,
+                'storageid': storage_id,
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id,
+                'blockid': block_id,
+                'blocksize': blocksize,
+                'isinvalid': False
+            }
+
+            args = {
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id,
+                'blockid': block_id
+            }
+
+            bulk.find(args).upsert().update_one({'$set': block})
+            ops.append((block_id, blocksize))
+
+        if not ops:
+            return
+
+        try:
+            result = bulk.execute()
+        except self._errors.BulkWriteError as ex:
+            # The server rejects the losing upload's upserts, which
+            # is fine; any other error is not
+            result = ex.details
+
+            if any(error['code'] != DUPLICATE_KEY_ERROR
+                   for error in result['writeErrors']):
+                raise
+
+        upserted = set(res['index'] for res in result['upserted'])
+        deltas = dict(blocks=0, bytes=0, badblocks=0)
+
+        for index, (block_id, blocksize) in enumerate(ops):
+            self._invalidate_block(vault_id, block_id)
+
+            if index in upserted:
+                deltas['blocks'] += 1
+                deltas['bytes'] += int(blocksize)
+
+            elif block_id in found:
+                # A bad block replaced in place
+                deltas['badblocks'] -= 1
+                deltas['bytes'] += int(blocksize) - int(
+                    found[block_id].get('blocksize') or 0)
+
+            # Otherwise the upload that got there first counted it
+
+        if any(deltas.values()):
+            self._inc_vault_counters(vault_id, **deltas)
 
     def unregister_block(self, vault_id, block_id):
 
         self._require_no_block_refs(vault_id, block_id)
 
-        self._blocks.ensure_index([('projectid', 1),
-            ('vaultid', 1), ('blockid', 1)])
-
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
             'blockid': str(block_id)
         }
+
+        record = self._load_block_record(vault_id, block_id)
+
         self._blocks.remove(args)
+        self._invalidate_block(vault_id, block_id)
+
+        if record is not None:
+            self._inc_vault_counters(vault_id, blocks=-1,
+                                     bytes=-int(record.size or 0),
+                                     badblocks=-int(record.isinvalid))
 
     def get_block_ref_count(self, vault_id, block_id):
 
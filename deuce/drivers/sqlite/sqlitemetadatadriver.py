@@ -1,12 +1,11 @@
-from functools import lru_cache
-
 from deuce import conf
 import deuce
 import importlib
+import threading
 
 
 from deuce.drivers.metadatadriver import MetadataStorageDriver,\
-    OverlapError, GapError, ConstraintError
+    OverlapError, GapError, ConstraintError, BlockRecord, VaultCounters
 
 # SQL schemas. Note: the schema is versions
 # in such a way that new instances always start
@@ -61,10 +60,177 @@ schemas.append([
     """
 ])  # Version 1
 
+schemas.append([
+    """
+    CREATE INDEX fileblocks_offset
+    ON fileblocks (projectid, vaultid, fileid, offset)
+    """
+])  # Version 2
+
+schemas.append([
+    # Storage block HEAD/GET: storage id -> block id
+    """
+    CREATE INDEX blocks_storageid
+    ON blocks (projectid, vaultid, storageid, blockid)
+    """,
+    # Bad block scans; only the invalid blocks are indexed
+    """
+    CREATE INDEX blocks_invalid
+    ON blocks (projectid, vaultid, blockid)
+    WHERE isinvalid = 1
+    """,
+    # Files referencing a block, and block reference counts
+    """
+    CREATE INDEX fileblocks_blockid
+    ON fileblocks (projectid, vaultid, blockid, fileid)
+    """,
+    # File listings filtered on finalized
+    """
+    CREATE INDEX files_finalized
+    ON files (projectid, vaultid, finalized, fileid)
+    """
+])  # Version 3
+
+schemas.append([
+    # Reference counts are kept up to date by triggers so that they
+    # change in the same transaction as the fileblocks rows
+    """
+    CREATE TABLE blockrefs
+    (
+        projectid TEXT NOT NULL,
+        vaultid TEXT NOT NULL,
+        blockid TEXT NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(projectid, vaultid, blockid)
+    )
+    """,
+    """
+    CREATE TRIGGER fileblocks_insert_ref AFTER INSERT ON fileblocks
+    BEGIN
+        INSERT OR IGNORE INTO blockrefs (projectid, vaultid, blockid)
+        VALUES (NEW.projectid, NEW.vaultid, NEW.blockid);
+
+        UPDATE blockrefs SET refcount = refcount + 1
+        WHERE projectid = NEW.projectid
+        AND vaultid = NEW.vaultid
+        AND blockid = NEW.blockid;
+    END
+    """,
+    """
+    CREATE TRIGGER fileblocks_delete_ref AFTER DELETE ON fileblocks
+    BEGIN
+        UPDATE blockrefs SET refcount = refcount - 1
+        WHERE projectid = OLD.projectid
+        AND vaultid = OLD.vaultid
+        AND blockid = OLD.blockid;
+
+        DELETE FROM blockrefs
+        WHERE projectid = OLD.projectid
+        AND vaultid = OLD.vaultid
+        AND blockid = OLD.blockid
+        AND refcount <= 0;
+    END
+    """,
+    """
+    INSERT INTO blockrefs (projectid, vaultid, blockid, refcount)
+    SELECT projectid, vaultid, blockid, count(*)
+    FROM fileblocks
+    GROUP BY projectid, vaultid, blockid
+    """
+])  # Version 4
+
+schemas.append([
+    # Running totals for the vault statistics, kept up to date by
+    # triggers. A vault's row is created with the vault, counted
+    # here for the vaults that already exist, or by the first
+    # statistics request for it; the triggers leave vaults without
+    # a row alone.
+    """
+    CREATE TABLE vaultstats
+    (
+        projectid TEXT NOT NULL,
+        vaultid TEXT NOT NULL,
+        files INTEGER NOT NULL DEFAULT 0,
+        blocks INTEGER NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        badblocks INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(projectid, vaultid)
+    )
+    """,
+    """
+    CREATE TRIGGER files_insert_stats AFTER INSERT ON files
+    BEGIN
+        UPDATE vaultstats SET files = files + 1
+        WHERE projectid = NEW.projectid
+        AND vaultid = NEW.vaultid;
+    END
+    """,
+    """
+    CREATE TRIGGER files_delete_stats AFTER DELETE ON files
+    BEGIN
+        UPDATE vaultstats SET files = files - 1
+        WHERE projectid = OLD.projectid
+        AND vaultid = OLD.vaultid;
+    END
+    """,
+    """
+    CREATE TRIGGER blocks_insert_stats AFTER INSERT ON blocks
+    BEGIN
+        UPDATE vaultstats SET
+            blocks = blocks + 1,
+            bytes = bytes + NEW.size,
+            badblocks = badblocks + NEW.isinvalid
+        WHERE projectid = NEW.projectid
+        AND vaultid = NEW.vaultid;
+    END
+    """,
+    """
+    CREATE TRIGGER blocks_delete_stats AFTER DELETE ON blocks
+    BEGIN
+        UPDATE vaultstats SET
+            blocks = blocks - 1,
+            bytes = bytes - OLD.size,
+            badblocks = badblocks - OLD.isinvalid
+        WHERE projectid = OLD.projectid
+        AND vaultid = OLD.vaultid;
+    END
+    """,
+    """
+    CREATE TRIGGER blocks_update_stats
+    AFTER UPDATE OF size, isinvalid ON blocks
+    BEGIN
+        UPDATE vaultstats SET
+            bytes = bytes + NEW.size - OLD.size,
+            badblocks = badblocks + NEW.isinvalid - OLD.isinvalid
+        WHERE projectid = NEW.projectid
+        AND vaultid = NEW.vaultid;
+    END
+    """,
+    """
+    INSERT INTO vaultstats
+    (projectid, vaultid, files, blocks, bytes, badblocks)
+    SELECT projectid, vaultid,
+        (SELECT COUNT(*) FROM files
+         WHERE files.projectid = vaults.projectid
+         AND files.vaultid = vaults.vaultid),
+        (SELECT COUNT(*) FROM blocks
+         WHERE blocks.projectid = vaults.projectid
+         AND blocks.vaultid = vaults.vaultid),
+        (SELECT COALESCE(SUM(size), 0) FROM blocks
+         WHERE blocks.projectid = vaults.projectid
+         AND blocks.vaultid = vaults.vaultid),
+        (SELECT COUNT(*) FROM blocks
+         WHERE blocks.projectid = vaults.projectid
+         AND blocks.vaultid = vaults.vaultid
+         AND isinvalid = 1)
+    FROM vaults
+    """
+])  # Version 5
+
 CURRENT_DB_VERSION = len(schemas)
 
 SQL_CREATE_VAULT = '''
-    INSERT OR REPLACE INTO vaults
+    INSERT OR IGNORE INTO vaults
     (projectid, vaultid)
     VALUES (:projectid, :vaultid)
 '''
@@ -89,15 +255,6 @@ SQL_CREATE_FILE = '''
     VALUES (:projectid, :vaultid, :fileid)
 '''
 
-SQL_GET_BLOCK = '''
-    SELECT size
-    FROM blocks
-    WHERE projectid = :projectid
-    AND vaultid = :vaultid
-    AND blockid = :blockid
-    AND isinvalid = 0
-'''
-
 SQL_GET_FILE = '''
     SELECT finalized
     FROM files
@@ -129,20 +286,45 @@ SQL_GET_ALL_FILE_BLOCKS = '''
     AND fileid = :fileid
     ORDER BY offset
 '''
-SQL_GET_BAD_BLOCKS = '''
-    SELECT blockid
+
+SQL_GET_FILE_MANIFEST = '''
+    SELECT files.finalized, files.size,
+        fileblocks.blockid, fileblocks.offset,
+        blocks.size, blocks.storageid
+    FROM files
+    LEFT JOIN fileblocks
+    ON fileblocks.projectid = files.projectid
+    AND fileblocks.vaultid = files.vaultid
+    AND fileblocks.fileid = files.fileid
+    LEFT JOIN blocks
+    ON blocks.projectid = fileblocks.projectid
+    AND blocks.vaultid = fileblocks.vaultid
+    AND blocks.blockid = fileblocks.blockid
+    WHERE files.projectid = :projectid
+    AND files.vaultid = :vaultid
+    AND files.fileid = :fileid
+    ORDER BY fileblocks.offset
+'''
+
+SQL_COUNT_BAD_BLOCKS = '''
+    SELECT COUNT(*)
     FROM blocks
     WHERE projectid = :projectid
     AND vaultid = :vaultid
     AND isinvalid = 1
 '''
 
-SQL_GET_FILE_PER_BLOCK = '''
-    SELECT fileid
-    FROM fileblocks
-    WHERE projectid = :projectid
-    AND vaultid = :vaultid
-    AND blockid = :blockid
+# NOTE: the CROSS JOIN makes sqlite drive the join from the
+# (few) bad blocks rather than from every block of every file
+SQL_COUNT_BAD_FILES = '''
+    SELECT COUNT(DISTINCT fileblocks.fileid)
+    FROM blocks CROSS JOIN fileblocks
+    WHERE blocks.projectid = :projectid
+    AND blocks.vaultid = :vaultid
+    AND blocks.isinvalid = 1
+    AND fileblocks.projectid = blocks.projectid
+    AND fileblocks.vaultid = blocks.vaultid
+    AND fileblocks.blockid = blocks.blockid
 '''
 
 SQL_UPDATE_REF_TIME_BLOCKS_IN_FILE = '''
@@ -175,6 +357,17 @@ SQL_GET_FILE_BLOCKS = '''
     LIMIT :limit
 '''
 
+SQL_GET_FILE_BLOCK_OFFSET = '''
+    SELECT offset
+    FROM fileblocks
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND fileid = :fileid
+    AND offset <= :position
+    ORDER BY offset DESC
+    LIMIT 1
+'''
+
 SQL_DELETE_FILE_BLOCKS_FOR_FILE = '''
     DELETE FROM fileblocks
     WHERE projectid = :projectid
@@ -192,12 +385,16 @@ SQL_GET_ALL_BLOCKS = '''
     LIMIT :limit
 '''
 
-SQL_GET_STORAGE_ID = '''
-    SELECT storageid
+# Block ids are looked up in chunks so the number of
+# host parameters stays under SQLITE_MAX_VARIABLE_NUMBER
+SQL_MAX_IN_ARGS = 500
+
+SQL_GET_STORAGE_IDS = '''
+    SELECT blockid, storageid
     FROM blocks
     WHERE projectid = :projectid
     AND vaultid = :vaultid
-    AND blockid = :blockid
+    AND blockid IN ({0})
 '''
 
 SQL_GET_BLOCK_ID = '''
@@ -233,17 +430,51 @@ SQL_GET_COUNT_ALL_FILES = '''
     AND vaultid = :vaultid
 '''
 
+SQL_GET_SUM_ALL_BLOCK_SIZES = '''
+    SELECT COALESCE(SUM(size), 0)
+    FROM blocks
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+'''
+
+SQL_CREATE_VAULT_STATS = '''
+    INSERT OR IGNORE INTO vaultstats (projectid, vaultid)
+    VALUES (:projectid, :vaultid)
+'''
 
+SQL_DELETE_VAULT_STATS = '''
+    DELETE FROM vaultstats
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+'''
+
+SQL_GET_VAULT_STATS = '''
+    SELECT files, blocks, bytes, badblocks
+    FROM vaultstats
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+'''
+
+SQL_SET_VAULT_STATS = '''
+    INSERT OR REPLACE INTO vaultstats
+    (projectid, vaultid, files, blocks, bytes, badblocks)
+    VALUES (:projectid, :vaultid, :files, :blocks, :bytes, :badblocks)
+'''
+
+
+# NOTE: each fileblock looks up its block by primary key, and the
+# rows come out of fileblocks_offset already in offset order
 SQL_CREATE_FILEBLOCK_LIST = '''
-    SELECT blocks.blockid, fileblocks.offset, blocks.size
-    FROM blocks, fileblocks
-    WHERE fileblocks.blockid = blocks.blockid
-    AND fileblocks.vaultid = blocks.vaultid
-    AND fileblocks.projectid = :projectid
+    SELECT fileblocks.blockid, fileblocks.offset, blocks.size
+    FROM fileblocks CROSS JOIN blocks
+    WHERE fileblocks.projectid = :projectid
     AND fileblocks.vaultid = :vaultid
     AND fileblocks.fileid = :fileid
+    AND blocks.projectid = fileblocks.projectid
+    AND blocks.vaultid = fileblocks.vaultid
+    AND blocks.blockid = fileblocks.blockid
     AND blocks.isinvalid = 0
-    ORDER by offset
+    ORDER BY fileblocks.offset
 '''
 
 SQL_FINALIZE_FILE = '''
@@ -254,8 +485,11 @@ SQL_FINALIZE_FILE = '''
     AND vaultid=:vaultid
 '''
 
+# NOTE: A conflicting row is identical to the new one, so it is
+# kept. REPLACE would delete it without firing fileblocks_delete_ref
+# and the block's reference count would drift.
 SQL_ASSIGN_BLOCK_TO_FILE = '''
-    INSERT OR REPLACE INTO fileblocks
+    INSERT OR IGNORE INTO fileblocks
     (projectid, vaultid, fileid, blockid, offset)
     VALUES (:projectid, :vaultid, :fileid, :blockid, :offset)
 '''
@@ -280,22 +514,66 @@ SQL_MARK_BLOCK_AS_BAD = '''
     blockid = :blockid
 '''
 
-SQL_GET_BLOCK_STATUS = '''
-    SELECT isinvalid
+SQL_GET_BLOCK_RECORD = '''
+    SELECT storageid, size, isinvalid
     FROM blocks
-    WHERE projectid=:projectid
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
     AND blockid = :blockid
+'''
+
+SQL_GET_BLOCKS_STATUS = '''
+    SELECT blockid, isinvalid
+    FROM blocks
+    WHERE projectid = :projectid
     AND vaultid = :vaultid
+    AND blockid IN ({0})
 '''
 
 SQL_GET_BLOCK_REF_COUNT = '''
-    SELECT count(*)
-    FROM fileblocks
+    SELECT refcount
+    FROM blockrefs
     WHERE projectid = :projectid
     AND vaultid = :vaultid
     AND blockid = :blockid
 '''
 
+SQL_COUNT_WRONG_BLOCK_REFS = '''
+    SELECT count(*)
+    FROM (
+        SELECT projectid, vaultid, blockid, count(*) AS refcount
+        FROM fileblocks
+        GROUP BY projectid, vaultid, blockid
+    ) AS actual
+    LEFT JOIN blockrefs
+    USING (projectid, vaultid, blockid)
+    WHERE blockrefs.refcount IS NULL
+    OR blockrefs.refcount != actual.refcount
+'''
+
+SQL_COUNT_STALE_BLOCK_REFS = '''
+    SELECT count(*)
+    FROM blockrefs
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM fileblocks
+        WHERE fileblocks.projectid = blockrefs.projectid
+        AND fileblocks.vaultid = blockrefs.vaultid
+        AND fileblocks.blockid = blockrefs.blockid
+    )
+'''
+
+SQL_DELETE_ALL_BLOCK_REFS = '''
+    DELETE FROM blockrefs
+'''
+
+SQL_RECOMPUTE_BLOCK_REFS = '''
+    INSERT INTO blockrefs (projectid, vaultid, blockid, refcount)
+    SELECT projectid, vaultid, blockid, count(*)
+    FROM fileblocks
+    GROUP BY projectid, vaultid, blockid
+'''
+
 SQL_UPDATE_REF_TIME = '''
     UPDATE blocks
     SET reftime = strftime('%s', 'now')
@@ -304,6 +582,14 @@ SQL_UPDATE_REF_TIME = '''
     AND blockid = :blockid
 '''
 
+SQL_UPDATE_REF_TIMES = '''
+    UPDATE blocks
+    SET reftime = strftime('%s', 'now')
+    WHERE projectid = :projectid
+    AND vaultid = :vaultid
+    AND blockid IN ({0})
+'''
+
 SQL_GET_REF_TIME = '''
     SELECT reftime
     FROM blocks
@@ -316,15 +602,61 @@ SQL_GET_REF_TIME = '''
 class SqliteStorageDriver(MetadataStorageDriver):
 
     def __init__(self):
+        super(SqliteStorageDriver, self).__init__()
+
         self._dbfile = conf.metadata_driver.sqlite.path
 
         # Load the driver module according to the configuration
         deuce.db_pack = importlib.import_module(
             conf.metadata_driver.sqlite.db_module)
-        self._conn = getattr(deuce.db_pack, 'Connection')(self._dbfile)
+
+        # Each thread gets its own connection so that readers do not
+        # wait on each other; with WAL journaling they do not wait
+        # on the writer either. An in-memory database only exists
+        # for the connection that created it, so that one is shared.
+        self._local = threading.local()
+        self._shared_conn = None
+
+        if self._dbfile == ':memory:':
+            self._shared_conn = self._connect(check_same_thread=False)
 
         self._do_migrate()
 
+    def _connect(self, **kwargs):
+        sqlite_conf = conf.metadata_driver.sqlite
+
+        conn = getattr(deuce.db_pack, 'Connection')(
+            self._dbfile,
+            timeout=sqlite_conf.busy_timeout / 1000.0,
+            **kwargs)
+
+        # NOTE: pragmas cannot be parameterized, so the values are
+        # formatted in. They are validated by the configspec.
+        conn.execute('pragma journal_mode=%s' % sqlite_conf.journal_mode)
+        conn.execute('pragma synchronous=%s' % sqlite_conf.synchronous)
+        conn.execute('pragma cache_size=%d' % sqlite_conf.cache_size)
+        conn.execute('pragma mmap_size=%d' % sqlite_conf.mmap_size)
+        conn.execute('pragma busy_timeout=%d' % sqlite_conf.busy_timeout)
+
+        # The REPLACE in SQL_REGISTER_BLOCK only fires the delete
+        # triggers of the row it replaces with recursive triggers on,
+        # without which the vault statistics would count it twice
+        conn.execute('pragma recursive_triggers=ON')
+
+        return conn
+
+    @property
+    def _conn(self):
+        """The connection for the calling thread"""
+        if self._shared_conn is not None:
+            return self._shared_conn
+
+        try:
+            return self._local.conn
+        except AttributeError:
+            self._local.conn = self._connect()
+            return self._local.conn
+
     def _get_user_version(self):
         res = self._conn.execute('pragma user_version')
         row = next(res)
@@ -343,11 +675,18 @@ class SqliteStorageDriver(MetadataStorageDriver):
         for ver in range(db_ver, CURRENT_DB_VERSION):
             schema = schemas[db_ver]
 
-            for query in schema:
-                self._conn.execute(query)
+            # Each version is applied and recorded in a transaction
+            # of its own. It must be committed: the connection would
+            # otherwise hold the write lock against the other
+            # threads' connections for as long as it lives
+            with self._conn:
+                self._conn.execute('BEGIN')
+
+                for query in schema:
+                    self._conn.execute(query)
 
-            db_ver = db_ver + 1
-            self._set_user_version(db_ver)
+                db_ver = db_ver + 1
+                self._set_user_version(db_ver)
 
     def _determine_marker(self, marker):
         """Determines the default marker to use if
@@ -361,9 +700,15 @@ class SqliteStorageDriver(MetadataStorageDriver):
             'projectid': deuce.context.project_id,
             'vaultid': vault_id
         }
-        self._conn.execute(SQL_CREATE_VAULT, args)
+        res = self._conn.execute(SQL_CREATE_VAULT, args)
+
+        # Only a new vault starts its counters at zero; one that
+        # already exists keeps its own, or has them counted when
+        # they are first asked for
+        if res.rowcount == 1:
+            self._conn.execute(SQL_CREATE_VAULT_STATS, args)
+
         self._conn.commit()
-        # TODO: check that one row was inserted
         return
 
     def delete_vault(self, vault_id):
@@ -374,6 +719,7 @@ class SqliteStorageDriver(MetadataStorageDriver):
         }
 
         self._conn.execute(SQL_DELETE_VAULT, args)
+        self._conn.execute(SQL_DELETE_VAULT_STATS, args)
         self._conn.commit()
         return
 
@@ -391,52 +737,44 @@ class SqliteStorageDriver(MetadataStorageDriver):
         res = self._conn.execute(SQL_GET_ALL_VAULT, args)
         return [row[0] for row in res]
 
-    def get_vault_statistics(self, vault_id):
-        """Return the statistics on the vault.
-
-        "param vault_id: The ID of the vault to gather statistics for"""
-        res = {}
-
+    def _get_vault_counters(self, vault_id):
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id
         }
 
-        def __stats_query(sql_statement, default_value):
-            result = self._conn.execute(sql_statement, args)
-
-            try:
-                row = next(result)
-                return row[0]
-
-            except StopIteration:  # pragma: no cover
-                return default_value
-
-            except IndexError:  # pragma: no cover
-                return default_value
-
-        def __stats_get_vault_file_count():
-            return __stats_query(SQL_GET_COUNT_ALL_FILES, 0)
-
-        def __stats_get_vault_block_count():
-            return __stats_query(SQL_GET_COUNT_ALL_BLOCKS, 0)
+        try:
+            return VaultCounters(*next(self._conn.execute(
+                SQL_GET_VAULT_STATS, args)))
+        except StopIteration:
+            return None
 
-        # Add any statistics regarding files
-        res['files'] = {}
-        res['files']['count'] = __stats_get_vault_file_count()
+    def _set_vault_counters(self, vault_id, counters):
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'files': counters.files,
+            'blocks': counters.blocks,
+            'bytes': counters.bytes,
+            'badblocks': counters.badblocks
+        }
 
-        # Add any statistics regarding blocks
-        res['blocks'] = {}
-        res['blocks']['count'] = __stats_get_vault_block_count()
+        self._conn.execute(SQL_SET_VAULT_STATS, args)
+        self._conn.commit()
 
-        # Add information about bad blocks and bad files
+    def _count_vault_statistics(self, vault_id):
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id
+        }
 
-        res['blocks']['bad'], res['files']['bad'] = \
-            self.vault_health(vault_id)
-        # Add any statistics specific to the Sqlite backend
-        res['internal'] = {}
+        def __stats_query(sql_statement):
+            return next(self._conn.execute(sql_statement, args))[0]
 
-        return res
+        return VaultCounters(
+            files=__stats_query(SQL_GET_COUNT_ALL_FILES),
+            blocks=__stats_query(SQL_GET_COUNT_ALL_BLOCKS),
+            bytes=__stats_query(SQL_GET_SUM_ALL_BLOCK_SIZES))
 
     def vault_health(self, vault_id):
         '''Returns the number of bad blocks and bad files associated
@@ -447,28 +785,14 @@ class SqliteStorageDriver(MetadataStorageDriver):
             vaultid=vault_id,
         )
 
-        res = self._conn.execute(SQL_GET_BAD_BLOCKS, args)
-
-        bad_blocks = [row[0] for row in res]
-
-        no_of_bad_blocks = len(bad_blocks)
+        no_of_bad_blocks = next(self._conn.execute(SQL_COUNT_BAD_BLOCKS,
+                                                   args))[0]
 
-        bad_files = set()
+        if no_of_bad_blocks == 0:
+            return (0, 0)
 
-        for block_id in bad_blocks:
-            args = dict(
-                projectid=deuce.context.project_id,
-                vaultid=vault_id,
-                blockid=block_id,
-            )
-            result = self._conn.execute(SQL_GET_FILE_PER_BLOCK, args)
-            bad_file = [row[0] for row in result]
-            try:
-                bad_files.add(bad_file[0])
-            except IndexError:
-                pass
-
-        no_of_bad_files = len(bad_files)
+        no_of_bad_files = next(self._conn.execute(SQL_COUNT_BAD_FILES,
+                                                  args))[0]
 
         return (no_of_bad_blocks, no_of_bad_files)
 
@@ -504,18 +828,41 @@ class SqliteStorageDriver(MetadataStorageDriver):
 
     def get_block_storage_id(self, vault_id, block_id):
         """Retrieve storage id for a given block id"""
-        args = {
-            'projectid': deuce.context.project_id,
-            'vaultid': vault_id,
-            'blockid': block_id
-        }
+        record = self._get_block_record(vault_id, block_id)
+        return record.storage_id if record else None
 
-        res = self._conn.execute(SQL_GET_STORAGE_ID, args)
-        try:
-            row = next(res)
-            return str(row[0])
-        except StopIteration:
-            return None
+    def _chunk_block_query(self, query, vault_id, block_ids):
+        """Yields (query, args) pairs that together cover block_ids,
+        for a query with an IN ({0}) placeholder for the block ids.
+        Each chunk stays within sqlite's limit on bound parameters"""
+        for start in range(0, len(block_ids), SQL_MAX_IN_ARGS):
+            chunk = block_ids[start:start + SQL_MAX_IN_ARGS]
+
+            args = {
+                'projectid': deuce.context.project_id,
+                'vaultid': vault_id
+            }
+            args.update(('blockid{0}'.format(n), block_id)
+                        for n, block_id in enumerate(chunk))
+
+            yield (query.format(', '.join(
+                ':blockid{0}'.format(n) for n in range(0, len(chunk)))),
+                args)
+
+    def _select_by_block_ids(self, query, vault_id, block_ids):
+        """Yields the rows of query over all of block_ids"""
+        for chunk_query, args in self._chunk_block_query(query, vault_id,
+                                                         block_ids):
+            for row in self._conn.execute(chunk_query, args):
+                yield row
+
+    def get_block_storage_ids(self, vault_id, block_ids):
+        """Retrieve storage ids for the given block ids"""
+        storage_ids = dict((row[0], str(row[1])) for row in
+                           self._select_by_block_ids(SQL_GET_STORAGE_IDS,
+                                                     vault_id, block_ids))
+
+        return [storage_ids.get(block_id) for block_id in block_ids]
 
     def get_block_metadata_id(self, vault_id, storage_id):
         """Retrieve block id for a given storage id"""
@@ -624,21 +971,13 @@ class SqliteStorageDriver(MetadataStorageDriver):
 
     def get_block_data(self, vault_id, block_id):
         """Returns the blocksize for this block"""
-        args = {
-            'projectid': deuce.context.project_id,
-            'vaultid': vault_id,
-            'blockid': block_id
-        }
-
-        res = self._conn.execute(SQL_GET_BLOCK, args)
+        record = self._get_block_record(vault_id, block_id)
 
-        try:
-            row = next(res)
-        except StopIteration:
+        if record is None or record.isinvalid:
             raise Exception("No such block: {0}".format(block_id))
 
         retval = {}
-        retval['blocksize'] = list(row)[0]
+        retval['blocksize'] = record.size
         return retval
 
     def get_file_data(self, vault_id, file_id):
@@ -667,54 +1006,43 @@ class SqliteStorageDriver(MetadataStorageDriver):
 
         self._conn.execute(SQL_MARK_BLOCK_AS_BAD, args)
         self._conn.commit()
+        self._invalidate_block(vault_id, block_id)
 
-    @staticmethod
-    def _block_exists(res, check_status):
-        if len(res) == 0:
-            return False
-
-        # The result should contain exactly
-        # one row and one column.
-        assert len(res) == 1
-        assert len(res[0]) == 1
-
-        if check_status and res[0][0] == 1:
-            return False
-
-        return True
-
-    def has_block(self, vault_id, block_id, check_status=False):
-        # Query the blocks table
-        retval = False
-
+    def _load_block_record(self, vault_id, block_id):
         args = {
             'projectid': deuce.context.project_id,
             'vaultid': vault_id,
             'blockid': block_id
         }
 
-        # This query should only ever return zero or 1 row, so
-        # return that value here
-        res = list(self._conn.execute(SQL_GET_BLOCK_STATUS, args))
+        res = self._conn.execute(SQL_GET_BLOCK_RECORD, args)
 
-        return SqliteStorageDriver._block_exists(res, check_status)
+        try:
+            row = next(res)
+        except StopIteration:
+            return None
 
-    def has_blocks(self, vault_id, block_ids, check_status=False):
-        results = []
+        return BlockRecord(str(row[0]), row[1], row[2] == 1)
 
-        for block_id in block_ids:
-            args = {
-                'projectid': deuce.context.project_id,
-                'vaultid': vault_id,
-                'blockid': block_id
-            }
+    def has_block(self, vault_id, block_id, check_status=False):
+        record = self._get_block_record(vault_id, block_id)
+
+        if record is None:
+            return False
+
+        return not (check_status and record.isinvalid)
+
+    def has_blocks(self, vault_id, block_ids, check_status=False):
+        statuses = dict(self._select_by_block_ids(SQL_GET_BLOCKS_STATUS,
+                                                  vault_id, block_ids))
 
-            res = list(self._conn.execute(SQL_GET_BLOCK_STATUS, args))
+        def exists(block_id):
+            if block_id not in statuses:
+                return False
 
-            if SqliteStorageDriver._block_exists(res, check_status) is False:
-                results.append(block_id)
+            return not (check_status and statuses[block_id] == 1)
 
-        return results
+        return [block_id for block_id in block_ids if not exists(block_id)]
 
     def create_block_generator(self, vault_id, marker=None,
             limit=None):
@@ -768,6 +1096,46 @@ class SqliteStorageDriver(MetadataStorageDriver):
 
         return [(row[0], row[1]) for row in query_res]
 
+    def get_file_manifest(self, vault_id, file_id):
+
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'fileid': file_id
+        }
+
+        res = list(self._conn.execute(SQL_GET_FILE_MANIFEST, args))
+
+        if not res:
+            return None
+
+        # Every row carries the file's columns; a file without any
+        # blocks comes back as a single row with no block columns
+        finalized, length = res[0][0], res[0][1]
+
+        blocks = [(row[2], row[3], row[4],
+                   str(row[5]) if row[5] is not None else None)
+                  for row in res if row[2] is not None]
+
+        return (bool(finalized), length or 0, blocks)
+
+    def get_file_block_offset(self, vault_id, file_id, position):
+
+        args = {
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'fileid': file_id,
+            'position': position
+        }
+
+        res = self._conn.execute(SQL_GET_FILE_BLOCK_OFFSET, args)
+
+        try:
+            row = next(res)
+            return row[0]
+        except StopIteration:
+            return None
+
     def assign_block(self, vault_id, file_id, block_id, offset):
         # TODO(jdp): tweak this to support multiple assignments
         args = {
@@ -787,27 +1155,31 @@ class SqliteStorageDriver(MetadataStorageDriver):
         self._conn.commit()
 
     def assign_blocks(self, vault_id, file_id, block_ids, offsets):
-        # TODO(jdp): tweak this to support multiple assignments
-
-        for block_id, offset in zip(block_ids, offsets):
-            args = {
-                'projectid': deuce.context.project_id,
-                'vaultid': vault_id,
-                'fileid': file_id,
-                'blockid': block_id,
-                'offset': offset
-            }
+        # All of the blocks are assigned in a single transaction
+        args = [{
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'fileid': file_id,
+            'blockid': block_id,
+            'offset': offset
+        } for block_id, offset in zip(block_ids, offsets)]
 
-            self._conn.execute(SQL_ASSIGN_BLOCK_TO_FILE, args)
+        self._conn.executemany(SQL_ASSIGN_BLOCK_TO_FILE, args)
 
-            del args['fileid']
-            del args['offset']
-            self._conn.execute(SQL_UPDATE_REF_TIME, args)
+        for query, args in self._chunk_block_query(SQL_UPDATE_REF_TIMES,
+                                                   vault_id,
+                                                   list(set(block_ids))):
+            self._conn.execute(query, args)
 
-            self._conn.commit()
+        self._conn.commit()
 
     def register_block(self, vault_id, block_id, storage_id, blocksize):
-        if not self.has_block(vault_id, block_id, check_status=True):
+        # Read the block afresh rather than from the block cache; a
+        # cached record may be stale if another worker unregistered
+        # the block or marked it as bad
+        record = self._load_block_record(vault_id, block_id)
+
+        if record is None or record.isinvalid:
             args = {
                 'projectid': deuce.context.project_id,
                 'vaultid': vault_id,
@@ -818,6 +1190,28 @@ class SqliteStorageDriver(MetadataStorageDriver):
 
             self._conn.execute(SQL_REGISTER_BLOCK, args)
             self._conn.commit()
+            self._invalidate_block(vault_id, block_id)
+
+    def register_blocks(self, vault_id, blocks):
+        missing = set(self.has_blocks(vault_id,
+                                      [block[0] for block in blocks],
+                                      check_status=True))
+
+        args = [{
+            'projectid': deuce.context.project_id,
+            'vaultid': vault_id,
+            'blockid': block_id,
+            'blocksize': int(blocksize),
+            'storageid': storage_id
+        } for block_id, storage_id, blocksize in blocks
+            if block_id in missing]
+
+        if args:
+            self._conn.executemany(SQL_REGISTER_BLOCK, args)
+            self._conn.commit()
+
+            for arg in args:
+                self._invalidate_block(vault_id, arg['blockid'])
 
     def unregister_block(self, vault_id, block_id):
 
@@ -831,6 +1225,7 @@ class SqliteStorageDriver(MetadataStorageDriver):
 
         self._conn.execute(SQL_UNREGISTER_BLOCK, args)
         self._conn.commit()
+        self._invalidate_block(vault_id, block_id)
 
     def get_block_ref_count(self, vault_id, block_id):
 
@@ -842,9 +1237,24 @@ class SqliteStorageDriver(MetadataStorageDriver):
 
         query_res = self._conn.execute(SQL_GET_BLOCK_REF_COUNT, args)
 
-        count = next(query_res)[0]
+        try:
+            return next(query_res)[0]
+        except StopIteration:
+            return 0
+
+    def repair_block_ref_counts(self):
+        """Recomputes every block's reference count from the
+        fileblocks table, in case the counts have drifted.
+
+        :returns: The number of blocks whose count was wrong"""
+        wrong = next(self._conn.execute(SQL_COUNT_WRONG_BLOCK_REFS))[0]
+        stale = next(self._conn.execute(SQL_COUNT_STALE_BLOCK_REFS))[0]
+
+        self._conn.execute(SQL_DELETE_ALL_BLOCK_REFS)
+        self._conn.execute(SQL_RECOMPUTE_BLOCK_REFS)
+        self._conn.commit()
 
-        return count if not None else 0
+        return wrong + stale
 
     def get_block_ref_modified(self, vault_id, block_id):
 
@@ -11,8 +11,6 @@ from deuce.util import log
 logger = log.getLogger(__name__)
 from swiftclient.exceptions import ClientException
 
-from six import BytesIO
-
 import deuce
 
 
@@ -62,8 +60,9 @@ class SwiftStorageDriver(BlockStorageDriver):
         except ClientException:
             return False
 
-    def get_vault_statistics(self, vault_id):
-        """Return the statistics on the vault.
+    def get_vault_statistics(self, vault_id, recompute=False):
+        """Return the statistics on the vault. Swift keeps the
+        container totals itself, so recompute has no effect.
 
         "param vault_id: The ID of the vault to gather statistics for"""
 
@@ -114,13 +113,11 @@ class SwiftStorageDriver(BlockStorageDriver):
 
     # =========== BLOCKS ===============================
 
-    def store_block(self, vault_id, metadata_block_id, blockdata):
+    def store_block(self, vault_id, metadata_block_id, blockdata,
+                    md5=None):
         try:
             response = dict()
-            mdhash = hashlib.md5()
-
-            mdhash.update(blockdata)
-            mdetag = mdhash.hexdigest()
+            mdetag = md5 or hashlib.md5(blockdata).hexdigest()
             storage_id = self.storage_id(metadata_block_id)
             ret_etag = self.Conn.put_object(
                 url=deuce.context.openstack.swift.storage_url,
@@ -136,20 +133,28 @@ class SwiftStorageDriver(BlockStorageDriver):
         except ClientException:
             return (False, '')
 
-    def store_async_block(self, vault_id, metadata_block_ids, blockdatas):
+    def store_async_block(self, vault_id, metadata_block_ids, blockdatas,
+                          md5s=None):
         try:
             response = dict()
             storage_ids = [self.storage_id(metadata_block_id)
                            for metadata_block_id in metadata_block_ids]
-            rets = self.Conn.put_async_object(
+            statuses = self.Conn.put_async_object(
                 url=deuce.context.openstack.swift.storage_url,
                 token=deuce.context.openstack.auth_token,
                 container=vault_id,
                 names=storage_ids,
                 contents=blockdatas,
-                etag=True,
+                etag=md5s or True,
                 response_dict=response)
-            return (response['status'] == 201, storage_ids)
+
+            # Swift checks each object against its Etag, so an
+            # object it created is stored intact
+            storage_ids = [storage_id if status == 201 else None
+                           for storage_id, status
+                           in zip(storage_ids, statuses)]
+
+            return (None not in storage_ids, storage_ids)
         except ClientException:
             return (False, [])
 
@@ -184,24 +189,25 @@ class SwiftStorageDriver(BlockStorageDriver):
 
     def get_block_obj(self, vault_id, storage_block_id):
 
-        buff = BytesIO()
         response = dict()
 
         try:
             # NOTE(TheSriram): block is a tuple of
-            # headers and response body.
+            # headers and response body. The body is streamed,
+            # so it is read off the connection as the caller
+            # reads it, rather than being held in memory
             block = self.Conn.get_object(
                 url=deuce.context.openstack.swift.storage_url,
                 token=deuce.context.openstack.auth_token,
                 container=vault_id,
                 name=str(storage_block_id),
-                response_dict=response)
+                response_dict=response,
+                stream=True)
 
             if response['status'] >= 200 and response['status'] < 300:
-                buff.write(block[1])
-                buff.seek(0)
-                return buff
+                return block[1]
             else:
+                block[1].close()
                 return None
 
         except ClientException:
@@ -209,20 +215,16 @@ class SwiftStorageDriver(BlockStorageDriver):
 
     def get_block_object_length(self, vault_id, storage_block_id):
         """Returns the length of an object"""
-        response = dict()
         try:
-            # NOTE(TheSriram): block is a tuple of
-            # headers and response body
-            block = \
-                self.Conn.get_object(
-                    url=deuce.context.openstack.swift.storage_url,
-                    token=deuce.context.openstack.auth_token,
-                    container=vault_id,
-                    name=str(storage_block_id),
-                    response_dict=response)
-
-            return len(block[1]) if (response['status'] >= 200
-                                     and response['status'] < 300) else 0
+            # The object's headers carry its length, so there is
+            # no need to fetch its data
+            headers = self.Conn.head_object(
+                url=deuce.context.openstack.swift.storage_url,
+                token=deuce.context.openstack.auth_token,
+                container=vault_id,
+                name=str(storage_block_id))
+
+            return int(headers.get('content-length', 0))
 
         except ClientException:
             return 0
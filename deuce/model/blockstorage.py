@@ -108,7 +108,7 @@ class BlockStorage(object):
                      storage_block_id=storage_block_id) if obj else None
 
     def get_blocks_generator(self, marker, limit):
-        return (BlockStorage(Vault.get(self.vault_id), storage_block_id)
+        return (BlockStorage(self.Vault, storage_block_id)
                 for storage_block_id in
                 deuce.storage_driver.get_vault_block_list(self.vault_id,
                                                           limit,
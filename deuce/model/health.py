@@ -5,4 +5,8 @@ class Health(object):
 
     @staticmethod
     def health():
-        return deuce.metadata_driver.get_health()
+        stats = deuce.metadata_driver.block_cache.stats()
+
+        return deuce.metadata_driver.get_health() + [
+            "block metadata cache: {hits} hits, {misses} misses, "
+            "{size}/{maxsize} entries".format(**stats)]
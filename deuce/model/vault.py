@@ -2,24 +2,58 @@ from deuce.model.block import Block
 from deuce.model.file import File
 from deuce.model.exceptions import ConsistencyError
 from deuce.util import log as logging
+from deuce.util import LRUCache
+from deuce.util import digest
 
+from deuce import conf
 import deuce
 import uuid
-import hashlib
 
 
 logger = logging.getLogger(__name__)
 
+# Vault existence cached across requests, keyed by
+# (project_id, vault_id). A ttl of zero disables it.
+_vault_cache = LRUCache(
+    conf.block_storage_driver.vault_cache.maxsize
+    if conf.block_storage_driver.vault_cache.ttl else 0,
+    conf.block_storage_driver.vault_cache.ttl)
+
+
+def _request_vaults():
+    """Returns the vault existence checks already made by
+    the current request"""
+    try:
+        return deuce.context.vaults
+    except AttributeError:
+        deuce.context.vaults = {}
+        return deuce.context.vaults
+
 
 class Vault(object):
 
     @staticmethod
     def get(vault_id):
+        key = (deuce.context.project_id, vault_id)
+        checked = _request_vaults()
+
+        exists = checked.get(key)
+
+        if exists is None:
+            exists = _vault_cache.get(key)
+
+        if exists is None:
+            exists = bool(deuce.storage_driver.vault_exists(vault_id))
 
-        if deuce.storage_driver.vault_exists(vault_id):
-            return Vault(vault_id)
+            if exists:
+                _vault_cache.put(key, True)
+            elif conf.block_storage_driver.vault_cache.negative_ttl:
+                _vault_cache.put(key, False,
+                    ttl=conf.block_storage_driver.vault_cache.negative_ttl)
 
-        return None
+        checked[key] = exists
+
+        return Vault(vault_id) if exists else None
 
     @staticmethod
     def get_vaults_generator(marker, limit):
@@ -31,6 +65,11 @@ class Vault(object):
         """Creates the vault with the specified vault_id"""
         deuce.storage_driver.create_vault(vault_id)
         deuce.metadata_driver.create_vault(vault_id)
+
+        key = (deuce.context.project_id, vault_id)
+        _vault_cache.invalidate(key)
+        _request_vaults()[key] = True
+
         return Vault(vault_id)
 
     def __init__(self, vault_id):
@@ -39,29 +78,30 @@ class Vault(object):
     def _get_storage_id(self, block_id):
         return deuce.metadata_driver.get_block_storage_id(self.id, block_id)
 
-    def get_vault_statistics(self):
+    def get_vault_statistics(self, recompute=False):
         # Get information about the vault
         # - number of files
         # - number of blocks
         # - total size
         # - etc
+        # The drivers keep running totals; recompute audits them
+        # by counting everything again
         vault_stats = {}
 
         metadata_info = deuce.metadata_driver
         storage_info = deuce.storage_driver
 
         vault_stats['metadata'] = metadata_info.get_vault_statistics(
-            self.id)
+            self.id, recompute=recompute)
         vault_stats['storage'] = storage_info.get_vault_statistics(
-            self.id)
+            self.id, recompute=recompute)
 
         return vault_stats
 
     def put_block(self, block_id, blockdata, data_len):
 
         # Validate the hash of the block data against block_id
-        if hashlib.sha1(blockdata).hexdigest() != block_id:
-            raise ValueError('Invalid Hash Value in the block ID')
+        md5s = digest.verify_blocks([block_id], [blockdata])
 
         actual_block_length = len(blockdata)
         if actual_block_length != data_len:
@@ -71,7 +111,7 @@ class Vault(object):
                     data_len, actual_block_length))
 
         retval, storage_id = deuce.storage_driver.store_block(
-            self.id, block_id, blockdata)
+            self.id, block_id, blockdata, md5=md5s[0])
 
         if retval:
             deuce.metadata_driver.register_block(
@@ -80,40 +120,41 @@ class Vault(object):
         return (retval, storage_id)
 
     def put_async_block(self, block_ids, blockdatas):
+        """Stores and registers the blocks.
+
+        :returns: The ids of the blocks that were stored. Any
+            other block failed to store and was not registered"""
         block_ids = [block_id.decode() for block_id in block_ids]
         block_sizes = [len(block_data) for block_data in blockdatas]
 
-        # Validate the hash of the block data against block_id
-        for block_id, blockdata in zip(block_ids, blockdatas):
-            if hashlib.sha1(blockdata).hexdigest() != block_id:
-                raise ValueError('Invalid Hash Value in the block ID')
+        # Validate the hash of the block data against block_id. The
+        # MD5s come out of the same pass and are handed to storage
+        md5s = digest.verify_blocks(block_ids, blockdatas)
 
         retval, storage_ids = deuce.storage_driver.store_async_block(
             self.id,
             block_ids,
-            blockdatas)
-
-        # (BenjamenMeyer): If we fail to upload any one block then we
-        # let the Validation and Clean-Up Service remove any uploaded blocks
-        # and fail out the request as a whole
-        if retval:
-            # Note: zip() will produce a list of the shortest combination.
-            # That is, if a = (1, 2, 3) and b = (a, b) then
-            # zip(a, b) = ((1, a), (2, b)). If 'a' is the storage id for '2'
-            # because '1' failed to be stored, then the entire list is
-            # improperly shifted and we incorrectly report which blocks were
-            # saved, thus corrupting the data
-            for block_id, storageid, blockdata, block_size in zip(block_ids,
-                                                                  storage_ids,
-                                                                  blockdatas,
-                                                                  block_sizes):
-                deuce.metadata_driver.register_block(
-                    self.id,
-                    block_id,
-                    storageid,
-                    block_size)
-
-        return retval
+            blockdatas,
+            md5s=md5s)
+
+        # Only the blocks that made it to storage are registered, the
+        # caller is told which ones did so that it can retry the rest.
+        # Storage reports None for a block it failed to store, or no
+        # storage ids at all if it does not know of any stored block.
+        #
+        # Note: zip() will produce a list of the shortest combination.
+        # That is, if a = (1, 2, 3) and b = (a, b) then
+        # zip(a, b) = ((1, a), (2, b)). The storage ids must therefore
+        # line up with the block ids, or be empty.
+        stored = [(block_id, storage_id, block_size)
+                  for block_id, storage_id, block_size
+                  in zip(block_ids, storage_ids, block_sizes)
+                  if storage_id is not None]
+
+        if stored:
+            deuce.metadata_driver.register_blocks(self.id, stored)
+
+        return [block_id for block_id, storage_id, block_size in stored]
 
     def get_blocks(self, marker, limit):
         gen = deuce.metadata_driver.create_block_generator(
@@ -154,9 +195,10 @@ class Vault(object):
 
         return Block(self.id, block_id, obj) if obj else None
 
-    def get_blocks_generator(self, block_ids):
-        storage_ids = [
-            self._get_storage_id(block_id) for block_id in block_ids]
+    def get_blocks_generator(self, block_ids, storage_ids=None):
+        if storage_ids is None:
+            storage_ids = deuce.metadata_driver.get_block_storage_ids(
+                self.id, list(block_ids))
         return deuce.storage_driver.create_blocks_generator(
             self.id, storage_ids)
 
@@ -195,10 +237,47 @@ class Vault(object):
     def get_file_length(self, file_id):
         return deuce.metadata_driver.file_length(self.id, file_id)
 
+    def get_file_manifest(self, file_id):
+        return deuce.metadata_driver.get_file_manifest(self.id, file_id)
+
+    def get_file_range_generator(self, file_id, first, last):
+        """Returns a generator of (block_id, offset) tuples for the
+        blocks of the file that hold bytes first through last
+        (inclusive), ordered by offset.
+
+        The first block is found with a seek on the offset index and
+        the rest are read in pages from there, so blocks before or
+        after the range are never looked at"""
+        marker = deuce.metadata_driver.get_file_block_offset(
+            self.id, file_id, first)
+
+        if marker is None:
+            return
+
+        limit = conf.api_configuration.max_returned_num
+
+        while True:
+            blocks = list(deuce.metadata_driver.create_file_block_generator(
+                self.id, file_id, offset=marker, limit=limit))
+
+            for block_id, offset in blocks:
+                if offset > last:
+                    return
+                yield (block_id, offset)
+
+            if len(blocks) < limit:
+                return
+
+            marker = blocks[-1][1] + 1
+
     def delete(self):
         succ = deuce.storage_driver.delete_vault(self.id)
         if succ:
             deuce.metadata_driver.delete_vault(self.id)
+
+            key = (deuce.context.project_id, self.id)
+            _vault_cache.invalidate(key)
+            _request_vaults().pop(key, None)
         return succ
 
     def delete_file(self, file_id):
@@ -5,7 +5,118 @@
 #
 # Or from a mocking package...
 
+from mongomock import DuplicateKeyError
+from mongomock.collection import Collection
 from mongomock.connection import Connection
+from mongomock.database import Database
+
+# Applies a write the way the server would, whatever a test
+# patches Collection.update with to watch the driver's writes
+_apply_update = Collection.update
+
+
+class BulkWriteError(Exception):
+    """Stands in for pymongo.errors.BulkWriteError"""
+
+    def __init__(self, details):
+        super(BulkWriteError, self).__init__('batch op errors occurred')
+        self.details = details
+
+
+class errors(object):
+    """Stands in for pymongo.errors"""
+    DuplicateKeyError = DuplicateKeyError
+    BulkWriteError = BulkWriteError
+
+
+class Mock_BulkOperation(object):
+    """A single find() of a Mock_BulkOperationBuilder"""
+
+    def __init__(self, ops, selector):
+        self._ops = ops
+        self._selector = selector
+        self._upsert = False
+
+    def upsert(self):
+        self._upsert = True
+        return self
+
+    def update_one(self, document):
+        self._ops.append((self._selector, document, self._upsert))
+
+
+class Mock_BulkOperationBuilder(object):
+    """Stands in for pymongo's unordered BulkOperationBuilder, for
+    updates only. The whole batch is sent with one execute()"""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._ops = []
+
+    def find(self, selector):
+        return Mock_BulkOperation(self._ops, selector)
+
+    def execute(self):
+        result = {'nMatched': 0, 'nUpserted': 0, 'upserted': [],
+                  'writeErrors': []}
+
+        for index, (selector, document, upsert) in enumerate(self._ops):
+            try:
+                res = _apply_update(self._collection, selector, document,
+                                    upsert=upsert)
+            except DuplicateKeyError as ex:
+                result['writeErrors'].append(
+                    {'index': index, 'code': 11000, 'errmsg': str(ex)})
+                continue
+
+            if res['updatedExisting']:
+                result['nMatched'] += res['n']
+            elif res['n']:
+                result['nUpserted'] += 1
+                result['upserted'].append({'index': index})
+
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+
+        return result
+
+
+class Mock_Collection(Collection):
+
+    def __init__(self, db, name):
+        super(Mock_Collection, self).__init__(db, name)
+        self._indexes = {}
+
+    def initialize_unordered_bulk_op(self):
+        return Mock_BulkOperationBuilder(self)
+
+    def ensure_index(self, key_or_list, unique=False, **kwargs):
+        """Records the index, so that index_information() reports
+        it. The index is not enforced"""
+        name = '_'.join('{0}_{1}'.format(*key) for key in key_or_list)
+
+        self._indexes[name] = {'key': list(key_or_list)}
+        if unique:
+            self._indexes[name]['unique'] = True
+
+        return name
+
+    def drop_index(self, index_or_name):
+        self._indexes.pop(index_or_name, None)
+
+    def index_information(self):
+        return dict((name, dict(index))
+                    for name, index in self._indexes.items())
+
+
+class Mock_Database(Database):
+
+    def __getitem__(self, coll_name):
+        coll = self._collections.get(coll_name, None)
+        if coll is None:
+            coll = self._collections[coll_name] = \
+                Mock_Collection(self, coll_name)
+        return coll
 
 
 class Mock_Connection(Connection):
@@ -13,6 +124,12 @@ class Mock_Connection(Connection):
     def __init__(self, *args, **kwargs):
         super(Mock_Connection, self).__init__(*args, **kwargs)
 
+    def __getitem__(self, db_name):
+        db = self._databases.get(db_name, None)
+        if db is None:
+            db = self._databases[db_name] = Mock_Database(self, db_name)
+        return db
+
     def alive(self):
         """The original MongoConnection.alive method checks the
         status of the server.
@@ -210,10 +210,12 @@ def put_async_object(url,
         with open(path, 'wb') as outfile:
             outfile.write(content)
 
-        mdhash = hashlib.md5()
-        etags.append(mdhash.update(content))
+        if isinstance(etag, (list, tuple)):
+            etags.append(etag[len(etags)])
+        else:
+            etags.append(hashlib.md5(content).hexdigest())
     response_dict['status'] = 201
-    return etags
+    return [201] * len(etags)
 
 
 # Check Block
@@ -225,7 +227,7 @@ def head_object(url,
     path = _get_block_path(container, name)
     if not os.path.exists(path):
         raise ClientException('mocking')
-    return 'mocking_ret'
+    return {'content-length': str(os.path.getsize(path))}
 
 
 # Delete Block
@@ -253,7 +255,8 @@ def get_object(url,
             token,
             container,
             name,
-            response_dict):
+            response_dict,
+            stream=False):
 
     path = _get_block_path(container, name)
 
@@ -280,6 +283,10 @@ def get_object(url,
         pass
 
     response_dict['status'] = _mock_status_code()
+
+    if stream:
+        return hdrs, io.BytesIO(buff or b'')
+
     return hdrs, buff
 
 
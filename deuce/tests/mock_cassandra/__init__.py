@@ -3,6 +3,8 @@ import deuce.drivers.cassandra.cassandrametadatadriver \
 
 import uuid
 
+from deuce.tests.mock_cassandra.query import PreparedStatement
+
 
 class ConsistencyLevel(object):
 
@@ -37,7 +39,13 @@ class Session(object):
     def __init__(self, conn):
         self.conn = conn
 
+    def prepare(self, query):
+        return PreparedStatement(query)
+
     def execute(self, query, queryargs):
+        if isinstance(query, PreparedStatement):
+            query = query.query_string
+
         # Health check.
         if 'system.local' in query:
             return 'true'
@@ -58,15 +66,10 @@ class Session(object):
 
         elif isinstance(queryargs, dict):
 
-            # If the user passed dictionary arguments, assume that they
-            # used that cassandra %(fieldname)s and convert to sqlite's
-            # :fieldname
+            # Prepared statements use cassandra's :fieldname markers,
+            # which sqlite understands as they are
 
             for k, v in queryargs.items():
-                cass_style_arg = "%({0})s".format(k)
-                sqlite_style_arg = ":{0}".format(k)
-                query = query.replace(cass_style_arg, sqlite_style_arg)
-
                 # Convert UUID parameters to strings
                 if isinstance(v, uuid.UUID):
                     queryargs[k] = str(v)
@@ -89,6 +92,19 @@ class Session(object):
 
             self.conn.execute(insert_query, insert_args)
 
+        elif original_query == actual_driver.CQL_INC_VAULT_STATS:
+
+            # Counter updates create the row, as above
+
+            insert_query = """
+                INSERT or IGNORE into vaultstats
+                (projectid, vaultid, files, blocks, bytes, badblocks)
+                VALUES
+                (:projectid, :vaultid, 0, 0, 0, 0)
+            """
+
+            self.conn.execute(insert_query, queryargs)
+
         elif original_query == actual_driver.CQL_REGISTER_BLOCK:
 
             # Cassandra's inserts by default are upserts, when mocked with
@@ -115,6 +131,22 @@ class Session(object):
             upsert_args = queryargs.copy()
             self.conn.execute(upsert_query, upsert_args)
 
+        elif original_query == actual_driver.CQL_CREATE_VAULT:
+
+            # A lightweight transaction, which tells whether the
+            # row was inserted
+            insert_query = query.replace('INSERT INTO',
+                                         'INSERT OR IGNORE INTO')
+            insert_query = insert_query.replace('IF NOT EXISTS', '')
+
+            cursor = self.conn.execute(insert_query, queryargs)
+            res = [(cursor.rowcount == 1,)]
+
+        elif original_query == actual_driver.CQL_ADD_BAD_FILE:
+
+            # Another upsert
+            query = query.replace('INSERT INTO', 'INSERT OR REPLACE INTO')
+
         elif original_query == actual_driver.CQL_UPDATE_REF_TIME or \
                 original_query == actual_driver.CQL_REGISTER_BLOCK:
 
@@ -129,7 +161,8 @@ class Session(object):
             query = "SELECT strftime('%s', 'now')"
 
         if original_query not in [actual_driver.CQL_REGISTER_BLOCK,
-                                  actual_driver.CQL_REGISTER_FILE_TO_BLOCK]:
+                                  actual_driver.CQL_REGISTER_FILE_TO_BLOCK,
+                                  actual_driver.CQL_CREATE_VAULT]:
             res = self.conn.execute(query, queryargs)
             res = list(res)
 
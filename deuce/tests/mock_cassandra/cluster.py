@@ -58,6 +58,24 @@ CREATE TABLE blockreferences (
   refcount INTEGER,
   PRIMARY KEY(projectid, vaultid, blockid)
 );
+""", """
+CREATE TABLE badfiles (
+  projectid TEXT,
+  vaultid TEXT,
+  fileid TEXT,
+  blockid TEXT,
+  PRIMARY KEY(projectid, vaultid, fileid, blockid)
+);
+""", """
+CREATE TABLE vaultstats (
+  projectid TEXT,
+  vaultid TEXT,
+  files INTEGER,
+  blocks INTEGER,
+  bytes INTEGER,
+  badblocks INTEGER,
+  PRIMARY KEY(projectid, vaultid)
+);
 """]
 
 from deuce.tests.mock_cassandra import Session
@@ -65,7 +83,8 @@ from deuce.tests.mock_cassandra import Session
 
 class Cluster(object):
 
-    def __init__(self, contact_points, auth_provider, ssl_options):
+    def __init__(self, contact_points, auth_provider, ssl_options,
+                 load_balancing_policy=None):
         # Create the mock driver in memory only
         self._sqliteconn = sqlite3.connect(':memory:')
         self.cluster_contact_points = contact_points
@@ -0,0 +1,20 @@
+from collections import namedtuple
+
+ExecutionResult = namedtuple('ExecutionResult', ['success', 'result_or_exc'])
+
+
+def execute_concurrent(session, statements_and_parameters, concurrency=100,
+                       raise_on_first_error=True, results_generator=False):
+    # sqlite is synchronous, so the statements simply run in order
+    results = []
+
+    for statement, parameters in statements_and_parameters:
+        try:
+            results.append(ExecutionResult(
+                True, session.execute(statement, parameters)))
+        except Exception as ex:
+            if raise_on_first_error:
+                raise
+            results.append(ExecutionResult(False, ex))
+
+    return results
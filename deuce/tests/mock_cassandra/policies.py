@@ -0,0 +1,11 @@
+
+class DCAwareRoundRobinPolicy(object):
+
+    def __init__(self, local_dc=''):
+        self.local_dc = local_dc
+
+
+class TokenAwarePolicy(object):
+
+    def __init__(self, child_policy):
+        self._child_policy = child_policy
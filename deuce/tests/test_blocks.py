@@ -216,6 +216,43 @@ class TestBlocksController(ControllerTest):
                                       body='non-msgpack')
         self.assertEqual(self.srmock.status, falcon.HTTP_400)
 
+    def test_post_in_batches(self):
+        from deuce.model import Vault
+
+        headers = {
+            "Content-Type": "application/msgpack",
+        }
+        headers.update(self._hdrs)
+        data = [os.urandom(x) for x in range(1, 6)]
+        block_list = [self.calc_sha1(d) for d in data]
+
+        request_body = msgpack.packb(dict(zip(block_list, data)))
+
+        # The blocks are stored two at a time as they are decoded
+        with patch('deuce.conf.api_configuration.max_blocks_in_flight', 2):
+            with patch.object(Vault, 'put_async_block',
+                              autospec=True,
+                              side_effect=Vault.put_async_block) as put:
+                self.simulate_post(self.get_blocks_path(self.vault_name),
+                                   headers=headers,
+                                   body=request_body)
+
+        self.assertEqual(self.srmock.status, falcon.HTTP_201)
+        self.assertEqual([len(call[0][1]) for call in put.call_args_list],
+                         [2, 2, 1])
+
+        for block_id in block_list:
+            self.simulate_head(self.get_block_path(self.vault_name,
+                                                   block_id),
+                               headers=self._hdrs)
+            self.assertEqual(self.srmock.status, falcon.HTTP_204)
+
+        # A truncated body is rejected
+        self.simulate_post(self.get_blocks_path(self.vault_name),
+                           headers=headers,
+                           body=request_body[:-1])
+        self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
     def test_post_invalid_endpoint(self):
         path = self.get_blocks_path(self.vault_name)
 
@@ -434,6 +471,49 @@ class TestBlocksController(ControllerTest):
             self.helper_create_blocks(1, async=True)
             self.assertEqual(self.srmock.status, falcon.HTTP_500)
 
+    def test_vault_async_storage_partial_failure(self):
+        import deuce
+
+        headers = {
+            "Content-Type": "application/msgpack",
+        }
+        headers.update(self._hdrs)
+        data = [os.urandom(x) for x in range(1, 4)]
+        block_list = [self.calc_sha1(d) for d in data]
+        failed_block = block_list[1]
+
+        request_body = msgpack.packb(dict(zip(block_list, data)))
+
+        store_async_block = deuce.storage_driver.store_async_block
+
+        def store(vault_id, block_ids, blockdatas, md5s=None):
+            retval, storage_ids = store_async_block(vault_id, block_ids,
+                                                    blockdatas, md5s=md5s)
+            return (False, [None if block_id == failed_block
+                            else storage_id
+                            for block_id, storage_id
+                            in zip(block_ids, storage_ids)])
+
+        with patch.object(deuce.storage_driver, 'store_async_block',
+                          side_effect=store):
+            response = self.simulate_post(
+                self.get_blocks_path(self.vault_name),
+                headers=headers,
+                body=request_body)
+
+        # The failed block is reported back, the others are stored
+        # and registered
+        self.assertEqual(self.srmock.status, falcon.HTTP_500)
+        self.assertIn(failed_block, response[0].decode())
+
+        for block_id in block_list:
+            self.simulate_head(self.get_block_path(self.vault_name,
+                                                   block_id),
+                               headers=self._hdrs)
+            self.assertEqual(self.srmock.status,
+                             falcon.HTTP_404 if block_id == failed_block
+                             else falcon.HTTP_204)
+
     def helper_create_blocks(self, num_blocks, async=False,
                              singleblocksize=False, blocksize=100):
         min_size = 1
@@ -25,6 +25,14 @@ class CassandraStorageDriverTest(SqliteStorageDriverTest):
     def create_driver(self):
         return CassandraStorageDriver()
 
+    def forget_vault_counters(self, driver, vault_id):
+        if cassandra_mock is False:
+            raise unittest.SkipTest('Counter rows cannot be reliably '
+                                    'deleted from a real Cassandra')
+
+        driver._session.conn.execute(
+            'DELETE FROM vaultstats WHERE vaultid = ?', (vault_id,))
+
     @unittest.skipIf(cassandra_mock is False
        and ssl_enabled is False,
        "Don't run the test if we are running without SSL")
@@ -53,8 +61,10 @@ class CassandraStorageDriverTest(SqliteStorageDriverTest):
             conf.metadata_driver.cassandra.db_module)
         cassandra_auth = importlib.import_module(
             '{0}.auth'.format(conf.metadata_driver.cassandra.db_module))
-        cassandra_query = importlib.import_module(
-            '{0}.query'.format(conf.metadata_driver.cassandra.db_module))
+        cassandra_policies = importlib.import_module(
+            '{0}.policies'.format(conf.metadata_driver.cassandra.db_module))
+        cassandra_concurrent = importlib.import_module(
+            '{0}.concurrent'.format(conf.metadata_driver.cassandra.db_module))
 
         # Mock importlib so we can control the cassandra cluster import
         with patch('importlib.import_module') as mock_importlib:
@@ -62,7 +72,8 @@ class CassandraStorageDriverTest(SqliteStorageDriverTest):
                 cassandra_driver,
                 MagicMock(),
                 cassandra_auth,
-                cassandra_query
+                cassandra_policies,
+                cassandra_concurrent
             ]
             # override the connect method so it doesn't actually do anything
             mock_importlib.return_value[1].connect = MagicMock()
@@ -70,3 +81,163 @@ class CassandraStorageDriverTest(SqliteStorageDriverTest):
 
             conf.metadata_driver.cassandra.cluster = contact_points
             return CassandraStorageDriver()
+
+    @unittest.skipIf(cassandra_mock is False,
+    "Dont run the test if we are against non-mocked Cassandra")
+    def test_prepared_statements(self):
+        from deuce.drivers.cassandra import cassandrametadatadriver as cql
+
+        driver = self.create_driver()
+
+        queries = [value for name, value in vars(cql).items()
+                   if name.startswith('CQL_')]
+
+        # Every statement is prepared once, with the configured
+        # consistency level
+        self.assertEqual(sorted(driver._statements), sorted(queries))
+
+        for statement in driver._statements.values():
+            self.assertEqual(statement.consistency_level,
+                             driver.consistency_level)
+
+        executed = []
+        execute = driver._session.execute
+
+        def record(query, args):
+            executed.append(query)
+            return execute(query, args)
+
+        with patch.object(driver._session, 'prepare') as prepare:
+            with patch.object(driver._session, 'execute',
+                              side_effect=record):
+                vault_id = self.create_vault_id()
+                driver.create_vault(vault_id)
+                file_id = self.create_file_id()
+                driver.create_file(vault_id, file_id)
+                driver.get_file_data(vault_id, file_id)
+                driver.delete_file(vault_id, file_id)
+                driver.delete_vault(vault_id)
+
+            self.assertFalse(prepare.called)
+
+        prepared = set(id(s) for s in driver._statements.values())
+        self.assertTrue(executed)
+        self.assertTrue(all(id(q) in prepared for q in executed))
+
+    def test_assign_blocks_pipeline(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        driver.create_vault(vault_id)
+        driver.create_file(vault_id, file_id)
+
+        block_ids = [self.create_block_id() for _ in range(10)]
+        driver.register_blocks(vault_id,
+                               [(block_id, self.create_storage_block_id(),
+                                 100) for block_id in block_ids])
+        driver.mark_block_as_bad(vault_id, block_ids[0])
+
+        calls = []
+        execute_concurrent = driver._concurrent.execute_concurrent
+
+        def record(session, statements_and_args, concurrency,
+                   raise_on_first_error):
+            calls.append(concurrency)
+            return execute_concurrent(session, statements_and_args,
+                                      concurrency, raise_on_first_error)
+
+        with patch.object(conf.metadata_driver.cassandra, 'concurrency', 3):
+            with patch.object(driver._concurrent, 'execute_concurrent',
+                              side_effect=record):
+                driver.assign_blocks(vault_id, file_id, block_ids,
+                                     [n * 100 for n in range(10)])
+
+        # One read of the blocks, then a single bounded pipeline for
+        # every write
+        self.assertEqual(calls, [3, 3])
+
+        for block_id in block_ids:
+            self.assertEqual(driver.get_block_ref_count(vault_id, block_id),
+                             1)
+
+        self.assertEqual(driver.vault_health(vault_id), (1, 1))
+        self.assertEqual(
+            [block[0] for block in driver.create_file_block_generator(
+                vault_id, file_id)],
+            block_ids)
+
+    def test_paged_generators(self):
+        driver = self.create_driver()
+
+        for statement in driver._statements.values():
+            self.assertEqual(statement.fetch_size,
+                             conf.metadata_driver.cassandra.fetch_size)
+
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        driver.create_vault(vault_id)
+        driver.create_file(vault_id, file_id)
+
+        block_ids = [self.create_block_id() for _ in range(10)]
+        driver.register_blocks(vault_id,
+                               [(block_id, self.create_storage_block_id(),
+                                 100) for block_id in block_ids])
+        driver.assign_blocks(vault_id, file_id, block_ids,
+                             [n * 100 for n in range(10)])
+
+        consumed = []
+        execute = driver._session.execute
+
+        def rows(query, args):
+            # Stands in for the driver's ResultSet, which fetches
+            # further pages as it is iterated
+            for row in execute(query, args):
+                consumed.append(row)
+                yield row
+
+        with patch.object(driver._session, 'execute', side_effect=rows):
+            for gen in (driver.create_block_generator(vault_id),
+                        driver.create_file_generator(vault_id,
+                                                     finalized=False),
+                        driver.create_file_block_generator(vault_id,
+                                                           file_id)):
+                del consumed[:]
+                next(gen)
+                self.assertEqual(len(consumed), 1)
+                gen.close()
+
+        # Finalize and delete work through the fileblocks a page
+        # at a time
+        with patch.object(conf.metadata_driver.cassandra, 'fetch_size', 3):
+            driver.finalize_file(vault_id, file_id, 1000)
+            self.assertTrue(driver.is_finalized(vault_id, file_id))
+
+            driver.delete_file(vault_id, file_id)
+
+        for block_id in block_ids:
+            self.assertEqual(driver.get_block_ref_count(vault_id, block_id),
+                             0)
+
+    def test_file_generator_marker(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        file_ids = [self.create_file_id() for _ in range(0, 6)]
+
+        for file_id in file_ids:
+            driver.create_file(vault_id, file_id)
+            driver.finalize_file(vault_id, file_id)
+
+        # The listing resumes at the marker. The mocked cluster does
+        # not keep Cassandra's clustering order, so only the files
+        # returned are compared
+        marker = sorted(file_ids)[2]
+
+        listed = list(driver.create_file_generator(vault_id, marker=marker))
+        self.assertEqual(sorted(listed), sorted(file_ids)[2:])
+
+        listed = list(driver.create_file_generator(vault_id, marker=marker,
+                                                   limit=3))
+        self.assertEqual(len(listed), 3)
+        self.assertTrue(set(listed) <= set(sorted(file_ids)[2:]))
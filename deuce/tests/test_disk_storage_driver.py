@@ -3,7 +3,9 @@ import mock
 import os
 import random
 
+from deuce import conf
 from deuce.tests import V1Base
+from deuce.drivers import blockstoragedriver
 from deuce.drivers.blockstoragedriver import BlockStorageDriver
 from deuce.drivers.disk import DiskStorageDriver
 from deuce.tests.util import MockFile
@@ -233,6 +235,89 @@ class DiskStorageDriverTest(V1Base):
             driver.delete_block(vault_id, storage_id)
         assert driver.delete_vault(vault_id)
 
+    def test_block_generator_prefetch(self):
+        driver = self.create_driver()
+
+        block_size = 3000
+        vault_id = self.create_vault_id()
+
+        driver.create_vault(vault_id)
+
+        blocks = [MockFile(block_size) for x in range(0, 10)]
+
+        storage_ids = []
+        for block_data in blocks:
+            status, storage_id = driver.store_block(vault_id,
+                                                    block_data.sha1(),
+                                                    block_data.read())
+            storage_ids.append(storage_id)
+
+        for window in (0, 1, 3, 20):
+            with mock.patch.object(conf.api_configuration,
+                                   'block_prefetch_window', window):
+                gen = driver.create_blocks_generator(vault_id,
+                                                     storage_ids[:])
+
+                fetched_data = list(gen)
+
+            self.assertEqual([storage_id for storage_id, obj in
+                              fetched_data], storage_ids)
+
+            for block_data, (storage_id, obj) in zip(blocks, fetched_data):
+                self.assertEqual(obj.read(), block_data._content)
+                obj.close()
+
+        # Prefetched blocks are read into memory and their storage
+        # objects closed straight away, rather than holding on to a
+        # storage connection until the consumer gets to them
+        opened = []
+        get_block_obj = driver.get_block_obj
+
+        def tracked_get_block_obj(vault_id, storage_block_id):
+            obj = mock.Mock(wraps=get_block_obj(vault_id, storage_block_id))
+            opened.append(obj)
+            return obj
+
+        with mock.patch.object(conf.api_configuration,
+                               'block_prefetch_window', 3), \
+                mock.patch.object(driver, 'get_block_obj',
+                                  side_effect=tracked_get_block_obj):
+            fetched_data = list(driver.create_blocks_generator(
+                vault_id, storage_ids[:]))
+
+        self.assertEqual(len(opened), len(storage_ids))
+        for obj in opened:
+            obj.close.assert_called_once_with()
+
+        for block_data, (storage_id, obj) in zip(blocks, fetched_data):
+            self.assertNotIn(obj, opened)
+            self.assertEqual(obj.read(), block_data._content)
+
+        # Stopping part way through drops the blocks not yet fetched
+        with mock.patch.object(conf.api_configuration,
+                               'block_prefetch_window', 3):
+            gen = driver.create_blocks_generator(vault_id, storage_ids[:])
+
+            storage_id, obj = next(gen)
+            self.assertEqual(storage_id, storage_ids[0])
+            obj.close()
+            gen.close()
+
+        # All downloads share one bounded pool of fetching threads
+        self.assertIs(blockstoragedriver._get_executor(),
+                      blockstoragedriver._get_executor())
+
+        # Blocks missing from storage come back as None
+        with mock.patch.object(conf.api_configuration,
+                               'block_prefetch_window', 3):
+            gen = driver.create_blocks_generator(vault_id,
+                                                 ['invalid_block_id'])
+            self.assertEqual(list(gen), [('invalid_block_id', None)])
+
+        for storage_id in storage_ids:
+            driver.delete_block(vault_id, storage_id)
+        assert driver.delete_vault(vault_id)
+
     def test_storage_block_failure(self):
         # (BenjamenMeyer) Success cases are taken care of elsewhere
         # we're only concerned about the failure case that explicitly
@@ -324,3 +409,68 @@ class DiskStorageDriverTest(V1Base):
                                                        block_datas)
         self.assertFalse(retVal)
         self.assertEqual(retList, [])
+
+
+class DiskStorageDriverTotalsTest(V1Base):
+
+    def create_driver(self):
+        return DiskStorageDriver()
+
+    def test_vault_statistics_totals(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+
+        block_datas = [MockFile(size) for size in (10, 20, 30)]
+        block_ids = [block_data.sha1() for block_data in block_datas]
+
+        driver.get_vault_statistics(vault_id)
+
+        status, storage_ids = driver.store_async_block(
+            vault_id, block_ids[:2],
+            [block_data.read() for block_data in block_datas[:2]])
+        driver.store_block(vault_id, block_ids[2], block_datas[2].read())
+
+        statistics = driver.get_vault_statistics(vault_id)
+        self.assertEqual(statistics['block-count'], 3)
+        self.assertEqual(statistics['total-size'], 60)
+
+        driver.delete_block(vault_id, storage_ids[0])
+
+        statistics = driver.get_vault_statistics(vault_id)
+        self.assertEqual(statistics['block-count'], 2)
+        self.assertEqual(statistics['total-size'], 50)
+
+        # Files written behind the driver's back are only seen
+        # by a recompute
+        path = driver._get_block_path(vault_id, 'other')
+        with open(path, 'wb') as outfile:
+            outfile.write(b'x' * 5)
+
+        self.assertEqual(driver.get_vault_statistics(vault_id),
+                         statistics)
+
+        statistics = driver.get_vault_statistics(vault_id, recompute=True)
+        self.assertEqual(statistics['block-count'], 3)
+        self.assertEqual(statistics['total-size'], 55)
+
+        # Rewriting a block only adjusts the total size
+        with mock.patch.object(driver, 'storage_id',
+                               return_value=storage_ids[1]):
+            driver.store_block(vault_id, block_ids[1], b'y' * 25)
+
+        statistics = driver.get_vault_statistics(vault_id)
+        self.assertEqual(statistics['block-count'], 3)
+        self.assertEqual(statistics['total-size'], 60)
+
+        # A block that fails to write is closed and not counted
+        outfile = mock.MagicMock()
+        outfile.write.side_effect = IOError('mocking write failure')
+
+        with mock.patch('builtins.open', return_value=outfile):
+            self.assertEqual(driver.store_block(vault_id, block_ids[0],
+                                                b'z' * 10), (False, ''))
+
+        outfile.close.assert_called_with()
+        self.assertEqual(driver.get_vault_statistics(vault_id), statistics)
@@ -13,6 +13,7 @@ from deuce import conf
 from deuce.model import Vault
 import deuce
 from deuce.tests import ControllerTest
+from deuce.util import FileCat
 from deuce.util.misc import set_qs, relative_uri
 
 
@@ -187,6 +188,136 @@ class TestFiles(ControllerTest):
             # Total received bytes is therefore zero
             self.assertEqual(file_length, 0)
 
+    def test_get_range(self):
+
+        enough_num = 10
+
+        block_list, blocks_data = self.helper_create_blocks(
+            num_blocks=enough_num)
+        blocks_data = list(blocks_data)
+        self.helper_store_blocks(self.vault_id, blocks_data)
+
+        contents = b''.join(block[1] for block in blocks_data)
+        file_length = len(contents)
+
+        data = json.dumps([[block_list[cnt], cnt * 100]
+                 for cnt in range(0, enough_num)])
+
+        response = self.simulate_post(self._fileblocks_path, body=data,
+                                      headers=self._hdrs)
+
+        finalize_hdrs = self._hdrs.copy()
+        finalize_hdrs['x-file-length'] = str(file_length)
+        response = self.simulate_post(self._file_path,
+                                      headers=finalize_hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        # (Range header, first byte, last byte)
+        ranges = [
+            ('bytes=0-0', 0, 0),
+            ('bytes=0-99', 0, 99),
+            ('bytes=150-349', 150, 349),
+            ('bytes=250-', 250, file_length - 1),
+            ('bytes=-120', file_length - 120, file_length - 1),
+            ('bytes=999-5000', 999, file_length - 1),
+            ('bytes=-5000', 0, file_length - 1),
+        ]
+
+        for value, first, last in ranges:
+            hdrs = self._hdrs.copy()
+            hdrs['range'] = value
+
+            response = self.simulate_get(self._file_path, headers=hdrs)
+            body = b''.join(response)
+
+            self.assertEqual(self.srmock.status, falcon.HTTP_206)
+            self.assertEqual(self.srmock.headers_dict['content-range'],
+                             'bytes {0}-{1}/{2}'.format(first, last,
+                                                        file_length))
+            self.assertEqual(self.srmock.headers_dict['content-length'],
+                             str(last - first + 1))
+            self.assertEqual(body, contents[first:last + 1])
+
+        # Only the blocks covering the range are fetched
+        with patch.object(Vault, 'get_blocks_generator',
+                          wraps=Vault.get_blocks_generator,
+                          autospec=True) as blocks_gen:
+            hdrs = self._hdrs.copy()
+            hdrs['range'] = 'bytes=150-349'
+            response = b''.join(self.simulate_get(self._file_path,
+                                                  headers=hdrs))
+            self.assertEqual(blocks_gen.call_args[0][1], block_list[1:4])
+
+        # Blocks read in several chunks are trimmed chunk by chunk,
+        # skipping whole chunks before the range and stopping
+        # part way through the last block
+        with patch.object(FileCat, 'DEFAULT_CHUNK_SIZE', 30):
+            for value, first, last in ranges:
+                hdrs = self._hdrs.copy()
+                hdrs['range'] = value
+
+                response = self.simulate_get(self._file_path, headers=hdrs)
+                self.assertEqual(self.srmock.status, falcon.HTTP_206)
+                self.assertEqual(b''.join(response),
+                                 contents[first:last + 1])
+
+        # Ranges that cannot be used return the whole file
+        for value in ('bytes=20-10', 'bytes=-', 'bytes=0-1,5-6',
+                      'items=0-10'):
+            hdrs = self._hdrs.copy()
+            hdrs['range'] = value
+
+            response = self.simulate_get(self._file_path, headers=hdrs)
+            self.assertEqual(self.srmock.status, falcon.HTTP_200)
+            self.assertEqual(b''.join(response), contents)
+
+        # Ranges entirely outside of the file are not satisfiable
+        for value in ('bytes={0}-'.format(file_length), 'bytes=-0'):
+            hdrs = self._hdrs.copy()
+            hdrs['range'] = value
+
+            response = self.simulate_get(self._file_path, headers=hdrs)
+            self.assertEqual(self.srmock.status,
+                             falcon.HTTP_416)
+            self.assertEqual(self.srmock.headers_dict['content-range'],
+                             'bytes */{0}'.format(file_length))
+
+    def test_get_range_errors(self):
+        hdrs = self._hdrs.copy()
+        hdrs['range'] = 'bytes=0-10'
+
+        # The file does not exist
+        response = self.simulate_get(self._files_path + '/' +
+                                     self.create_file_id(), headers=hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_404)
+
+        # The file is not finalized
+        response = self.simulate_get(self._distractor_file_path,
+                                     headers=hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_409)
+
+        # Nothing in an empty file can be satisfied, not even
+        # a suffix range
+        finalize_hdrs = self._hdrs.copy()
+        finalize_hdrs['x-file-length'] = '0'
+        response = self.simulate_post(self._file_path,
+                                      headers=finalize_hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        for value in ('bytes=0-', 'bytes=0-10', 'bytes=-10'):
+            hdrs['range'] = value
+
+            response = self.simulate_get(self._file_path, headers=hdrs)
+            self.assertEqual(self.srmock.status, falcon.HTTP_416)
+            self.assertEqual(self.srmock.headers_dict['content-range'],
+                             'bytes */0')
+
+        # A malformed range returns the whole (empty) file
+        hdrs['range'] = 'bytes=a-b'
+        response = self.simulate_get(self._file_path, headers=hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual(b''.join(response), b'')
+
     def test_get_one(self):
         # vault does not exists
         response = self.simulate_get(self._NOT_EXIST_files_path,
@@ -1,3 +1,5 @@
+import json
+
 import falcon
 
 from deuce.tests import V1Base
@@ -8,3 +10,7 @@ class TestHealth(V1Base):
     def test_health(self):
         response = self.simulate_get('/v1.0/health')
         self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        status = json.loads(response[0].decode())
+        self.assertTrue(any(line.startswith('block metadata cache:')
+                            for line in status))
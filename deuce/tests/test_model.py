@@ -1,6 +1,10 @@
+import mock
+
+import deuce
 from deuce.tests import V1Base
 
 from deuce.model import Vault, File
+from deuce.util import LRUCache
 
 
 class TestModel(V1Base):
@@ -26,6 +30,60 @@ class TestModel(V1Base):
         v = Vault.get(vault_id)
         assert v is None
 
+    def test_vault_get_cached(self):
+        vault_id = self.create_vault_id()
+        Vault.create(vault_id)
+
+        with mock.patch.object(deuce.storage_driver, 'vault_exists',
+                               wraps=deuce.storage_driver.vault_exists) \
+                as vault_exists:
+
+            # Known to exist for the rest of the request once created
+            for _ in range(0, 3):
+                assert Vault.get(vault_id) is not None
+            self.assertEqual(vault_exists.call_count, 0)
+
+            missing_id = self.create_vault_id()
+            for _ in range(0, 3):
+                assert Vault.get(missing_id) is None
+            self.assertEqual(vault_exists.call_count, 1)
+
+            # A new request checks again
+            deuce.context.vaults = {}
+            assert Vault.get(vault_id) is not None
+            self.assertEqual(vault_exists.call_count, 2)
+
+    def test_vault_get_cached_across_requests(self):
+        vault_id = self.create_vault_id()
+        missing_id = self.create_vault_id()
+
+        with mock.patch('deuce.model.vault._vault_cache',
+                        LRUCache(10, ttl=60)), \
+                mock.patch.object(deuce.conf.block_storage_driver.vault_cache,
+                                  'negative_ttl', 5), \
+                mock.patch.object(deuce.storage_driver, 'vault_exists',
+                                  wraps=deuce.storage_driver.vault_exists) \
+                as vault_exists:
+
+            Vault.create(vault_id)
+
+            for _ in range(0, 3):
+                deuce.context.vaults = {}
+                assert Vault.get(vault_id) is not None
+                assert Vault.get(missing_id) is None
+
+            # The first lookup of each vault went to storage
+            self.assertEqual(vault_exists.call_count, 2)
+
+            # Creating and deleting a vault is seen straight away
+            Vault.create(missing_id)
+            deuce.context.vaults = {}
+            assert Vault.get(missing_id) is not None
+
+            Vault.get(vault_id).delete()
+            deuce.context.vaults = {}
+            assert Vault.get(vault_id) is None
+
     def test_file_crud(self):
         vault_id = self.create_vault_id()
 
@@ -57,3 +115,74 @@ class TestModel(V1Base):
         blocks_list = list(blocks_gen)
 
         assert len(blocks_list) == 0
+
+    def test_put_async_block(self):
+        vault_id = self.create_vault_id()
+
+        v = Vault.create(vault_id)
+
+        blockdatas = [b'a', b'bb', b'ccc']
+        block_ids = [self.calc_sha1(blockdata) for blockdata in blockdatas]
+
+        def storage_ids(*ids):
+            return mock.patch.object(deuce.storage_driver,
+                                     'store_async_block',
+                                     return_value=(None not in ids,
+                                                   list(ids)))
+
+        with mock.patch.object(deuce.metadata_driver, 'register_blocks',
+                               wraps=deuce.metadata_driver.register_blocks) \
+                as register_blocks:
+
+            # Nothing known to be stored, or every block failed;
+            # there is nothing to register
+            for ids in ((), (None, None, None)):
+                with storage_ids(*ids):
+                    self.assertEqual(v.put_async_block(
+                        [block_id.encode() for block_id in block_ids],
+                        blockdatas), [])
+
+            self.assertFalse(register_blocks.called)
+            self.assertEqual(
+                deuce.metadata_driver.has_blocks(vault_id, block_ids),
+                block_ids)
+
+            # Only the blocks that were stored are registered
+            with storage_ids('storage_a', None, 'storage_c'):
+                self.assertEqual(v.put_async_block(
+                    [block_id.encode() for block_id in block_ids],
+                    blockdatas), [block_ids[0], block_ids[2]])
+
+            register_blocks.assert_called_once_with(
+                vault_id, [(block_ids[0], 'storage_a', 1),
+                           (block_ids[2], 'storage_c', 3)])
+            self.assertEqual(
+                deuce.metadata_driver.has_blocks(vault_id, block_ids),
+                [block_ids[1]])
+
+    def test_file_range_generator(self):
+        vault_id = self.create_vault_id()
+
+        v = Vault.create(vault_id)
+        f = v.create_file()
+
+        block_ids = [self.create_block_id() for _ in range(0, 5)]
+        offsets = [n * 10 for n in range(0, 5)]
+        deuce.metadata_driver.assign_blocks(vault_id, f.file_id,
+                                            block_ids, offsets)
+
+        # The blocks are read a page at a time, and only up to the
+        # block holding the last byte
+        with mock.patch.object(deuce.conf.api_configuration,
+                               'max_returned_num', 2):
+            self.assertEqual(
+                list(v.get_file_range_generator(f.file_id, 15, 34)),
+                list(zip(block_ids[1:4], offsets[1:4])))
+            self.assertEqual(
+                list(v.get_file_range_generator(f.file_id, 0, 49)),
+                list(zip(block_ids, offsets)))
+
+        # A file without blocks has nothing in range
+        self.assertEqual(
+            list(v.get_file_range_generator(v.create_file().file_id, 0, 9)),
+            [])
@@ -1,4 +1,15 @@
+from mock import call, patch
+from mongomock import DuplicateKeyError
+from mongomock.collection import Collection
+
 from deuce.drivers.mongodb import MongoDbStorageDriver
+from deuce.drivers.mongodb import mongodbmetadatadriver
+from deuce.drivers.mongodb.mongodbmetadatadriver import INDEXES, \
+    INDEX_VERSION, UNIQUE_INDEXES
+from deuce.tests import V1Base
+from deuce.tests.db_mocking import mongodb_mocking
+from deuce.tests.db_mocking.mongodb_mocking import BulkWriteError, \
+    Mock_BulkOperationBuilder, Mock_Collection
 from deuce.tests.test_sqlite_storage_driver import SqliteStorageDriverTest
 
 
@@ -12,3 +23,235 @@ class MongoDbStorageDriverTest(SqliteStorageDriverTest):
 
     def create_driver(self):
         return MongoDbStorageDriver()
+
+    def forget_vault_counters(self, driver, vault_id):
+        driver._vaultstats.remove({'vaultid': vault_id})
+
+
+class MongoDbIndexTest(V1Base):
+
+    def test_index_bootstrap(self):
+        # With ensure_index patched out the indexes really are
+        # missing, which is not what this test is about
+        with patch.object(Mock_Collection, 'ensure_index') as ensure_index, \
+                patch.object(mongodbmetadatadriver, '_indexes_checked',
+                             True):
+            driver = MongoDbStorageDriver()
+
+            self.assertEqual(ensure_index.call_count,
+                             sum(len(keys) for keys in INDEXES.values()))
+            self.assertIn(call(UNIQUE_INDEXES['blocks'][0], unique=True),
+                          ensure_index.call_args_list)
+
+            # Queries no longer ensure indexes
+            vault_id = self.create_vault_id()
+            driver.create_vault(vault_id)
+            driver.has_blocks(vault_id, ['a', 'b'])
+            driver.vault_health(vault_id)
+
+            # Only a newer manifest creates the indexes again
+            driver._create_indexes()
+
+            self.assertEqual(ensure_index.call_count,
+                             sum(len(keys) for keys in INDEXES.values()))
+
+            with patch('deuce.drivers.mongodb.mongodbmetadatadriver.'
+                       'INDEX_VERSION', INDEX_VERSION + 1):
+                driver._create_indexes()
+
+            self.assertEqual(ensure_index.call_count,
+                             2 * sum(len(keys) for keys in INDEXES.values()))
+
+    def test_unique_index_upgrade(self):
+        driver = MongoDbStorageDriver()
+        keys = UNIQUE_INDEXES['blocks'][0]
+
+        # The plain index an older manifest made is replaced by
+        # the unique one
+        def index_information(collection):
+            if collection.name != 'blocks':
+                return {}
+            return {'blockid_index': {'key': keys},
+                    'unique_index': {'key': keys, 'unique': True}}
+
+        with patch.object(Mock_Collection, 'index_information',
+                          autospec=True, side_effect=index_information), \
+                patch.object(Mock_Collection, 'drop_index') as drop_index, \
+                patch('deuce.drivers.mongodb.mongodbmetadatadriver.'
+                      'INDEX_VERSION', INDEX_VERSION + 1):
+            driver._create_indexes()
+
+        drop_index.assert_called_once_with('blockid_index')
+
+    def test_missing_indexes(self):
+        driver = MongoDbStorageDriver()
+        self.assertEqual(driver.missing_indexes(), [])
+
+        def index_information(collection):
+            return dict(('index{0}'.format(n), {'key': keys})
+                        for n, keys in enumerate(
+                            INDEXES.get(collection.name, [])[1:]))
+
+        missing = [(collection, keys[0])
+                   for collection, keys in INDEXES.items()]
+
+        with patch.object(Mock_Collection, 'index_information',
+                          autospec=True, side_effect=index_information):
+            self.assertEqual(driver.missing_indexes(), missing)
+
+            # The first driver of the process warns about each of
+            # them, and the drivers after it do not
+            with patch.object(mongodbmetadatadriver, '_indexes_checked',
+                              False), \
+                    patch.object(mongodbmetadatadriver.logger,
+                                 'warning') as warning:
+                MongoDbStorageDriver()
+                MongoDbStorageDriver()
+
+            self.assertEqual(warning.call_args_list, [
+                call('MongoDB collection {0} is missing the index '
+                     '{1}'.format(collection, keys))
+                for collection, keys in missing])
+
+
+class MongoDbQueryCountTest(V1Base):
+
+    def test_batched_block_lookups(self):
+        driver = MongoDbStorageDriver()
+
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_ids = [self.create_block_id() for _ in range(100)]
+
+        driver.create_file(vault_id, file_id)
+        driver.register_blocks(vault_id, [
+            (block_id, self.create_storage_block_id(), 10)
+            for block_id in block_ids[:-1]])
+        driver.assign_blocks(vault_id, file_id, block_ids,
+                             [n * 10 for n in range(len(block_ids))])
+
+        chunks = -(-len(block_ids) // driver._docnum)
+
+        with patch.object(Collection, 'find', autospec=True,
+                          side_effect=Collection.find) as find:
+            self.assertEqual(driver.has_blocks(vault_id, block_ids),
+                             block_ids[-1:])
+            self.assertEqual(find.call_count, chunks)
+
+            find.reset_mock()
+            driver.finalize_file(vault_id, file_id, len(block_ids) * 10 - 10)
+
+            # The file, its fileblocks, and the blocks in chunks
+            self.assertEqual(find.call_count, 2 + chunks)
+
+    def test_batched_block_registration(self):
+        driver = MongoDbStorageDriver()
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+
+        block_ids = [self.create_block_id() for _ in range(100)]
+        driver.register_block(vault_id, block_ids[0],
+                              self.create_storage_block_id(), 10)
+        driver.mark_block_as_bad(vault_id, block_ids[0])
+
+        with patch.object(Mock_BulkOperationBuilder, 'execute',
+                          autospec=True,
+                          side_effect=Mock_BulkOperationBuilder.execute) \
+                as execute, \
+                patch.object(Collection, 'update', autospec=True,
+                             side_effect=Collection.update) as update:
+            driver.register_blocks(vault_id, [
+                (block_id, self.create_storage_block_id(), 10)
+                for block_id in block_ids])
+
+            # One write for all of the blocks, and one for the
+            # vault's counters
+            self.assertEqual(execute.call_count, 1)
+            self.assertEqual([args[0].name for args, _ in
+                              update.call_args_list], ['vaultstats'])
+
+            # Nothing left to register, nothing written
+            execute.reset_mock()
+            update.reset_mock()
+            driver.register_blocks(vault_id, [
+                (block_id, self.create_storage_block_id(), 10)
+                for block_id in block_ids])
+
+            self.assertEqual(execute.call_count, 0)
+            self.assertEqual(update.call_count, 0)
+
+        self.assertEqual(driver.has_blocks(vault_id, block_ids,
+                                           check_status=True), [])
+        counters = driver._get_vault_counters(vault_id)
+        self.assertEqual((counters.blocks, counters.bytes, counters.badblocks),
+                         (100, 1000, 0))
+
+
+class MongoDbRegisterRaceTest(V1Base):
+
+    def test_racing_block_registration(self):
+        driver = MongoDbStorageDriver()
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+
+        blocks = [(self.create_block_id(), self.create_storage_block_id(),
+                   10) for _ in range(3)]
+
+        def block_count():
+            return driver._blocks.find({'vaultid': vault_id}).count()
+
+        # Every upload looks the blocks up before any of them
+        # registers them
+        with patch.object(driver, '_find_blocks', return_value=[]), \
+                patch.object(driver, '_load_block_record',
+                             return_value=None):
+            driver.register_blocks(vault_id, blocks)
+            driver.register_blocks(vault_id, blocks)
+            driver.register_block(vault_id, *blocks[0])
+
+            self.assertEqual(block_count(), 3)
+            counters = driver._get_vault_counters(vault_id)
+            self.assertEqual((counters.blocks, counters.bytes), (3, 30))
+
+            # The unique block index may instead have the server
+            # reject the losing upload's upsert
+            block = (self.create_block_id(),
+                     self.create_storage_block_id(), 10)
+
+            with patch.object(mongodb_mocking, '_apply_update',
+                              side_effect=DuplicateKeyError('duplicate')):
+                driver.register_blocks(vault_id, [block])
+
+            with patch.object(Collection, 'update',
+                              side_effect=DuplicateKeyError('duplicate')):
+                driver.register_block(vault_id, *block)
+
+            counters = driver._get_vault_counters(vault_id)
+            self.assertEqual((counters.blocks, counters.bytes), (3, 30))
+
+            # Any other failure of the batch is not swallowed
+            error = BulkWriteError({'writeErrors': [{'index': 0, 'code': 2}],
+                                    'upserted': []})
+
+            with patch.object(Mock_BulkOperationBuilder, 'execute',
+                              side_effect=error):
+                with self.assertRaises(BulkWriteError):
+                    driver.register_blocks(vault_id, [block])
+
+
+class MongoDbVaultStatsTest(V1Base):
+
+    def test_one_stats_document_per_vault(self):
+        driver = MongoDbStorageDriver()
+
+        vault_id = self.create_vault_id()
+        args = {'vaultid': vault_id}
+
+        driver.create_vault(vault_id)
+        driver.create_vault(vault_id)
+        self.assertEqual(driver._vaultstats.find(args).count(), 1)
+
+        driver.delete_vault(vault_id)
+        self.assertEqual(driver._vaultstats.find(args).count(), 0)
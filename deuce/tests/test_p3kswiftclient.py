@@ -1,10 +1,14 @@
+import hashlib
 import json
 from deuce.util import client as p3k_swiftclient
 from deuce.tests.util.mockfile import MockFile
 from deuce.tests import V1Base
 from swiftclient.exceptions import ClientException
 import mock
+import aiohttp
 import asyncio
+import concurrent.futures
+import threading
 
 
 class Response(object):
@@ -13,10 +17,22 @@ class Response(object):
         self.status = status
         self.content = content
         self.headers = {'etag': 'mock'}
-        if content:
-            fut = asyncio.Future(loop=None)
-            fut.set_result(content)
-            self.content.read = mock.Mock(return_value=fut)
+
+        # Whether the connection went back to the pool, or was
+        # dropped along with whatever was left of the body
+        self.released = False
+        self.closed = False
+
+    @asyncio.coroutine
+    def read(self):
+        return self.content
+
+    @asyncio.coroutine
+    def release(self):
+        self.released = True
+
+    def close(self):
+        self.closed = True
 
     def decode(self):
         return self.content.decode()
@@ -51,11 +67,39 @@ class Test_P3k_SwiftClient(V1Base):
         self.block_contents = [b'mock', b'mock']
         self.response_dict = dict()
 
+    def tearDown(self):
+        # Don't leave the session's connections open behind the test
+        p3k_swiftclient.get_client().close()
+
+    def mock_request(self, fut):
+        """Answers every request of the session with fut. Returns
+        the mock standing in for the session's request method"""
+        request = mock.Mock(return_value=fut)
+
+        @asyncio.coroutine
+        def send(*args, **kwargs):
+            result = request(*args, **kwargs)
+
+            # The client runs its own loop, so the test's futures
+            # are resolved here rather than awaited
+            if asyncio.iscoroutine(result):
+                result = yield from result
+            elif isinstance(result, asyncio.Future):
+                result = result.result()
+
+            return result
+
+        patcher = mock.patch.object(aiohttp.ClientSession, 'request',
+                                    new=staticmethod(send))
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        return request
+
     def test_put_container(self):
         res = Response(201)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         p3k_swiftclient.put_container(
             self.storage_url,
             self.token,
@@ -67,7 +111,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(200)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         response = p3k_swiftclient.head_container(
             self.storage_url,
             self.token,
@@ -76,7 +120,7 @@ class Test_P3k_SwiftClient(V1Base):
         res_exception = Response(404)
         fut = asyncio.Future(loop=None)
         fut.set_result(res_exception)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         self.assertRaises(ClientException,
                           lambda: p3k_swiftclient.head_container(
                               self.storage_url,
@@ -93,7 +137,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(200, content)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         response = p3k_swiftclient.get_container(
             self.storage_url,
             self.token,
@@ -112,7 +156,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(200, content)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         response = p3k_swiftclient.get_container(
             self.storage_url,
             self.token,
@@ -126,7 +170,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(404, content)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         self.assertRaises(ClientException,
                           lambda: p3k_swiftclient.get_container(
                               self.storage_url,
@@ -137,7 +181,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(204)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         p3k_swiftclient.delete_container(
             self.storage_url,
             self.token,
@@ -149,7 +193,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(201)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         p3k_swiftclient.put_object(
             self.storage_url,
             self.token,
@@ -175,7 +219,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(201)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        request = self.mock_request(fut)
         p3k_swiftclient.put_async_object(
             self.storage_url,
             self.token,
@@ -196,10 +240,27 @@ class Test_P3k_SwiftClient(V1Base):
             self.response_dict)
 
         self.assertEqual(self.response_dict['status'], 201)
+
+        # Precomputed etags are sent as they are
+        etags = [hashlib.md5(content).hexdigest()
+                 for content in self.block_contents]
+        p3k_swiftclient.put_async_object(
+            self.storage_url,
+            self.token,
+            self.vault,
+            self.blocks,
+            self.block_contents,
+            etags,
+            self.response_dict)
+
+        self.assertEqual(self.response_dict['status'], 201)
+        sent_etags = [call[1]['headers']['Etag'] for call in
+                      request.call_args_list[-2:]]
+        self.assertEqual(sent_etags, etags)
         res = Response(202)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         p3k_swiftclient.put_async_object(
             self.storage_url,
             self.token,
@@ -215,7 +276,7 @@ class Test_P3k_SwiftClient(V1Base):
         res = Response(204)
         fut = asyncio.Future(loop=None)
         fut.set_result(res)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         response = p3k_swiftclient.head_object(
             self.storage_url,
             self.token,
@@ -225,7 +286,7 @@ class Test_P3k_SwiftClient(V1Base):
         res_exception = Response(404)
         fut = asyncio.Future(loop=None)
         fut.set_result(res_exception)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut)
+        self.mock_request(fut)
         self.assertRaises(ClientException,
                           lambda: p3k_swiftclient.head_object(
                               self.storage_url,
@@ -238,7 +299,7 @@ class Test_P3k_SwiftClient(V1Base):
         r = Response(200, mock_file)
         fut1 = asyncio.Future(loop=None)
         fut1.set_result(r)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut1)
+        self.mock_request(fut1)
 
         response, block = p3k_swiftclient.get_object(
             self.storage_url,
@@ -253,7 +314,7 @@ class Test_P3k_SwiftClient(V1Base):
         r = Response(204)
         fut1 = asyncio.Future(loop=None)
         fut1.set_result(r)
-        p3k_swiftclient.aiohttp.request = mock.Mock(return_value=fut1)
+        self.mock_request(fut1)
 
         p3k_swiftclient.delete_object(
             self.storage_url,
@@ -262,3 +323,215 @@ class Test_P3k_SwiftClient(V1Base):
             self.block,
             self.response_dict)
         self.assertEqual(self.response_dict['status'], 204)
+
+    def test_swift_client(self):
+        # All threads share one session, and with it the pooled
+        # connections
+        client = p3k_swiftclient.get_client()
+        self.assertIs(p3k_swiftclient.get_client(), client)
+
+        other = []
+        thread = threading.Thread(
+            target=lambda: other.append(p3k_swiftclient.get_client()))
+        thread.start()
+        thread.join()
+        self.assertIs(other[0], client)
+        self.assertEqual(client._session.connector.limit,
+                         p3k_swiftclient.conf.block_storage_driver.swift.
+                         connection_limit)
+
+        client.close()
+        self.assertTrue(client.closed)
+        self.assertIsNot(p3k_swiftclient.get_client(), client)
+
+        # Closing again is harmless
+        client.close()
+        self.assertTrue(client.closed)
+
+    def test_run_coroutine_threadsafe_fallback(self):
+        # Used in place of asyncio's before Python 3.4.4
+        loop = p3k_swiftclient.get_client().loop
+
+        @asyncio.coroutine
+        def succeed():
+            return threading.current_thread().name
+
+        @asyncio.coroutine
+        def fail():
+            raise ValueError('failed')
+
+        @asyncio.coroutine
+        def cancel():
+            raise asyncio.CancelledError()
+
+        run = p3k_swiftclient._run_coroutine_threadsafe
+
+        self.assertEqual(run(succeed(), loop).result(), 'swift-client')
+
+        with self.assertRaises(ValueError):
+            run(fail(), loop).result()
+
+        with self.assertRaises(concurrent.futures.CancelledError):
+            run(cancel(), loop).result()
+
+    def test_swift_client_retries(self):
+        def result(value):
+            fut = asyncio.Future(loop=None)
+            if isinstance(value, Exception):
+                fut.set_exception(value)
+            else:
+                fut.set_result(value)
+            return fut
+
+        swift_conf = p3k_swiftclient.conf.block_storage_driver.swift
+        request = self.mock_request(None)
+
+        with mock.patch.object(swift_conf, 'retry_backoff', 0):
+            # The settings are read when the client is created
+            p3k_swiftclient.get_client().close()
+
+            # Transient failures are retried until one succeeds
+            request.side_effect = [
+                result(aiohttp.errors.ClientOSError()),
+                result(Response(503)),
+                result(Response(201))]
+
+            p3k_swiftclient.put_container(self.storage_url, self.token,
+                                          self.vault, self.response_dict)
+            self.assertEqual(self.response_dict['status'], 201)
+            self.assertEqual(request.call_count, 3)
+
+            # and give up after swift.retries attempts
+            request.reset_mock()
+            request.side_effect = lambda *args, **kwargs: \
+                result(Response(503))
+
+            p3k_swiftclient.put_container(self.storage_url, self.token,
+                                          self.vault, self.response_dict)
+            self.assertEqual(self.response_dict['status'], 503)
+            self.assertEqual(request.call_count, swift_conf.retries + 1)
+
+            request.reset_mock()
+            request.side_effect = lambda *args, **kwargs: \
+                result(aiohttp.errors.ClientOSError())
+
+            self.assertRaises(aiohttp.errors.ClientOSError,
+                              p3k_swiftclient.put_container,
+                              self.storage_url, self.token, self.vault,
+                              self.response_dict)
+            self.assertEqual(request.call_count, swift_conf.retries + 1)
+
+            # Client errors are not
+            request.reset_mock()
+            request.side_effect = None
+            request.return_value = result(Response(404))
+
+            p3k_swiftclient.put_container(self.storage_url, self.token,
+                                          self.vault, self.response_dict)
+            self.assertEqual(self.response_dict['status'], 404)
+            self.assertEqual(request.call_count, 1)
+
+    def test_put_async_object_per_block(self):
+        swift_conf = p3k_swiftclient.conf.block_storage_driver.swift
+        names = ['mock{0}'.format(n) for n in range(10)]
+        contents = [b'mock'] * len(names)
+        in_flight = []
+        peak = []
+
+        @asyncio.coroutine
+        def request(method, url, headers, data):
+            in_flight.append(url)
+            peak.append(len(in_flight))
+            yield from asyncio.sleep(0)
+            in_flight.remove(url)
+
+            if url.endswith('mock3'):
+                raise aiohttp.errors.ClientOSError()
+            return Response(422 if url.endswith('mock5') else 201)
+
+        with mock.patch.object(swift_conf, 'retry_backoff', 0):
+            with mock.patch.object(swift_conf, 'upload_concurrency', 3):
+                p3k_swiftclient.get_client().close()
+                self.mock_request(None).side_effect = request
+
+                statuses = p3k_swiftclient.put_async_object(
+                    self.storage_url,
+                    self.token,
+                    self.vault,
+                    names,
+                    contents,
+                    True,
+                    self.response_dict)
+
+        # Uploads are bounded, and one failure does not hide the
+        # objects that were stored
+        self.assertEqual(max(peak), 3)
+        self.assertEqual(self.response_dict['status'], 500)
+        self.assertEqual(statuses, [201, 201, 201, None, 201, 422,
+                                    201, 201, 201, 201])
+
+    def test_get_object_stream(self):
+        block = b'0123456789'
+
+        class Stream(object):
+            offset = 0
+
+            @asyncio.coroutine
+            def read(self, size):
+                size = len(block) if size < 0 else size
+                chunk = block[self.offset:self.offset + size]
+                self.offset += len(chunk)
+                return chunk
+
+        r = Response(200, Stream())
+        fut = asyncio.Future(loop=None)
+        fut.set_result(r)
+        self.mock_request(fut)
+
+        with mock.patch.object(p3k_swiftclient.SwiftObjectStream,
+                               'DEFAULT_CHUNK_SIZE', 4):
+            response, stream = p3k_swiftclient.get_object(
+                self.storage_url,
+                self.token,
+                self.vault,
+                self.block,
+                self.response_dict,
+                stream=True)
+        self.assertEqual(self.response_dict['status'], 200)
+
+        # Nothing is read until it is asked for, and the body is
+        # handed out a chunk at a time
+        self.assertEqual(r.content.offset, 0)
+        self.assertEqual(stream.read(3), b'012')
+        self.assertFalse(r.released)
+        self.assertEqual(list(stream), [b'3456', b'789'])
+
+        # The connection goes back to the pool at the end of the
+        # body, to be reused
+        self.assertTrue(stream.closed)
+        self.assertTrue(r.released)
+        self.assertFalse(r.closed)
+        self.assertEqual(stream.read(), b'')
+
+        # The stream can also be closed early
+        r = Response(200, Stream())
+        fut = asyncio.Future(loop=None)
+        fut.set_result(r)
+        self.mock_request(fut)
+
+        response, stream = p3k_swiftclient.get_object(
+            self.storage_url,
+            self.token,
+            self.vault,
+            self.block,
+            self.response_dict,
+            stream=True)
+        # A connection with the rest of the body still on it cannot
+        # be reused, so it is dropped
+        stream.close()
+        self.assertTrue(r.closed)
+        self.assertFalse(r.released)
+        self.assertEqual(stream.read(), b'')
+
+        stream.close()
+        self.assertTrue(stream.closed)
@@ -1,13 +1,18 @@
+from deuce.cmd import repair
 from deuce.tests import V1Base
 from deuce.drivers.metadatadriver import MetadataStorageDriver, GapError,\
-    OverlapError, ConstraintError
+    OverlapError, ConstraintError, VaultCounters
 from deuce.drivers.sqlite import SqliteStorageDriver
+from deuce.drivers.sqlite import sqlitemetadatadriver
 from deuce.drivers import BlockStorageDriver
+import os
 import random
+import tempfile
+import threading
 
 import deuce
 
-from mock import MagicMock
+from mock import MagicMock, patch
 
 
 class SqliteStorageDriverTest(V1Base):
@@ -18,6 +23,13 @@ class SqliteStorageDriverTest(V1Base):
     def create_driver(self):
         return SqliteStorageDriver()
 
+    def forget_vault_counters(self, driver, vault_id):
+        """Drops the counters of the vault, as if it predated them"""
+        driver._conn.execute(sqlitemetadatadriver.SQL_DELETE_VAULT_STATS,
+                             dict(projectid=deuce.context.project_id,
+                                  vaultid=vault_id))
+        driver._conn.commit()
+
     def test_basic_construction(self):
         driver = self.create_driver()
 
@@ -79,6 +91,125 @@ class SqliteStorageDriverTest(V1Base):
         self.assertEqual(new_stats['blocks']['bad'], 3)
         self.assertEqual(new_stats['files']['bad'], 1)
 
+    def test_vault_counters(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+
+        def check(files, blocks, size, bad_blocks):
+            stats = driver.get_vault_statistics(vault_id)
+
+            self.assertEqual(stats['files']['count'], files)
+            self.assertEqual(stats['blocks']['count'], blocks)
+            self.assertEqual(stats['blocks']['bytes'], size)
+            self.assertEqual(stats['blocks']['bad'], bad_blocks)
+
+            # The counters agree with a full count
+            self.assertEqual(driver.get_vault_statistics(vault_id,
+                                                         recompute=True),
+                             stats)
+
+        check(0, 0, 0, 0)
+
+        file_ids = [self.create_file_id() for _ in range(2)]
+
+        for file_id in file_ids:
+            driver.create_file(vault_id, file_id)
+
+        block_ids = [self.create_block_id() for _ in range(4)]
+
+        driver.register_block(vault_id, block_ids[0],
+                              self.create_storage_block_id(), 100)
+        driver.register_blocks(vault_id, [
+            (block_id, self.create_storage_block_id(), 200)
+            for block_id in block_ids])
+
+        check(2, 4, 700, 0)
+
+        driver.mark_block_as_bad(vault_id, block_ids[1])
+        driver.mark_block_as_bad(vault_id, block_ids[1])
+
+        check(2, 4, 700, 1)
+
+        # Replacing a bad block
+        driver.register_block(vault_id, block_ids[1],
+                              self.create_storage_block_id(), 300)
+
+        check(2, 4, 800, 0)
+
+        driver.mark_block_as_bad(vault_id, block_ids[2])
+        driver.register_blocks(vault_id, [
+            (block_ids[2], self.create_storage_block_id(), 50)])
+
+        check(2, 4, 650, 0)
+
+        driver.mark_block_as_bad(vault_id, block_ids[3])
+        driver.unregister_block(vault_id, block_ids[3])
+        driver.unregister_block(vault_id, block_ids[3])
+
+        check(2, 3, 450, 0)
+
+        driver.finalize_file(vault_id, file_ids[0])
+        driver.delete_file(vault_id, file_ids[0])
+        driver.delete_file(vault_id, file_ids[0])
+
+        check(1, 3, 450, 0)
+
+        # Counters that have drifted are only corrected on request
+        driver._set_vault_counters(vault_id, VaultCounters(files=42))
+
+        stats = driver.get_vault_statistics(vault_id)
+        self.assertEqual(stats['files']['count'], 42)
+        self.assertEqual(stats['blocks']['count'], 0)
+
+        stats = driver.get_vault_statistics(vault_id, recompute=True)
+        self.assertEqual(stats['files']['count'], 1)
+        self.assertEqual(stats['blocks']['count'], 3)
+
+        check(1, 3, 450, 0)
+
+        # Creating the vault again keeps its counters
+        driver.create_vault(vault_id)
+
+        check(1, 3, 450, 0)
+
+        driver.delete_file(vault_id, file_ids[1])
+        for block_id in block_ids[:3]:
+            driver.unregister_block(vault_id, block_id)
+
+        check(0, 0, 0, 0)
+
+        # The counters go with a deleted vault, so one created again
+        # with the same id does not inherit them
+        driver._set_vault_counters(vault_id, VaultCounters(files=42,
+                                                           blocks=7))
+        driver.delete_vault(vault_id)
+        driver.create_vault(vault_id)
+
+        check(0, 0, 0, 0)
+
+    def test_create_vault_uncounted(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        driver.create_vault(vault_id)
+        driver.create_file(vault_id, self.create_file_id())
+        driver.register_block(vault_id, self.create_block_id(),
+                              self.create_storage_block_id(), 100)
+
+        self.forget_vault_counters(driver, vault_id)
+        self.assertIsNone(driver._get_vault_counters(vault_id))
+
+        # Creating the vault again does not start its counters at
+        # zero; they are counted when first asked for
+        driver.create_vault(vault_id)
+
+        stats = driver.get_vault_statistics(vault_id)
+        self.assertEqual(stats['files']['count'], 1)
+        self.assertEqual(stats['blocks']['count'], 1)
+        self.assertEqual(stats['blocks']['bytes'], 100)
+
     def test_db_health(self):
         driver = self.create_driver()
         retval = driver.get_health()
@@ -140,6 +271,44 @@ class SqliteStorageDriverTest(V1Base):
                                  file_id,
                                  block_length)
 
+    def test_finalize_file_block_sizes(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_ids = [self.create_block_id() for _ in range(50)]
+        sizes = [random.randint(1, 100) for _ in block_ids]
+        offsets = [sum(sizes[:n]) for n in range(len(sizes))]
+
+        # The same vault and blocks, with other sizes, in another project
+        project_id = deuce.context.project_id
+        deuce.context.project_id = self.create_project_id()
+
+        for block_id in block_ids:
+            driver.register_block(vault_id, block_id,
+                                  self._genstorageid(block_id), 1000)
+
+        deuce.context.project_id = project_id
+
+        driver.create_file(vault_id, file_id)
+        driver.register_blocks(vault_id, [
+            (block_id, self._genstorageid(block_id), size)
+            for block_id, size in zip(block_ids, sizes)])
+
+        # Blocks are assigned out of order, and the same block can
+        # appear at several offsets
+        order = list(range(len(block_ids)))
+        random.shuffle(order)
+        driver.assign_blocks(vault_id, file_id,
+                             [block_ids[n] for n in order] + block_ids[:1],
+                             [offsets[n] for n in order] + [sum(sizes)])
+
+        with self.assertRaises(OverlapError):
+            driver.finalize_file(vault_id, file_id, sum(sizes))
+
+        driver.finalize_file(vault_id, file_id, sum(sizes) + sizes[0])
+        self.assertTrue(driver.is_finalized(vault_id, file_id))
+
     def test_finalize_empty_file(self):
         driver = self.create_driver()
 
@@ -228,6 +397,61 @@ class SqliteStorageDriverTest(V1Base):
         self.assertEqual(bad_files, 1)
         self.assertEqual(bad_blocks, num_blocks)
 
+    def test_vault_health_shared_bad_blocks(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        file_ids = [self.create_file_id() for _ in range(4)]
+        block_ids = [self.create_block_id() for _ in range(3)]
+
+        for block_id in block_ids:
+            driver.register_block(vault_id, block_id,
+                                  self._genstorageid(block_id), 1024)
+
+        # The first two files share block 0, the third has block 1
+        # twice and the last only has block 2
+        for file_id, file_block_ids in zip(file_ids, (
+                block_ids[:1], block_ids[:2], block_ids[1:2] * 2,
+                block_ids[2:])):
+            driver.create_file(vault_id, file_id)
+            driver.assign_blocks(vault_id, file_id, file_block_ids,
+                                 [n * 1024 for n in range(
+                                     len(file_block_ids))])
+
+        driver.mark_block_as_bad(vault_id, block_ids[0])
+        driver.mark_block_as_bad(vault_id, block_ids[1])
+
+        self.assertEqual(driver.vault_health(vault_id), (2, 3))
+
+        # A file gaining a block that is already bad
+        driver.assign_blocks(vault_id, file_ids[3], block_ids[:1], [1024])
+
+        self.assertEqual(driver.vault_health(vault_id), (2, 4))
+
+        # or gaining it on its own
+        other_file_id = self.create_file_id()
+        driver.create_file(vault_id, other_file_id)
+        driver.assign_block(vault_id, other_file_id, block_ids[1], 0)
+
+        self.assertEqual(driver.vault_health(vault_id), (2, 5))
+
+        driver.delete_file(vault_id, other_file_id)
+        driver.delete_file(vault_id, file_ids[3])
+        driver.delete_file(vault_id, file_ids[2])
+
+        self.assertEqual(driver.vault_health(vault_id), (2, 2))
+
+        # Replacing a bad block makes its files good again
+        driver.register_blocks(vault_id, [
+            (block_ids[0], self._genstorageid(block_ids[0]), 1024)])
+
+        self.assertEqual(driver.vault_health(vault_id), (1, 1))
+
+        driver.register_block(vault_id, block_ids[1],
+                              self._genstorageid(block_ids[1]), 1024)
+
+        self.assertEqual(driver.vault_health(vault_id), (0, 0))
+
     def test_blockid_to_storageid(self):
 
         driver = self.create_driver()
@@ -258,6 +482,130 @@ class SqliteStorageDriverTest(V1Base):
             self._genstorageid(self.create_block_id(b'bogus')))
         self.assertIsNone(bogus_block_id)
 
+    def test_block_storage_ids(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+
+        # Enough blocks to need more than one query in each driver
+        block_ids = [self.create_block_id() for _ in range(0, 600)]
+        storage_ids = [self._genstorageid(block_id)
+                       for block_id in block_ids]
+
+        for block_id, storage_id in zip(block_ids, storage_ids):
+            driver.register_block(vault_id, block_id, storage_id, 1024)
+
+        self.assertEqual(driver.get_block_storage_ids(vault_id, block_ids),
+                         storage_ids)
+
+        # Order follows the request; repeated and unknown blocks are kept
+        bogus_block_id = self.create_block_id(b'bogus')
+        request = [block_ids[5], bogus_block_id, block_ids[0], block_ids[5]]
+
+        self.assertEqual(driver.get_block_storage_ids(vault_id, request),
+                         [storage_ids[5], None, storage_ids[0],
+                          storage_ids[5]])
+
+        self.assertEqual(driver.get_block_storage_ids(vault_id, []), [])
+
+    def test_register_blocks(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+
+        block_ids = [self.create_block_id() for _ in range(0, 40)]
+        storage_ids = [self._genstorageid(block_id)
+                       for block_id in block_ids]
+
+        # One block is already registered and one was marked bad
+        driver.register_block(vault_id, block_ids[0], storage_ids[0], 10)
+        driver.register_block(vault_id, block_ids[1], 'bad', 10)
+        driver.mark_block_as_bad(vault_id, block_ids[1])
+
+        driver.register_blocks(vault_id, [
+            (block_id, storage_id, 1024)
+            for block_id, storage_id in zip(block_ids, storage_ids)])
+
+        self.assertEqual(driver.has_blocks(vault_id, block_ids,
+                                           check_status=True), [])
+        self.assertEqual(driver.get_block_storage_ids(vault_id, block_ids),
+                         storage_ids)
+        self.assertEqual(
+            driver.get_block_data(vault_id, block_ids[0])['blocksize'], 10)
+        self.assertEqual(
+            driver.get_block_data(vault_id, block_ids[1])['blocksize'], 1024)
+
+        driver.register_blocks(vault_id, [])
+
+    def test_block_cache(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        block_id = self.create_block_id()
+        storage_id = self._genstorageid(block_id)
+
+        # Missing blocks are not cached
+        self.assertFalse(driver.has_block(vault_id, block_id))
+        self.assertEqual(len(driver.block_cache), 0)
+
+        driver.register_block(vault_id, block_id, storage_id, 1024)
+
+        self.assertTrue(driver.has_block(vault_id, block_id))
+        hits = driver.block_cache.hits
+
+        # Storage id and status now come from the cache
+        self.assertEqual(driver.get_block_storage_id(vault_id, block_id),
+                         storage_id)
+        self.assertTrue(driver.has_block(vault_id, block_id,
+                                         check_status=True))
+        self.assertEqual(driver.block_cache.hits, hits + 2)
+
+        # Changes to the block are seen straight away
+        driver.mark_block_as_bad(vault_id, block_id)
+        self.assertFalse(driver.has_block(vault_id, block_id,
+                                          check_status=True))
+
+        driver.unregister_block(vault_id, block_id)
+        self.assertFalse(driver.has_block(vault_id, block_id))
+        self.assertIsNone(driver.get_block_storage_id(vault_id, block_id))
+
+    def test_register_block_stale_cache(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        block_id = self.create_block_id()
+        storage_id = self._genstorageid(block_id)
+
+        # Another worker unregisters the block; this worker's
+        # cache still has it
+        driver.register_block(vault_id, block_id, storage_id, 1024)
+        self.assertTrue(driver.has_block(vault_id, block_id))
+
+        with patch.object(driver, '_invalidate_block'):
+            driver.unregister_block(vault_id, block_id)
+
+        self.assertTrue(driver.has_block(vault_id, block_id))
+        self.assertEqual(driver.has_blocks(vault_id, [block_id]),
+                         [block_id])
+
+        # Uploading the block again registers it
+        driver.register_block(vault_id, block_id, storage_id, 1024)
+        self.assertEqual(driver.has_blocks(vault_id, [block_id]), [])
+
+        # The same goes for a block marked as bad elsewhere
+        self.assertTrue(driver.has_block(vault_id, block_id,
+                                         check_status=True))
+
+        with patch.object(driver, '_invalidate_block'):
+            driver.mark_block_as_bad(vault_id, block_id)
+
+        self.assertTrue(driver.has_block(vault_id, block_id,
+                                         check_status=True))
+
+        driver.register_block(vault_id, block_id, storage_id, 1024)
+        self.assertEqual(driver.has_blocks(vault_id, [block_id],
+                                           check_status=True), [])
+
     def test_block_crud(self):
         driver = self.create_driver()
 
@@ -436,6 +784,32 @@ class SqliteStorageDriverTest(V1Base):
         for block_id in block_ids:
             self.assertEqual(driver.get_block_ref_count(vault_id, block_id), 0)
 
+    def test_has_blocks_status(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+
+        # Enough blocks to need more than one query
+        block_ids = [self.create_block_id() for _ in range(0, 600)]
+        driver.register_blocks(vault_id, [
+            (block_id, self.create_storage_block_id(), 10)
+            for block_id in block_ids])
+
+        bad_block_id = block_ids[550]
+        driver.mark_block_as_bad(vault_id, bad_block_id)
+
+        # Missing blocks come back in the order they were asked for
+        bogus_block_ids = [self.create_block_id(b'bogus'),
+                           self.create_block_id(b'bogus2')]
+        request = [bogus_block_ids[1]] + block_ids + [bogus_block_ids[0]]
+
+        self.assertEqual(driver.has_blocks(vault_id, request),
+                         [bogus_block_ids[1], bogus_block_ids[0]])
+        self.assertEqual(driver.has_blocks(vault_id, request,
+                                           check_status=True),
+                         [bogus_block_ids[1], bad_block_id,
+                          bogus_block_ids[0]])
+
     def test_assign_multiple_blocks_after_adding_blocks(self):
         driver = self.create_driver()
 
@@ -955,6 +1329,85 @@ class SqliteStorageDriverTest(V1Base):
 
         self.assertEqual(out, [])
 
+    def test_file_manifest(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+
+        self.assertIsNone(driver.get_file_manifest(vault_id, file_id))
+
+        driver.create_file(vault_id, file_id)
+
+        self.assertEqual(driver.get_file_manifest(vault_id, file_id),
+                         (False, 0, []))
+
+        num_blocks = 10
+
+        block_ids = [self.create_block_id() for _ in range(0, num_blocks)]
+        block_sizes = [100 + x for x in range(0, num_blocks)]
+        offsets = [sum(block_sizes[:x]) for x in range(0, num_blocks)]
+        storage_ids = [self._genstorageid(block_id)
+                       for block_id in block_ids]
+
+        for block_id, storage_id, size in zip(block_ids, storage_ids,
+                                              block_sizes):
+            driver.register_block(vault_id, block_id, storage_id, size)
+
+        # Assign out of order; the manifest is ordered by offset
+        for block_id, offset in reversed(list(zip(block_ids, offsets))):
+            driver.assign_block(vault_id, file_id, block_id, offset)
+
+        driver.finalize_file(vault_id, file_id, sum(block_sizes))
+
+        finalized, length, blocks = driver.get_file_manifest(vault_id,
+                                                             file_id)
+
+        self.assertTrue(finalized)
+        self.assertEqual(length, sum(block_sizes))
+        self.assertEqual(blocks, list(zip(block_ids, offsets, block_sizes,
+                                          storage_ids)))
+
+    def test_file_block_offset(self):
+        driver = self.create_driver()
+
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+
+        num_blocks = 10
+
+        driver.create_file(vault_id, file_id)
+
+        block_ids = ['block_{0}'.format(id) for id in range(0, num_blocks)]
+        offsets = [x * 1024 for x in range(0, num_blocks)]
+
+        for block_id, offset in zip(block_ids, offsets):
+            driver.register_block(vault_id, block_id,
+                                  self._genstorageid(block_id), 1024)
+            driver.assign_block(vault_id, file_id, block_id, offset)
+
+        driver.finalize_file(vault_id, file_id)
+
+        # Positions on a block boundary and inside a block
+        self.assertEqual(driver.get_file_block_offset(vault_id, file_id, 0),
+                         0)
+        self.assertEqual(driver.get_file_block_offset(vault_id, file_id,
+                                                      1023), 0)
+        self.assertEqual(driver.get_file_block_offset(vault_id, file_id,
+                                                      1024 * 3), 1024 * 3)
+        self.assertEqual(driver.get_file_block_offset(vault_id, file_id,
+                                                      1024 * 5 + 7), 1024 * 5)
+
+        # Positions past the end land in the last block
+        self.assertEqual(driver.get_file_block_offset(vault_id, file_id,
+                                                      999999), 1024 * 9)
+
+        # A file without blocks has no block to seek to
+        empty_file_id = self.create_file_id()
+        driver.create_file(vault_id, empty_file_id)
+        self.assertIsNone(driver.get_file_block_offset(vault_id,
+                                                       empty_file_id, 0))
+
     def test_block_generator(self):
 
         driver = self.create_driver()
@@ -1094,3 +1547,308 @@ class SqliteStorageDriverTest(V1Base):
 
         for vault_id in vaultids:
             driver.delete_vault(vault_id)
+
+
+class SqliteConnectionTest(V1Base):
+
+    def test_connection_per_thread(self):
+        with tempfile.TemporaryDirectory() as path:
+            with patch('deuce.conf.metadata_driver.sqlite.path',
+                       os.path.join(path, 'metadata.db')):
+                driver = SqliteStorageDriver()
+
+            vault_id = self.create_vault_id()
+            driver.create_vault(vault_id)
+
+            mode = next(driver._conn.execute('pragma journal_mode'))[0]
+            self.assertEqual(mode, 'wal')
+
+            # Each thread reads through its own connection
+            conns = []
+            project_id = deuce.context.project_id
+
+            def read():
+                deuce.context.project_id = project_id
+                conns.append((driver._conn,
+                              driver.create_vaults_generator()))
+
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+
+            self.assertIsNot(conns[0][0], driver._conn)
+            self.assertEqual(conns[0][1], [vault_id])
+
+    def test_concurrent_writers(self):
+        with tempfile.TemporaryDirectory() as path:
+            with patch('deuce.conf.metadata_driver.sqlite.path',
+                       os.path.join(path, 'metadata.db')):
+                driver = SqliteStorageDriver()
+
+            vault_id = self.create_vault_id()
+            project_id = deuce.context.project_id
+            num_files = 20
+            num_blocks = 5
+
+            # Each writer waits for the other's transactions rather
+            # than failing on the database being locked
+            errors = []
+            file_ids = [[self.create_file_id() for _ in range(num_files)]
+                        for _ in range(2)]
+
+            def write(file_ids):
+                deuce.context.project_id = project_id
+                try:
+                    driver.create_vault(vault_id)
+
+                    for file_id in file_ids:
+                        block_ids = [self.create_block_id()
+                                     for _ in range(num_blocks)]
+
+                        driver.create_file(vault_id, file_id)
+                        driver.register_blocks(vault_id, [
+                            (block_id, self.create_storage_block_id(), 10)
+                            for block_id in block_ids])
+                        driver.assign_blocks(vault_id, file_id, block_ids,
+                                             [n * 10 for n in
+                                              range(num_blocks)])
+                        driver.finalize_file(vault_id, file_id,
+                                             num_blocks * 10)
+                except Exception as ex:
+                    errors.append(ex)
+
+            threads = [threading.Thread(target=write, args=(ids,))
+                       for ids in file_ids]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(errors, [])
+
+            # Everything both of them wrote is there, and counted
+            files = driver.create_file_generator(vault_id,
+                                                 limit=4 * num_files,
+                                                 finalized=True)
+            self.assertEqual(sorted(files),
+                             sorted(file_ids[0] + file_ids[1]))
+
+            stats = driver.get_vault_statistics(vault_id)
+            self.assertEqual(stats['files']['count'], 2 * num_files)
+            self.assertEqual(stats['blocks']['count'],
+                             2 * num_files * num_blocks)
+            self.assertEqual(
+                stats, driver.get_vault_statistics(vault_id, recompute=True))
+
+
+class SqliteMigrationTest(V1Base):
+
+    def test_migrate_then_write_from_another_thread(self):
+        with tempfile.TemporaryDirectory() as path, \
+                patch('deuce.conf.metadata_driver.sqlite.path',
+                      os.path.join(path, 'metadata.db')), \
+                patch('deuce.conf.metadata_driver.sqlite.busy_timeout',
+                      100):
+
+            # A database from before the block reference counts, with
+            # a file whose blocks the migration has to count
+            with patch.object(sqlitemetadatadriver, 'CURRENT_DB_VERSION',
+                              3):
+                driver = SqliteStorageDriver()
+
+            vault_id = self.create_vault_id()
+            file_id = self.create_file_id()
+            block_id = self.create_block_id()
+
+            driver.create_file(vault_id, file_id)
+            driver.assign_block(vault_id, file_id, block_id, 0)
+            self.assertEqual(driver._get_user_version(), 3)
+
+            driver = SqliteStorageDriver()
+            self.assertEqual(driver._get_user_version(),
+                             sqlitemetadatadriver.CURRENT_DB_VERSION)
+            self.assertFalse(driver._conn.in_transaction)
+            self.assertEqual(driver.get_block_ref_count(vault_id, block_id),
+                             1)
+
+            # The migration left nothing locked for the other threads
+            errors = []
+            project_id = deuce.context.project_id
+
+            def write():
+                deuce.context.project_id = project_id
+                try:
+                    driver.create_vault(vault_id)
+                except Exception as ex:
+                    errors.append(ex)
+
+            thread = threading.Thread(target=write)
+            thread.start()
+            thread.join()
+
+            self.assertEqual(errors, [])
+            self.assertEqual(driver.create_vaults_generator(), [vault_id])
+
+    def test_migrate_counts_existing_vaults(self):
+        with tempfile.TemporaryDirectory() as path, \
+                patch('deuce.conf.metadata_driver.sqlite.path',
+                      os.path.join(path, 'metadata.db')):
+
+            # A vault with files and blocks from before the counters
+            with patch.object(sqlitemetadatadriver, 'CURRENT_DB_VERSION',
+                              4):
+                driver = SqliteStorageDriver()
+
+            vault_id = self.create_vault_id()
+            block_ids = [self.create_block_id() for _ in range(2)]
+
+            driver._conn.execute(sqlitemetadatadriver.SQL_CREATE_VAULT,
+                                 dict(projectid=deuce.context.project_id,
+                                      vaultid=vault_id))
+            driver.create_file(vault_id, self.create_file_id())
+            driver.register_block(vault_id, block_ids[0],
+                                  self.create_storage_block_id(), 100)
+            driver.register_block(vault_id, block_ids[1],
+                                  self.create_storage_block_id(), 50)
+            driver.mark_block_as_bad(vault_id, block_ids[1])
+            self.assertEqual(driver._get_user_version(), 4)
+
+            driver = SqliteStorageDriver()
+            self.assertEqual(driver._get_user_version(),
+                             sqlitemetadatadriver.CURRENT_DB_VERSION)
+
+            counters = driver._get_vault_counters(vault_id)
+            self.assertEqual((counters.files, counters.blocks,
+                              counters.bytes, counters.badblocks),
+                             (1, 2, 150, 1))
+
+            # Creating the vault again leaves them be
+            stats = driver.get_vault_statistics(vault_id)
+            driver.create_vault(vault_id)
+
+            self.assertEqual(driver.get_vault_statistics(vault_id), stats)
+            self.assertEqual(driver.get_vault_statistics(vault_id,
+                                                         recompute=True),
+                             stats)
+
+
+class SqliteQueryPlanTest(V1Base):
+
+    def test_indexed_lookups(self):
+        driver = SqliteStorageDriver()
+
+        # Each of these must be an index search, never a table scan
+        queries = [
+            (sqlitemetadatadriver.SQL_GET_BLOCK_ID, 'blocks_storageid'),
+            (sqlitemetadatadriver.SQL_COUNT_BAD_BLOCKS, 'blocks_invalid'),
+            (sqlitemetadatadriver.SQL_GET_BLOCK_REF_COUNT,
+             'sqlite_autoindex_blockrefs_1'),
+            (sqlitemetadatadriver.SQL_GET_ALL_FILES, 'files_finalized')
+        ]
+
+        args = dict(projectid='p', vaultid='v', fileid='f', blockid='b',
+                    storageid='s', marker='', finalized=1, limit=1)
+
+        for query, index in queries:
+            plan = [row[-1] for row in driver._conn.execute(
+                'EXPLAIN QUERY PLAN ' + query, args)]
+
+            self.assertEqual(len(plan), 1)
+            self.assertTrue(plan[0].startswith('SEARCH'), plan[0])
+            self.assertIn(index, plan[0])
+
+        # Finalizing looks each of the file's blocks up in offset order
+        plan = [row[-1] for row in driver._conn.execute(
+            'EXPLAIN QUERY PLAN ' +
+            sqlitemetadatadriver.SQL_CREATE_FILEBLOCK_LIST, args)]
+
+        self.assertEqual(len(plan), 2)
+        self.assertIn('fileblocks_offset', plan[0])
+        self.assertIn('sqlite_autoindex_blocks_1', plan[1])
+        self.assertTrue(all(step.startswith('SEARCH') for step in plan))
+
+        # The bad files are found from the bad blocks
+        plan = [row[-1] for row in driver._conn.execute(
+            'EXPLAIN QUERY PLAN ' + sqlitemetadatadriver.SQL_COUNT_BAD_FILES,
+            args) if 'B-TREE' not in row[-1]]
+
+        self.assertEqual(len(plan), 2)
+        self.assertIn('blocks_invalid', plan[0])
+        self.assertIn('fileblocks_blockid', plan[1])
+        self.assertTrue(all(step.startswith('SEARCH') for step in plan))
+
+
+class SqliteBlockRefsTest(V1Base):
+
+    def test_repair_block_ref_counts(self):
+        driver = SqliteStorageDriver()
+
+        vault_id = self.create_vault_id()
+        file_id = self.create_file_id()
+        block_ids = [self.create_block_id() for _ in range(0, 3)]
+
+        driver.create_file(vault_id, file_id)
+        driver.assign_blocks(vault_id, file_id, block_ids, [0, 10, 20])
+
+        # Assigning the same block again does not add a reference
+        driver.assign_block(vault_id, file_id, block_ids[0], 0)
+        driver.assign_block(vault_id, file_id, block_ids[0], 30)
+
+        self.assertEqual(driver.get_block_ref_count(vault_id, block_ids[0]),
+                         2)
+        self.assertEqual(driver.repair_block_ref_counts(), 0)
+
+        # Counts that drifted are recomputed from fileblocks
+        driver._conn.execute('UPDATE blockrefs SET refcount = 7 '
+                             'WHERE blockid = ?', (block_ids[1],))
+        driver._conn.execute('DELETE FROM blockrefs WHERE blockid = ?',
+                             (block_ids[2],))
+        driver._conn.execute('INSERT INTO blockrefs VALUES (?, ?, ?, 1)',
+                             (deuce.context.project_id, vault_id, 'stale'))
+
+        self.assertEqual(driver.repair_block_ref_counts(), 3)
+        self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                          for block_id in block_ids + ['stale']],
+                         [2, 1, 1, 0])
+
+        driver.delete_file(vault_id, file_id)
+        self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                          for block_id in block_ids], [0, 0, 0])
+        self.assertEqual(
+            next(driver._conn.execute('SELECT count(*) FROM blockrefs'))[0],
+            0)
+
+    def test_repair_command(self):
+        with tempfile.TemporaryDirectory() as path, \
+                patch('deuce.conf.metadata_driver.sqlite.path',
+                      os.path.join(path, 'metadata.db')), \
+                patch('deuce.util.log.setup'):
+            driver = SqliteStorageDriver()
+
+            vault_id = self.create_vault_id()
+            file_id = self.create_file_id()
+            block_ids = [self.create_block_id() for _ in range(0, 2)]
+
+            driver.create_file(vault_id, file_id)
+            driver.assign_blocks(vault_id, file_id, block_ids, [0, 10])
+
+            driver._conn.execute('UPDATE blockrefs SET refcount = 5')
+            driver._conn.commit()
+
+            with patch.object(repair.LOG, 'info') as info:
+                repair.run()
+
+            info.assert_called_once_with(
+                u'Repaired the reference counts of 2 blocks')
+            self.assertEqual([driver.get_block_ref_count(vault_id, block_id)
+                              for block_id in block_ids], [1, 1])
+
+            # The other metadata drivers keep no counts to repair
+            with patch('deuce.conf.metadata_driver.driver', 'mongodb'), \
+                    patch.object(SqliteStorageDriver,
+                                 'repair_block_ref_counts') as repair_refs, \
+                    patch.object(repair.LOG, 'error') as error:
+                repair.run()
+
+            self.assertFalse(repair_refs.called)
+            self.assertTrue(error.called)
@@ -120,6 +120,17 @@ class SwiftStorageDriverTest(DiskStorageDriverTest):
             self.assertFalse(retVal)
             self.assertEqual(retList, [])
 
+        # Only the objects swift created get a storage id
+        with mock.patch(
+            'deuce.tests.db_mocking.swift_mocking.client.put_async_object',
+            return_value=[201, None]
+        ):
+            retVal, retList = driver.store_async_block(
+                vault_id, [block_id, block_id], [b'', b''])
+            self.assertFalse(retVal)
+            self.assertIsNotNone(retList[0])
+            self.assertIsNone(retList[1])
+
         with mock.patch(
             'deuce.tests.db_mocking.swift_mocking.client.head_object'
         ) as head_object:
@@ -127,6 +138,10 @@ class SwiftStorageDriverTest(DiskStorageDriverTest):
 
             self.assertFalse(driver.block_exists(vault_id, block_id))
 
+            self.assertEqual(driver.get_block_object_length(vault_id,
+                                                            block_id),
+                             0)
+
         with mock.patch(
             'deuce.tests.db_mocking.swift_mocking.client.delete_object'
         ) as delete_object:
@@ -141,9 +156,6 @@ class SwiftStorageDriverTest(DiskStorageDriverTest):
 
             self.assertIsNone(driver.get_block_obj(vault_id, block_id))
 
-            self.assertEqual(driver.get_block_object_length(vault_id,
-                                                            block_id),
-                             0)
         with mock.patch(
             'deuce.tests.db_mocking.swift_mocking.client._mock_status_code'
         ) as mock_status:
@@ -1,7 +1,13 @@
-from hashlib import md5
+from hashlib import md5, sha1
+import os
 from random import randrange
+import time
 from unittest import TestCase
-from deuce.util import FileCat, set_qs, set_qs_on_url
+
+import mock
+
+from deuce.util import FileCat, LRUCache, set_qs, set_qs_on_url
+from deuce.util import digest
 from deuce.tests.util import MockFile
 
 try:  # pragma: no cover
@@ -90,6 +96,128 @@ class TestFileCat(TestCase):
         assert bytes_read == sum(file_sizes)
         assert computed_md5 == expected_md5
 
+    def test_iter_read(self):
+        num_files = 7
+        min_file_size = 0
+        max_file_size = 10000
+        chunk_size = 1000
+
+        file_sizes = [randrange(min_file_size, max_file_size)
+                      for i in range(0, num_files)]
+
+        files = [MockFile(size) for size in file_sizes]
+
+        # Calculate an md5 of all of our files.
+        z = md5()
+        for f in files:
+            z.update(f._content)
+
+        expected_md5 = z.hexdigest()
+
+        # Nothing to iterate over
+        self.assertEqual(list(FileCat(None)), [])
+
+        fc = FileCat((f for f in files), chunk_size=chunk_size)
+
+        z = md5()
+        bytes_read = 0
+
+        for buff in fc:
+            assert 0 < len(buff) <= chunk_size
+
+            bytes_read += len(buff)
+            z.update(buff)
+
+        computed_md5 = z.hexdigest()
+
+        assert bytes_read == sum(file_sizes)
+        assert computed_md5 == expected_md5
+
+        # Closing part way through releases the current file
+        fc = FileCat((f for f in [MockFile(10)]), chunk_size=5)
+        self.assertEqual(len(next(fc)), 5)
+        fc.close()
+        self.assertEqual(list(fc), [])
+
+    def test_close(self):
+        files = [MockFile(10) for _ in range(3)]
+
+        # An iterator that cannot be closed is simply left alone
+        fc = FileCat(iter(files), chunk_size=5)
+        with mock.patch.object(files[0], 'close') as close_file:
+            fc.close()
+            close_file.assert_called_once_with()
+        self.assertEqual(fc.read(), b'')
+
+        # Nothing is open once everything has been read
+        fc = FileCat(iter(files[1:]))
+        self.assertEqual(len(fc.read()), 20)
+        fc.close()
+        self.assertEqual(list(fc), [])
+
+        # A generator is closed so it stops producing files
+        gen = (f for f in [MockFile(10), MockFile(10)])
+        fc = FileCat(gen)
+        fc.close()
+        self.assertEqual(list(gen), [])
+
+    def test_lru_cache(self):
+        cache = LRUCache(maxsize=3, ttl=10)
+
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.misses, 1)
+
+        for key in ('a', 'b', 'c'):
+            cache.put(key, key.upper())
+
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.hits, 1)
+
+        # 'b' is now the least recently used entry
+        cache.put('d', 'D')
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'A')
+
+        cache.invalidate('a')
+        cache.invalidate('not-cached')
+        self.assertIsNone(cache.get('a'))
+
+        # Entries expire after ttl seconds
+        now = time.monotonic()
+        with mock.patch('time.monotonic', return_value=now + 11):
+            self.assertIsNone(cache.get('c'))
+
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 4,
+                                         'size': 1, 'maxsize': 3})
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+        # A zero sized cache holds nothing
+        cache = LRUCache(maxsize=0)
+        cache.put('a', 'A')
+        self.assertIsNone(cache.get('a'))
+
+    def test_verify_blocks(self):
+        # Spans several digest chunks
+        blocks = [os.urandom(size) for size in
+                  (0, 1, digest.DIGEST_CHUNK_SIZE + 1)]
+        block_ids = [sha1(block).hexdigest() for block in blocks]
+        md5s = [md5(block).hexdigest() for block in blocks]
+
+        self.assertEqual(digest.block_digests(blocks[2]),
+                         (block_ids[2], md5s[2]))
+
+        for workers in (0, 2):
+            with mock.patch('deuce.conf.api_configuration.hash_workers',
+                            workers):
+                self.assertEqual(digest.verify_blocks(block_ids, blocks),
+                                 md5s)
+
+                with self.assertRaises(ValueError):
+                    digest.verify_blocks(block_ids, blocks[::-1])
+
     def test_set_qs_on_url(self):
         url = 'http://whatever:8080/hello/world'
 
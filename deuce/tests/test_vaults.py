@@ -273,6 +273,37 @@ class TestVaults(ControllerTest):
         response = self.simulate_delete(vault_path, headers=self._hdrs)
         self.assertEqual(self.srmock.status, falcon.HTTP_409)
 
+    def test_vault_statistics_recompute(self):
+        vault_path = '/v1.0/vaults/{0}'.format(self.create_vault_id())
+
+        response = self.simulate_put(vault_path, headers=self._hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_201)
+
+        block_data = os.urandom(2000)
+        block_path = '{0}/blocks/{1}'.format(
+            vault_path, hashlib.sha1(block_data).hexdigest())
+        block_headers = {
+            "Content-Type": "application/binary",
+            "Content-Length": "2000",
+        }
+        block_headers.update(self._hdrs)
+        response = self.simulate_put(block_path, headers=block_headers,
+                                     body=block_data)
+        self.assertEqual(self.srmock.status, falcon.HTTP_201)
+
+        response = self.simulate_get(vault_path, headers=self._hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        stats = json.loads(response[0].decode())
+
+        self.assertEqual(stats['metadata']['blocks']['count'], 1)
+        self.assertEqual(stats['metadata']['blocks']['bytes'], 2000)
+
+        response = self.simulate_get(vault_path, query_string='recompute=true',
+                                     headers=self._hdrs)
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual(json.loads(response[0].decode())['metadata'],
+                         stats['metadata'])
+
     def test_vault_error(self):
         from deuce.model import Vault
         with patch.object(Vault, 'create', return_value=False):
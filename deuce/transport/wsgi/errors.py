@@ -79,6 +79,14 @@ class HTTPNotFound(falcon.HTTPNotFound):
         super(HTTPNotFound, self).__init__()
 
 
+class HTTPRangeNotSatisfiable(falcon.HTTPRangeNotSatisfiable):
+
+    """Wraps falcon.HTTPRangeNotSatisfiable"""
+
+    def __init__(self, resource_length):
+        super(HTTPRangeNotSatisfiable, self).__init__(resource_length)
+
+
 class HTTPMethodNotAllowed(falcon.HTTPMethodNotAllowed):
 
     """Wraps falcon.HTTPMethodNotAllowed"""
@@ -223,33 +223,57 @@ class CollectionResource(object):
 
     @validate(vault_id=VaultGetRule)
     def on_post(self, req, resp, vault_id):
+        """Stores the blocks of a msgpack map of block ids to
+        block data. The map is decoded as it is read off the
+        request, and stored in batches of at most
+        api_configuration.max_blocks_in_flight blocks, so only
+        a few blocks are ever held in memory at once.
+
+        If any block of a batch fails to store, the request fails
+        with the ids of those blocks. Every other block, including
+        those of the batches before it, remains stored"""
         vault = Vault.get(vault_id)
         try:
-            unpacked = msgpack.unpackb(req.stream.read())
+            unpacker = msgpack.Unpacker(req.stream)
+            block_count = unpacker.read_map_header()
 
-            if not isinstance(unpacked, dict):
-                raise TypeError
+            batch_size = conf.api_configuration.max_blocks_in_flight
+            block_ids = []
+            block_datas = []
 
-            else:
-                block_ids = list(unpacked.keys())
-                block_datas = list(unpacked.values())
-                try:
-                    retval = vault.put_async_block(
-                        block_ids,
-                        block_datas)
-                    if retval:
-                        resp.status = falcon.HTTP_201
-                    else:
-                        raise errors.HTTPInternalServerError('Block '
-                                                            'Post Failed')
-                    logger.info('blocks [{0}] added'.format(block_ids))
-                except ValueError:
-                    raise errors.HTTPPreconditionFailed('hash error')
-        except (TypeError, ValueError):
+            for index in range(block_count):
+                block_ids.append(unpacker.unpack())
+                block_datas.append(unpacker.unpack())
+
+                if len(block_ids) == batch_size or index == block_count - 1:
+                    self._put_blocks(vault, block_ids, block_datas)
+                    block_ids = []
+                    block_datas = []
+
+            resp.status = falcon.HTTP_201
+
+        except (TypeError, ValueError, msgpack.UnpackException):
             logger.error('Request Body not well formed '
                          'for posting multiple blocks to {0}'.format(vault_id))
             raise errors.HTTPBadRequestBody("Request Body not well formed")
 
+    def _put_blocks(self, vault, block_ids, block_datas):
+        try:
+            stored = vault.put_async_block(block_ids, block_datas)
+        except ValueError:
+            raise errors.HTTPPreconditionFailed('hash error')
+
+        stored = set(stored or [])
+        failed = [block_id.decode() for block_id in block_ids
+                  if block_id.decode() not in stored]
+
+        if failed:
+            logger.error('blocks [{0}] failed to store'.format(failed))
+            raise errors.HTTPInternalServerError(
+                'Block Post Failed: {0}'.format(json.dumps(failed)))
+
+        logger.info('blocks [{0}] added'.format(block_ids))
+
     @validate(req=RequestRule(BlockMarkerRule, LimitRule),
               vault_id=VaultGetRule)
     def on_get(self, req, resp, vault_id):
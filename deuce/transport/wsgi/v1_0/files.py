@@ -1,8 +1,9 @@
 import json
+import re
 
 from stoplight import validate
 
-from deuce.util import set_qs_on_url
+from deuce.util import FileCat, set_qs_on_url
 from deuce.model import Vault
 from deuce import conf
 import deuce.util.log as logging
@@ -11,6 +12,66 @@ import deuce
 
 logger = logging.getLogger(__name__)
 
+# NOTE: falcon's req.range does not handle the 'bytes=' unit
+# prefix, so the Range header is parsed here instead. Only a
+# single range is supported.
+BYTE_RANGE_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(value, length):
+    """Parses the value of a Range header into an inclusive
+    (first, last) tuple of byte positions within a file of the
+    specified length. Returns None if the header is absent or
+    cannot be used, in which case the whole file is returned.
+    Raises HTTPRangeNotSatisfiable if the range lies entirely
+    outside of the file"""
+    match = BYTE_RANGE_REGEX.match(value.strip()) if value else None
+
+    if not match:
+        return None
+
+    first, last = match.groups()
+
+    if first:
+        first = int(first)
+        last = min(int(last), length - 1) if last else length - 1
+
+        if first >= length:
+            raise errors.HTTPRangeNotSatisfiable(length)
+
+        return (first, last) if first <= last else None
+
+    if last:
+        # Suffix range, i.e. the last N bytes of the file
+        suffix = int(last)
+
+        if suffix == 0 or length == 0:
+            raise errors.HTTPRangeNotSatisfiable(length)
+
+        return (max(length - suffix, 0), length - 1)
+
+    return None
+
+
+def trim_stream(chunks, skip, length):
+    """Yields length bytes from the chunks after dropping the
+    first skip bytes, then closes the chunks"""
+    try:
+        for chunk in chunks:
+            if length <= 0:
+                break
+
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+
+            chunk = chunk[skip:skip + length]
+            skip = 0
+            length -= len(chunk)
+            yield chunk
+    finally:
+        chunks.close()
+
 
 class CollectionResource(object):
 
@@ -85,40 +146,84 @@ class ItemResource(object):
             logger.error('Vault [{0}] does not exist'.format(vault_id))
             raise errors.HTTPNotFound
 
-        f = vault.get_file(file_id)
+        range_header = req.get_header('range')
 
-        if not f:
-            logger.error('File [{0}] does not exist'.format(file_id))
-            raise errors.HTTPNotFound
+        if range_header is None:
+            # The whole file is described by a single metadata call
+            manifest = vault.get_file_manifest(file_id)
 
-        if not f.finalized:
-            raise errors.HTTPConflict('File not Finalized')
+            if manifest is None:
+                logger.error('File [{0}] does not exist'.format(file_id))
+                raise errors.HTTPNotFound
+
+            finalized, file_length, blocks = manifest
+
+            if not finalized:
+                raise errors.HTTPConflict('File not Finalized')
+
+            byte_range = None
+            block_ids = [block[0] for block in blocks]
+            storage_ids = [block[3] for block in blocks]
+        else:
+            f = vault.get_file(file_id)
 
-        block_gen = deuce.metadata_driver.create_file_block_generator(
-            vault_id, file_id)
+            if not f:
+                logger.error('File [{0}] does not exist'.format(file_id))
+                raise errors.HTTPNotFound
 
-        block_ids = [block[0] for block in sorted(block_gen,
-                                                  key=lambda block: block[1])]
+            if not f.finalized:
+                raise errors.HTTPConflict('File not Finalized')
 
-        objs = vault.get_blocks_generator(block_ids)
+            file_length = vault.get_file_length(file_id)
+            byte_range = parse_range(range_header, file_length)
+
+            # Only the blocks that hold the requested bytes are
+            # fetched; the first one is trimmed to the start of the
+            # range and the stream stops at the end of the range.
+            # An unusable range is served as the whole file.
+            first, last = byte_range or (0, file_length - 1)
+
+            blocks = list(vault.get_file_range_generator(file_id,
+                                                         first, last))
+
+            block_ids = [block[0] for block in blocks]
+            storage_ids = None
+            skip = first - blocks[0][1] if blocks else 0
+
+        objs = vault.get_blocks_generator(block_ids, storage_ids)
 
         # NOTE(TheSriram): falcon 0.2.0 might fix this problem,
         # we should be able to set resp.stream to any file like
         # object instead of an iterator.
 
-        def premature_close(storage_id):
-            msg = '[{0}/{1}/{2}] is missing data' \
-                  'for storage block {3}'.format(deuce.context.project_id,
-                                                 vault_id,
-                                                 file_id,
-                                                 storage_id)
-            logger.error(msg)
-            raise StopIteration(msg)
-
-        resp.stream = (obj.read() if obj else premature_close(storageid)
-                       for (storageid, obj) in objs)
-        resp.status = falcon.HTTP_200
-        resp.set_header('Content-Length', str(vault.get_file_length(file_id)))
+        def block_objs():
+            # Stop the stream at the first block missing from
+            # storage; the client sees a short read.
+            for storage_id, obj in objs:
+                if obj is None:
+                    logger.error('[{0}/{1}/{2}] is missing data '
+                                 'for storage block {3}'.format(
+                                     deuce.context.project_id,
+                                     vault_id,
+                                     file_id,
+                                     storage_id))
+                    return
+                yield obj
+
+        # Blocks are streamed out in fixed size chunks as they are
+        # read, so a block is never held in memory as a whole
+        if byte_range is None:
+            resp.stream = FileCat(block_objs())
+            resp.status = falcon.HTTP_200
+            resp.set_header('Content-Length', str(file_length))
+        else:
+            resp.stream = trim_stream(FileCat(block_objs()), skip,
+                                      last - first + 1)
+            resp.status = falcon.HTTP_206
+            resp.content_range = (first, last, file_length)
+            resp.set_header('Content-Length', str(last - first + 1))
+
+        resp.set_header('Accept-Ranges', 'bytes')
         resp.content_type = 'application/octet-stream'
 
     @validate(vault_id=VaultPutRule, file_id=FilePostRuleNoneOk)
@@ -22,7 +22,10 @@ class ItemResource(object):
         vault = Vault.get(vault_id)
 
         if vault:
-            vault_stats = vault.get_vault_statistics()
+            # ?recompute=true counts the statistics instead of
+            # reading the running totals
+            recompute = req.get_param_as_bool('recompute') or False
+            vault_stats = vault.get_vault_statistics(recompute=recompute)
             resp.body = json.dumps(vault_stats)
             resp.status = falcon.HTTP_200
         else:
@@ -3,5 +3,8 @@ from deuce.util.misc import set_qs
 from deuce.util.misc import set_qs_on_url
 from deuce.util import client
 from deuce.util import filecat
+from deuce.util import cache
+from deuce.util import digest
 
 FileCat = filecat.FileCat
+LRUCache = cache.LRUCache
@@ -0,0 +1,88 @@
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+
+    """LRUCache: A bounded, thread-safe mapping that evicts
+    the least recently used entry once it holds maxsize
+    entries. Entries older than ttl seconds are treated
+    as missing.
+
+    Hits and misses are counted so that the cache can be
+    sized against a real workload"""
+
+    def __init__(self, maxsize, ttl=None):
+        """Constructs a new LRUCache object.
+        :param maxsize: The maximum number of entries held. A
+            maxsize of zero disables the cache
+        :param ttl: The number of seconds an entry is valid for.
+            None or zero means entries never expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the value cached for key, or default if
+        there is none or it has expired"""
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        """Caches value for key, evicting the least recently
+        used entries if the cache is full
+
+        :param ttl: Overrides the cache's ttl for this entry
+        """
+        if self.maxsize <= 0:
+            return
+
+        ttl = ttl or self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Drops the entry for key, if any"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drops every entry. The counters are kept"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns a dictionary describing the cache usage"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
@@ -1,72 +1,322 @@
 import aiohttp
 import asyncio
+import concurrent.futures
 import hashlib
 import json
+import threading
 from swiftclient.exceptions import ClientException
 
 from deuce import conf
-from deuce.util.event_loop import get_event_loop
 
 # NOTE (TheSriram) : must include exception handling
 
+# Failures worth another attempt: the connection dropped or was
+# refused, or the request timed out
+TRANSIENT_ERRORS = (aiohttp.errors.ClientError,
+                    aiohttp.errors.DisconnectedError,
+                    asyncio.TimeoutError)
 
-def _noloop_request(method, url, headers, data=None):
-    response = yield from aiohttp.request(method=method, url=url,
-                                          headers=headers, data=data)
-    return response
+_client = None
+_client_lock = threading.Lock()
+
+
+def _run_coroutine_threadsafe(coro, loop):
+    """Schedules the coroutine on the loop from another thread and
+    returns a concurrent.futures.Future of its result. Stands in for
+    asyncio.run_coroutine_threadsafe before Python 3.4.4"""
+    future = concurrent.futures.Future()
+
+    def copy_result(task):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+    def start():
+        asyncio.Task(coro, loop=loop).add_done_callback(copy_result)
+
+    loop.call_soon_threadsafe(start)
+    return future
+
+run_coroutine_threadsafe = getattr(asyncio, 'run_coroutine_threadsafe',
+                                   _run_coroutine_threadsafe)
+
+
+class SwiftClient(object):
+
+    """SwiftClient: Sends requests to Swift over one long-lived
+    aiohttp ClientSession, so that connections are kept alive
+    and reused across requests instead of being set up (TCP and
+    TLS) for every block.
+
+    The session's event loop runs on a thread of its own, and
+    every other thread hands its requests to it. This lets one
+    connection pool serve all of the threads, and lets a streamed
+    response be read by a thread other than the one that sent the
+    request; see get_client()"""
+
+    def __init__(self):
+        swift_conf = conf.block_storage_driver.swift
+
+        self._request_timeout = swift_conf.request_timeout
+        self._retries = swift_conf.retries
+        self._retry_backoff = swift_conf.retry_backoff
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='swift-client', daemon=True)
+        self._thread.start()
+
+        # A limit of zero leaves the connections per host unbounded
+        @asyncio.coroutine
+        def create_session():
+            connector = aiohttp.TCPConnector(
+                loop=self._loop,
+                limit=swift_conf.connection_limit or None,
+                conn_timeout=swift_conf.conn_timeout,
+                keepalive_timeout=swift_conf.keepalive_timeout)
+
+            return aiohttp.ClientSession(connector=connector,
+                                         loop=self._loop)
+
+        self._session = self.run(create_session())
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @property
+    def closed(self):
+        return self._session.closed or not self._loop.is_running()
+
+    def run(self, coro):
+        """Runs the coroutine on the client's loop and waits for
+        its result"""
+        return run_coroutine_threadsafe(coro, self._loop).result()
+
+    def close(self):
+        """Closes the session and all of its pooled connections,
+        and stops the client's loop"""
+        if self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._session.close)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+        if not self._loop.is_closed():
+            self._loop.close()
+
+    @asyncio.coroutine
+    def request(self, method, url, headers, data=None, read=False,
+                stream=False):
+        """Sends a single request. Connection errors, timeouts and
+        5xx responses are retried with exponential backoff, up to
+        swift.retries times.
+
+        :param read: Whether to read the response body
+        :param stream: Whether to leave the response body to be
+            read by the caller. Otherwise, and if read is not
+            set, the body is discarded so the connection can be
+            reused
+        :returns: A tuple of the response and its body, or None
+            for the body if it was not read
+        """
+        # A body that is read as it is sent cannot be sent again
+        retries = 0 if hasattr(data, 'read') else self._retries
+        attempt = 0
+
+        while True:
+            try:
+                response = yield from asyncio.wait_for(
+                    self._session.request(method, url, headers=headers,
+                                          data=data),
+                    self._request_timeout, loop=self._loop)
+
+                retry = response.status >= 500 and attempt < retries
+                body = None
+
+                if retry or not (read or stream):
+                    yield from response.release()
+                elif read:
+                    body = yield from asyncio.wait_for(
+                        response.read(), self._request_timeout,
+                        loop=self._loop)
+
+                if not retry:
+                    return (response, body)
+
+            except TRANSIENT_ERRORS:
+                if attempt >= retries:
+                    raise
+
+            yield from asyncio.sleep(self._retry_backoff * 2 ** attempt,
+                                     loop=self._loop)
+            attempt += 1
+
+    @asyncio.coroutine
+    def read(self, response, size):
+        """Reads at most size bytes of the response body as they
+        arrive. The connection goes back to the pool once the
+        whole body has been read"""
+        chunk = yield from asyncio.wait_for(
+            response.content.read(size), self._request_timeout,
+            loop=self._loop)
+
+        if not chunk:
+            yield from response.release()
+
+        return chunk
+
+    @asyncio.coroutine
+    def release(self, response):
+        """Drops the rest of the response body. A connection with
+        unread data on it cannot be reused, so it is closed"""
+        response.close()
+
+
+class SwiftObjectStream(object):
+
+    """SwiftObjectStream: A read-only file-like object over the
+    body of a Swift response. Data is read off the connection
+    as it is asked for, so only one chunk of the object is held
+    in memory at a time.
+
+    The stream is also an iterator of chunks of at most
+    chunk_size bytes, so it can be handed directly to a WSGI
+    server as a response body"""
+
+    # Number of bytes read per iteration
+    DEFAULT_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, client, response, chunk_size=None):
+        self._client = client
+        self._response = response
+        self._chunk_size = chunk_size or SwiftObjectStream.DEFAULT_CHUNK_SIZE
+
+    @property
+    def closed(self):
+        return self._response is None
+
+    def read(self, size=-1):
+        """Reads at most size bytes, or the rest of the object if
+        size is negative or None. Returns an empty bytes object
+        at the end of the object"""
+        if self._response is None:
+            return b''
+
+        chunk = self._client.run(self._client.read(
+            self._response, -1 if size is None else size))
+
+        if not chunk:
+            self._response = None
+
+        return chunk
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.read(self._chunk_size)
+
+        if not chunk:
+            raise StopIteration
+
+        return chunk
+
+    def close(self):
+        if self._response is not None:
+            self._client.run(self._client.release(self._response))
+            self._response = None
+
+
+def get_client():
+    """Returns the SwiftClient shared by all threads"""
+    global _client
+
+    with _client_lock:
+        if _client is None or _client.closed:
+            _client = SwiftClient()
+
+        return _client
 
 
-@get_event_loop
 def _async_request(method, url, headers, names, contents, etag):
+    """Sends a request for each of the named contents, at most
+    swift.upload_concurrency at a time.
+
+    :returns: The response of each request, in order, or None for
+        a request that still failed after its retries"""
+    client = get_client()
+    semaphore = asyncio.Semaphore(
+        conf.block_storage_driver.swift.upload_concurrency,
+        loop=client.loop)
+
+    @asyncio.coroutine
+    def send(url, headers, content):
+        with (yield from semaphore):
+            try:
+                response, body = yield from client.request(
+                    method, url, headers=headers, data=content)
+                return response
+            except TRANSIENT_ERRORS:
+                return None
+
     tasks = []
-    for name, content in zip(names, contents):
+    # etag is either a list of precomputed MD5 hexdigests, one
+    # per content, or a flag asking for them to be computed here
+    etags = etag if isinstance(etag, (list, tuple)) \
+        else [None] * len(contents)
+    for name, content, mdetag in zip(names, contents, etags):
         # NOTE(THeSriram) : xyu discovered that we received 422's
         # from swift if we didn't execute a copy of headers
         # containing the msd5 of block data
         headers = headers.copy()
         if etag:
-            mdhash = hashlib.md5()
-            mdhash.update(content)
-            mdetag = mdhash.hexdigest()
+            if mdetag is None:
+                mdetag = hashlib.md5(content).hexdigest()
             headers.update(
                 {'Etag': mdetag, 'Content-Length': str(len(content))})
         else:
             headers.update({'Content-Length': str(len(content))})
         tasks.append(
-            asyncio.Task(
-                _noloop_request(
-                    'PUT',
-                    url +
-                    str(name),
-                    headers=headers,
-                    data=content)))
-    total_responses = yield from asyncio.gather(*tasks)
+            send(
+                url +
+                str(name),
+                headers,
+                content))
+
+    @asyncio.coroutine
+    def send_all():
+        return (yield from asyncio.gather(*tasks, loop=client.loop))
+
+    total_responses = client.run(send_all())
     return total_responses
 
 
-@get_event_loop
 def _request(method, url, headers, data=None):
-    response = yield from aiohttp.request(method=method, url=url,
-                                          headers=headers, data=data)
+    client = get_client()
+    response, body = client.run(client.request(method, url, headers,
+                                               data=data))
     return response
 
 
-@get_event_loop
-def _request_getobj(method, url, headers, data=None):
-    response = yield from aiohttp.request(method=method, url=url,
-                                          headers=headers, data=data)
+def _request_getobj(method, url, headers, data=None, stream=False):
+    client = get_client()
 
-    block = yield from response.content.read()
-    return (response, block)
+    if not stream:
+        return client.run(client.request(method, url, headers, data=data,
+                                         read=True))
 
+    response, body = client.run(client.request(method, url, headers,
+                                               data=data, stream=True))
+    return (response, SwiftObjectStream(client, response))
 
-@get_event_loop
-def _request_getcontainer(method, url, headers, data=None):
-    response = yield from aiohttp.request(method=method, url=url,
-                                          headers=headers, data=data)
 
-    content = yield from response.content.read()
-    return (response, content)
+def _request_getcontainer(method, url, headers, data=None):
+    client = get_client()
+    return client.run(client.request(method, url, headers, data=data,
+                                     read=True))
 
 
 # Create vault
@@ -149,11 +399,17 @@ def put_async_object(
         contents,
         etag)
 
-    if all([response.status == 201 for response in responses]):
+    # The status of each object, or None if it could not be sent
+    statuses = [response.status if response is not None else None
+                for response in responses]
+
+    if all([status == 201 for status in statuses]):
         response_dict['status'] = 201
     else:
         response_dict['status'] = 500
 
+    return statuses
+
 
 # Check Block
 
@@ -192,7 +448,10 @@ def delete_object(url, token, container, name, response_dict):
 
 # Get Block
 
-def get_object(url, token, container, name, response_dict):
+def get_object(url, token, container, name, response_dict, stream=False):
+    """Fetches an object. If stream is set, the body is returned
+    as a SwiftObjectStream that the caller must read or close,
+    instead of being read into memory"""
     headers = {'X-Auth-Token': token}
     (response, block) = _request_getobj(
         'GET',
@@ -201,7 +460,8 @@ def get_object(url, token, container, name, response_dict):
         container +
         '/' +
         str(name),
-        headers=headers)
+        headers=headers,
+        stream=stream)
 
     response_dict['status'] = response.status
 
@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import threading
+
+from deuce import conf
+
+# Number of bytes fed to both digests at a time, small enough
+# that the second digest reads the slice from the CPU cache
+DIGEST_CHUNK_SIZE = 256 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def block_digests(blockdata):
+    """Computes the SHA-1 and MD5 of a block in a single pass
+    over its data.
+
+    :returns: A tuple of the SHA-1 and MD5 hexdigests"""
+    sha1 = hashlib.sha1()
+    md5 = hashlib.md5()
+    view = memoryview(blockdata)
+
+    for offset in range(0, len(view), DIGEST_CHUNK_SIZE):
+        chunk = view[offset:offset + DIGEST_CHUNK_SIZE]
+        sha1.update(chunk)
+        md5.update(chunk)
+
+    return (sha1.hexdigest(), md5.hexdigest())
+
+
+def _get_executor(workers):
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers)
+        return _executor
+
+
+def verify_blocks(block_ids, blockdatas):
+    """Validates the data of each block against its block id.
+
+    hashlib releases the GIL while digesting, so the blocks are
+    spread across api_configuration.hash_workers threads. Zero
+    workers, or a single block, hashes on the calling thread.
+
+    :returns: The MD5 hexdigest of each block, in order, so that
+        the storage driver does not have to hash them again
+    :raises ValueError: if a block does not match its block id"""
+    workers = conf.api_configuration.hash_workers
+
+    if workers < 1 or len(blockdatas) < 2:
+        digests = [block_digests(blockdata) for blockdata in blockdatas]
+    else:
+        digests = list(_get_executor(workers).map(block_digests,
+                                                  blockdatas))
+
+    for block_id, (sha1, md5) in zip(block_ids, digests):
+        if sha1 != block_id:
+            raise ValueError('Invalid Hash Value in the block ID')
+
+    return [md5 for sha1, md5 in digests]
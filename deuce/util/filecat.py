@@ -5,21 +5,40 @@ class FileCat(object):
 
     """FileCat: Allows multiple files to be handled
     as a single file-like-object for read-only
-    operations. Seek is not supported"""
+    operations. Seek is not supported.
 
-    def __init__(self, fileobjs):
+    FileCat is also an iterator yielding chunks of at most
+    chunk_size bytes, so it can be handed directly to a WSGI
+    server as a response body. Chunks never span two files,
+    so no data is copied while iterating"""
+
+    # Number of bytes read from the current file per iteration
+    DEFAULT_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fileobjs, chunk_size=None):
         """Constructs a new FileCat object.
         :param fileobjs: Any iterable capable of
             returning file-like objects. The objects
             must be ready-to-read
+        :param chunk_size: The maximum number of bytes
+            returned by each iteration
         """
         self._objs = fileobjs
         self._current_file = None
+        self._chunk_size = chunk_size or FileCat.DEFAULT_CHUNK_SIZE
         if self._objs:
-            try:
-                self._current_file = next(self._objs)
-            except StopIteration:
-                self._current_file = None
+            self._next_file()
+
+    def _next_file(self):
+        """Moves on to the next file in the sequence, closing
+        the current one (if any)"""
+        if self._current_file:
+            self._current_file.close()
+
+        try:
+            self._current_file = next(self._objs)
+        except StopIteration:
+            self._current_file = None
 
     def read(self, count=None):
 
@@ -38,17 +57,40 @@ class FileCat(object):
 
                 # Close this file. We're going
                 # to move on to the next one
-                self._current_file.close()
+                self._next_file()
 
-                try:
-                    self._current_file = next(self._objs)
-                except StopIteration:
+                if not self._current_file:
                     # We are done, just break and
                     # return whatever we've already
                     # read (if anything)
-                    self._current_file = None
                     break
             else:
                 res += buff
 
         return res
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self._current_file:
+            buff = self._current_file.read(self._chunk_size)
+
+            if len(buff) > 0:
+                return buff
+
+            self._next_file()
+
+        raise StopIteration
+
+    def close(self):
+        """Closes the file currently being read. Called by
+        the WSGI server once the response is finished, or
+        when the client goes away part way through"""
+        if self._current_file:
+            self._current_file.close()
+            self._current_file = None
+
+        # Stop any work being done to produce the remaining files
+        if hasattr(self._objs, 'close'):
+            self._objs.close()
@@ -21,6 +21,7 @@ setup(
     entry_points={
         'console_scripts': [
             'deuce-server = deuce.cmd.server:run',
+            'deuce-repair-block-refs = deuce.cmd.repair:run',
         ]
     },
     data_files=[('config', ['ini/config.ini', 'ini/configspec.ini'])],
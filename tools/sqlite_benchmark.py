@@ -0,0 +1,119 @@
+"""Times the sqlite metadata driver's hot lookups as the number
+of blocks in a vault grows. With the schema's indexes in place
+each lookup should stay roughly flat (O(log n)) from one size to
+the next.
+
+    python tools/sqlite_benchmark.py --sizes 10000 100000 10000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import deuce
+from deuce import conf
+from deuce.drivers.sqlite import SqliteStorageDriver
+from deuce.drivers.sqlite import sqlitemetadatadriver as sql
+
+PROJECT_ID = 'benchmark'
+VAULT_ID = 'vault'
+
+# One in this many blocks is bad, and one in this many files
+# is left unfinalized
+BAD_BLOCK_RATIO = 10000
+BLOCKS_PER_FILE = 100
+
+
+class Context(object):
+    project_id = PROJECT_ID
+
+
+def populate(driver, start, stop):
+    """Adds blocks [start, stop) to the vault, grouped into files"""
+    conn = driver._conn
+    batch = 100000
+
+    for first in range(start, stop, batch):
+        block_nums = range(first, min(first + batch, stop))
+
+        conn.executemany(
+            'INSERT INTO blocks (projectid, vaultid, blockid, storageid, '
+            'size, reftime, isinvalid) VALUES (?, ?, ?, ?, ?, 0, ?)',
+            ((PROJECT_ID, VAULT_ID, 'block%012d' % n, 'storage%012d' % n,
+              1024, int(n % BAD_BLOCK_RATIO == 0)) for n in block_nums))
+
+        conn.executemany(
+            'INSERT INTO fileblocks (projectid, vaultid, fileid, blockid, '
+            'offset) VALUES (?, ?, ?, ?, ?)',
+            ((PROJECT_ID, VAULT_ID, 'file%012d' % (n // BLOCKS_PER_FILE),
+              'block%012d' % n, (n % BLOCKS_PER_FILE) * 1024)
+             for n in block_nums))
+
+        conn.executemany(
+            'INSERT OR IGNORE INTO files (projectid, vaultid, fileid, '
+            'finalized, size) VALUES (?, ?, ?, 1, ?)',
+            ((PROJECT_ID, VAULT_ID, 'file%012d' % (n // BLOCKS_PER_FILE),
+              BLOCKS_PER_FILE * 1024) for n in block_nums))
+
+        conn.commit()
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for n in range(repeat):
+        func(n)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def run(driver, size, repeat):
+    conn = driver._conn
+
+    def storage_block_head(n):
+        args = dict(projectid=PROJECT_ID, vaultid=VAULT_ID,
+                    storageid='storage%012d' % (n * 7919 % size))
+        list(conn.execute(sql.SQL_GET_BLOCK_ID, args))
+
+    def vault_health(n):
+        driver.vault_health(VAULT_ID)
+
+    def file_listing(n):
+        args = dict(projectid=PROJECT_ID, vaultid=VAULT_ID,
+                    marker='file%012d' % (n * 7919 % size // BLOCKS_PER_FILE),
+                    finalized=1, limit=100)
+        list(conn.execute(sql.SQL_GET_ALL_FILES, args))
+
+    # Vault health walks every bad block, so it grows with their
+    # number rather than the vault's
+    bad_blocks = (size + BAD_BLOCK_RATIO - 1) // BAD_BLOCK_RATIO
+
+    print('{0:>10} blocks  head {1:8.1f}us  health {2:10.1f}us '
+          '({3} bad)  listing {4:8.1f}us'.format(
+              size,
+              timeit(storage_block_head, repeat),
+              timeit(vault_health, max(repeat // 100, 1)),
+              bad_blocks,
+              timeit(file_listing, repeat)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=1000)
+    args = parser.parse_args()
+
+    deuce.context = Context()
+
+    with tempfile.TemporaryDirectory() as path:
+        conf.metadata_driver.sqlite.path = os.path.join(path, 'bench.db')
+        driver = SqliteStorageDriver()
+
+        populated = 0
+        for size in sorted(args.sizes):
+            populate(driver, populated, size)
+            populated = size
+            run(driver, size, args.repeat)
+
+
+if __name__ == '__main__':
+    main()